@@ -0,0 +1,431 @@
+"""Measure the throughput of both spell engines on synthetic corpora
+
+The real spell files are too small to show how the engines scale, so this
+generates corpora of any size from the vocabulary in the modifiers files,
+with configurable nesting of subeffects and inheritance chains. Each stage
+of the pipeline is timed separately, and the results are printed as json
+so they can be tracked over time.
+
+Each engine and size is benchmarked in a fresh process, so that memory
+used by one run doesn't show up in the next. The memory of each stage is
+measured from the resident set size of that process on Linux:
+peak_memory_kb is how far it rose above what the process used when the
+stage started, at its highest during the stage, and memory_growth_kb is how
+much more the process used once the stage finished, which is mostly what
+the stage kept. They are null where they can't be measured.
+
+Example:
+    python benchmark.py --sizes 1000,10000 --depth 2 --chain 3
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+
+import yaml
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'new'))
+import spell_engine
+import spellgenerator
+from diagnostics import DiagnosticError
+from modifier_index import ModifierIndex
+from snapshot import load_yaml_snapshot, parse_yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def initialize_argument_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the spell engines')
+    parser.add_argument('--sizes', dest='sizes', type=str, default='1000,10000',
+                        help='comma separated numbers of abilities to generate')
+    parser.add_argument('--depth', dest='depth', type=int, default=1,
+                        help='maximum nesting depth of subeffects and attack subeffects')
+    parser.add_argument('--chain', dest='chain', type=int, default=1,
+                        help='length of $ref and base inheritance chains')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='seed for the corpus generator')
+    parser.add_argument('--engine', dest='engines', action='append',
+                        choices=['new', 'legacy'],
+                        help='engine to benchmark; may be repeated (default: both)')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        help='append the results as a json line to this file')
+    # used to benchmark each engine and size in a process of its own
+    parser.add_argument('--run', dest='run', choices=['new', 'legacy'],
+                        help=argparse.SUPPRESS)
+    return vars(parser.parse_args())
+
+
+def numeric_leaves(modifiers):
+    """Get the names of the entries of a modifiers dict that have a number"""
+    return sorted(
+        key for key, value in modifiers.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    )
+
+
+def nested_leaves(modifiers):
+    """Get {name: value} references to the nested entries of a modifiers dict"""
+    references = list()
+    for key, value in sorted(modifiers.items()):
+        if isinstance(value, dict):
+            for subkey in numeric_leaves(value):
+                references.append({key: subkey})
+    return references
+
+
+class AbilityCorpusGenerator(object):
+    """Generate abilities for new/spell_engine.py from new/modifiers.yaml"""
+
+    def __init__(self, modifiers, rng):
+        self.rng = rng
+        self.conditions = numeric_leaves(modifiers['conditions'])
+        self.condition_durations = numeric_leaves(modifiers['duration']['condition'])
+        self.buffs = numeric_leaves(modifiers['buffs']) + nested_leaves(modifiers['buffs'])
+        self.buff_durations = numeric_leaves(modifiers['duration']['nonpersonal buff'])
+        self.battlefield_effects = numeric_leaves(modifiers['battlefield effects'])
+        self.battlefield_durations = numeric_leaves(modifiers['duration']['battlefield effect'])
+        self.damage = numeric_leaves(modifiers['damage'])
+        self.instant_effects = numeric_leaves(modifiers['instant effect'])
+        # personal buffs have a different set of durations
+        self.ranges = [
+            range_name for range_name in numeric_leaves(modifiers['range']['normal'])
+            if range_name != 'personal'
+        ]
+        self.casting_times = numeric_leaves(modifiers['casting time'])
+        self.areas = list()
+        for shape in sorted(modifiers['area']):
+            for size in numeric_leaves(modifiers['area'][shape]):
+                for area_type in numeric_leaves(modifiers['area type']):
+                    self.areas.append("{0} {1} {2}".format(size, shape, area_type))
+
+    def effect(self, depth):
+        """Generate the primary properties of an ability"""
+        choice = self.rng.random()
+        if depth > 0 and choice < 0.15:
+            return {'subeffects': [
+                self.effect(depth - 1) for i in range(self.rng.randint(2, 3))
+            ]}
+        elif depth > 0 and choice < 0.3:
+            return {'attack subeffects': {
+                'success': self.effect(depth - 1),
+                'effect': self.effect(depth - 1),
+            }}
+        elif choice < 0.5:
+            return {
+                'conditions': [self.rng.choice(self.conditions)],
+                'duration': self.rng.choice(self.condition_durations),
+            }
+        elif choice < 0.7:
+            return {
+                'buffs': self.rng.sample(self.buffs, 2),
+                'duration': self.rng.choice(self.buff_durations),
+            }
+        elif choice < 0.8:
+            return {
+                'battlefield effects': [self.rng.choice(self.battlefield_effects)],
+                'duration': self.rng.choice(self.battlefield_durations),
+            }
+        elif choice < 0.9:
+            return {'instant effect': self.rng.choice(self.instant_effects)}
+        else:
+            return {'damage': self.rng.choice(self.damage)}
+
+    def ability(self, depth):
+        properties = self.effect(depth)
+        properties['range'] = self.rng.choice(self.ranges)
+        if self.rng.random() < 0.3:
+            properties['area'] = self.rng.choice(self.areas)
+            properties['targets'] = self.rng.choice(['all', 'allies', 'enemies'])
+        if self.rng.random() < 0.2:
+            properties['casting time'] = self.rng.choice(self.casting_times)
+        return properties
+
+    def corpus(self, size, depth, chain):
+        corpus = dict()
+        for index in range(size):
+            name = 'ability {0}'.format(index)
+            if index % chain:
+                corpus[name] = {
+                    '$ref': 'ability {0}'.format(index - 1),
+                    'range': self.rng.choice(self.ranges),
+                }
+            else:
+                corpus[name] = self.ability(depth)
+        return corpus
+
+
+class SpellCorpusGenerator(object):
+    """Generate spells for spellgenerator.py from modifiers.yaml"""
+
+    def __init__(self, modifiers, rng):
+        self.rng = rng
+        self.conditions = [
+            condition for condition in numeric_leaves(modifiers['conditions'])
+            if condition != 'base'
+        ]
+        self.buffs = [
+            buff for buff in numeric_leaves(modifiers['buffs'])
+            if buff != 'base'
+        ]
+        self.condition_durations = numeric_leaves(modifiers['duration']['normal'])
+        self.buff_durations = numeric_leaves(modifiers['duration']['nonpersonal buff'])
+        self.damage = numeric_leaves(modifiers['damage'])
+        self.ranges = numeric_leaves(modifiers['range']['normal'])
+        self.areas = list()
+        for shape in sorted(modifiers['area']):
+            for size in numeric_leaves(modifiers['area'][shape]):
+                self.areas.append("{0} {1}".format(size, shape))
+
+    def effect(self, depth):
+        choice = self.rng.random()
+        if depth > 0 and choice < 0.15:
+            return {'subeffects': [
+                self.effect(depth - 1) for i in range(self.rng.randint(2, 3))
+            ]}
+        elif depth > 0 and choice < 0.3:
+            return {'attack subeffects': {
+                'success': self.effect(depth - 1),
+                'effect': self.effect(depth - 1),
+            }}
+        elif choice < 0.6:
+            return {
+                'conditions': [self.rng.choice(self.conditions)],
+                'duration': self.rng.choice(self.condition_durations),
+            }
+        elif choice < 0.8:
+            return {
+                'buffs': [self.rng.choice(self.buffs)],
+                'duration': self.rng.choice(self.buff_durations),
+            }
+        else:
+            return {'damage': self.rng.choice(self.damage)}
+
+    def spell(self, depth):
+        attributes = self.effect(depth)
+        attributes['range'] = self.rng.choice(self.ranges)
+        if self.rng.random() < 0.3:
+            attributes[self.rng.choice(['burst', 'emanation'])] = self.rng.choice(self.areas)
+            attributes['targets'] = self.rng.choice(['all', 'allies', 'enemies'])
+        return attributes
+
+    def corpus(self, size, depth, chain):
+        corpus = {
+            'default spell': {
+                'casting time': 'standard',
+                'dispellable': True,
+                'spell resistance': True,
+                # warnings would be printed in the middle of the benchmark
+                'ignore warnings': True,
+            },
+        }
+        for index in range(size):
+            name = 'spell {0}'.format(index)
+            if index % chain:
+                corpus[name] = {
+                    'base': 'spell {0}'.format(index - 1),
+                    'range': self.rng.choice(self.ranges),
+                }
+            else:
+                corpus[name] = self.spell(depth)
+        return corpus
+
+
+def memory_kb(field):
+    """Read a memory statistic of this process from /proc on Linux
+
+    Args:
+        field (str): VmRSS for the resident set size, or VmHWM for its peak
+
+    Yields:
+        int: kilobytes, or None if it can't be read
+    """
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            match = re.search(r'^{0}:\s+(\d+) kB'.format(field), status_file.read(), re.M)
+    except IOError:
+        return None
+    return int(match.group(1)) if match else None
+
+
+def reset_peak_memory():
+    """Make VmHWM start again from the current resident set size
+
+    Yields:
+        bool: whether it could be reset, which needs Linux 4.0 or later
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def timed(stages, stage_name, count, function, *args):
+    peak_was_reset = reset_peak_memory()
+    start_memory = memory_kb('VmRSS')
+    start_time = time.time()
+    result = function(*args)
+    seconds = time.time() - start_time
+    peak_memory = memory_kb('VmHWM') if peak_was_reset else None
+    end_memory = memory_kb('VmRSS')
+    stages[stage_name] = {
+        'seconds': round(seconds, 6),
+        'per_second': round(count / seconds, 1) if seconds else None,
+        'peak_memory_kb': (
+            None if peak_memory is None or start_memory is None
+            else max(0, peak_memory - start_memory)
+        ),
+        'memory_growth_kb': (
+            None if end_memory is None or start_memory is None
+            else end_memory - start_memory
+        ),
+    }
+    return result
+
+
+def apply_all(function, items):
+    """Apply a function to every item, skipping the ones that it rejects
+
+    Random combinations of properties are sometimes invalid, such as an
+    attack whose effect is stronger than its success. Those still cost the
+    engine time, so they are timed along with the valid ones. Only
+    validation errors are skipped; any other exception is a bug in the
+    engine, and fails the benchmark.
+
+    Yields:
+        list: the results for the items that were accepted
+    """
+    results = list()
+    for item in items:
+        try:
+            results.append(function(*item))
+        except DiagnosticError:
+            pass
+    return results
+
+
+def benchmark_new_engine(size, depth, chain, seed):
+    modifiers_file_name = os.path.join(REPOSITORY_DIRECTORY, 'new', 'modifiers.yaml')
+    raw_modifiers = load_yaml_snapshot(modifiers_file_name)
+    generator = AbilityCorpusGenerator(raw_modifiers, random.Random(seed))
+    text = yaml.dump(generator.corpus(size, depth, chain), Dumper=SafeDumper)
+
+    stages = dict()
+    raw_data = timed(stages, 'yaml load', size, parse_yaml, text)
+    data = timed(stages, 'inheritance resolution', size,
+                 spell_engine.resolve_refs, raw_data)
+
+    table = spell_engine.ModifierTable(modifiers=raw_modifiers)
+
+    def create_ability(name, properties):
+        # validation is timed on its own below
+        properties = dict(properties)
+        properties['skip validation'] = True
+        return spell_engine.Ability(name, properties, table)
+
+    def validate_ability(ability):
+        ability.skip_validation = False
+        ability.validate()
+        return ability
+
+    abilities = timed(stages, 'Ability.__init__', size, apply_all,
+                      create_ability, data.iteritems())
+    valid_abilities = timed(stages, 'Ability.validate', len(abilities), apply_all,
+                            validate_ability, [(ability,) for ability in abilities])
+    levels = timed(stages, 'Ability.level', len(valid_abilities), apply_all,
+                   lambda ability: ability.level(),
+                   [(ability,) for ability in valid_abilities])
+    stages['Ability.__init__']['rejected'] = size - len(abilities)
+    stages['Ability.validate']['rejected'] = len(abilities) - len(valid_abilities)
+    stages['Ability.level']['rejected'] = len(valid_abilities) - len(levels)
+    return stages
+
+
+def benchmark_legacy_engine(size, depth, chain, seed):
+    raw_modifiers = load_yaml_snapshot(os.path.join(REPOSITORY_DIRECTORY, 'modifiers.yaml'))
+    all_modifiers = ModifierIndex(raw_modifiers)
+    generator = SpellCorpusGenerator(raw_modifiers, random.Random(seed))
+    text = yaml.dump(generator.corpus(size, depth, chain), Dumper=SafeDumper)
+
+    stages = dict()
+    raw_spells = timed(stages, 'yaml load', size, parse_yaml, text)
+    spells = timed(stages, 'inheritance resolution', size,
+                   spellgenerator.resolve_spells, raw_spells)
+    del spells['default spell']
+    levels = timed(stages, 'Spell.calculate_level', size, apply_all,
+                   lambda name, attributes: spellgenerator.Spell(
+                       name, dict(attributes), all_modifiers
+                   ).calculate_level(),
+                   spells.iteritems())
+    stages['Spell.calculate_level']['rejected'] = size - len(levels)
+    return stages
+
+
+BENCHMARKS = {
+    'legacy': benchmark_legacy_engine,
+    'new': benchmark_new_engine,
+}
+
+
+def run_in_subprocess(engine, size, depth, chain, seed):
+    """Benchmark an engine in a fresh process, so runs don't share memory
+
+    Yields:
+        dict: the stages, like the benchmark functions
+    """
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__),
+        '--run', engine,
+        '--sizes', str(size),
+        '--depth', str(depth),
+        '--chain', str(chain),
+        '--seed', str(seed),
+    ])
+    return json.loads(output)
+
+
+def main(args):
+    if args['run']:
+        print json.dumps(BENCHMARKS[args['run']](
+            int(args['sizes']), args['depth'], args['chain'], args['seed']
+        ))
+        return
+
+    results = list()
+    for size in [int(size) for size in args['sizes'].split(',')]:
+        for engine in args['engines'] or sorted(BENCHMARKS):
+            results.append({
+                'engine': engine,
+                'size': size,
+                'depth': args['depth'],
+                'chain': args['chain'],
+                'seed': args['seed'],
+                'stages': run_in_subprocess(
+                    engine, size, args['depth'], args['chain'], args['seed']
+                ),
+            })
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+    print json.dumps(report, indent=4, sort_keys=True)
+    if args['output']:
+        with open(args['output'], 'a') as output_file:
+            output_file.write(json.dumps(report, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main(initialize_argument_parser())
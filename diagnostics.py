@@ -0,0 +1,158 @@
+"""Collect the problems that the spell engines find in the entries they level
+
+Both engines used to print warnings as soon as they found them, and to
+format every property of an entry into the message of each error. Instead,
+problems are recorded as Diagnostics with a code, a severity, the name of
+the entry they belong to, and the arguments of their message, which is only
+formatted when the diagnostic is reported. Diagnostics are plain tuples, so
+they can be sent back from worker processes and merged into one collector.
+
+Suppression rules look like 'weak-success', which suppresses a code for
+every entry, or '_cantrip *:weak-*', which only suppresses it for entries
+whose names match. Codes and names are matched with shell-style wildcards.
+"""
+
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+ERROR = 'error'
+WARNING = 'warning'
+
+
+class Diagnostic(namedtuple('Diagnostic', 'code severity entry_name template arguments')):
+    """A problem with an entry
+
+    The template is formatted with the arguments, and with the entry name
+    as 'name'.
+    """
+    __slots__ = ()
+
+    def message(self):
+        return self.template.format(*self.arguments, name=self.entry_name)
+
+    def __str__(self):
+        return "{0}: {1}".format(self.severity.capitalize(), self.message())
+
+
+class DiagnosticError(Exception):
+    """Raised for a diagnostic that prevents an entry from being leveled
+
+    The details, usually the properties of the entry, are only formatted if
+    the error is printed.
+    """
+
+    def __init__(self, diagnostic, details=None, details_format="({0})"):
+        # everything is passed to Exception so that it can be pickled
+        super(DiagnosticError, self).__init__(diagnostic, details, details_format)
+        self.diagnostic = diagnostic
+        self.details = details
+        self.details_format = details_format
+
+    def __str__(self):
+        message = self.diagnostic.message()
+        if self.details is None:
+            return message
+        return message + ' ' + self.details_format.format(self.details)
+
+
+def parse_suppression(text):
+    """Parse a suppression rule such as 'weak-success' or 'grease:weak-*'
+
+    Yields:
+        tuple: (entry name pattern, code pattern)
+    """
+    if ':' not in text:
+        return '*', text.strip()
+    entry_pattern, code_pattern = text.rsplit(':', 1)
+    return entry_pattern.strip(), code_pattern.strip()
+
+
+def is_suppressed(code, suppressed_codes):
+    """Check whether a code is suppressed by the suppression of an entry
+
+    Args:
+        code (str)
+        suppressed_codes: True to suppress every code, or a list of code
+            patterns, as given by 'ignore warnings' or 'skip validation'
+    """
+    if suppressed_codes is True:
+        return True
+    if not suppressed_codes:
+        return False
+    return any(fnmatchcase(code, pattern) for pattern in suppressed_codes)
+
+
+class DiagnosticCollector(object):
+    """Gathers the diagnostics of many entries, without duplicates"""
+
+    def __init__(self, suppressions=()):
+        """
+        Args:
+            suppressions (list): suppression rule strings
+        """
+        self.suppressions = [parse_suppression(text) for text in suppressions]
+        self.diagnostics = list()
+        self._seen = set()
+        self.suppressed_count = 0
+
+    def is_suppressed(self, diagnostic):
+        for entry_pattern, code_pattern in self.suppressions:
+            if (fnmatchcase(diagnostic.code, code_pattern)
+                    and fnmatchcase(diagnostic.entry_name, entry_pattern)):
+                return True
+        return False
+
+    def add(self, diagnostic):
+        if diagnostic in self._seen:
+            return
+        self._seen.add(diagnostic)
+        if self.is_suppressed(diagnostic):
+            self.suppressed_count += 1
+            return
+        self.diagnostics.append(diagnostic)
+
+    def extend(self, diagnostics):
+        for diagnostic in diagnostics:
+            self.add(diagnostic)
+
+    def take(self):
+        """Remove and return the diagnostics collected so far
+
+        Duplicates of the removed diagnostics are still ignored afterwards.
+
+        Yields:
+            list: Diagnostics
+        """
+        diagnostics = self.diagnostics
+        self.diagnostics = list()
+        return diagnostics
+
+    def counts(self):
+        """Count the collected diagnostics
+
+        Yields:
+            dict: maps (severity, code) to the number of diagnostics
+        """
+        counts = dict()
+        for diagnostic in self.diagnostics:
+            key = (diagnostic.severity, diagnostic.code)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def report(self, stream, prefix='', summary=False):
+        """Write the collected diagnostics in the order they were found
+
+        Args:
+            stream (file)
+            prefix (str): written before each line, such as '#' to write
+                the diagnostics as yaml comments
+            summary (bool): if true, finish with the number of diagnostics
+                of each code
+        """
+        for diagnostic in self.diagnostics:
+            stream.write("{0}{1}\n".format(prefix, diagnostic))
+        if summary and (self.diagnostics or self.suppressed_count):
+            for (severity, code), count in sorted(self.counts().items()):
+                stream.write("{0}{1} {2}: {3}\n".format(prefix, severity, code, count))
+            if self.suppressed_count:
+                stream.write("{0}suppressed: {1}\n".format(prefix, self.suppressed_count))
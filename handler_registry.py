@@ -0,0 +1,47 @@
+"""Map property names to the methods that calculate their modifiers
+
+Both spell engines used to find the method for a property by name every
+time they calculated a modifier. Instead, methods are marked with the
+properties they handle, and a registry that maps each property name to its
+handler is built once, when the class is defined. Subclasses inherit the
+registry of their base classes, and can handle new properties or override
+old ones by marking their own methods.
+"""
+
+
+def handles(*property_names):
+    """Mark a method as the handler of the given properties
+
+    Args:
+        property_names (str)
+
+    Example:
+        @handles('area')
+        def _area_modifier(self):
+    """
+    def mark(method):
+        method.handled_properties = (
+            getattr(method, 'handled_properties', ()) + property_names
+        )
+        return method
+    return mark
+
+
+def collect_handlers(cls, registry_name):
+    """Build the registry of a class from its marked methods
+
+    Args:
+        cls (class)
+        registry_name (str): name of the class attribute that holds the
+            registry, so that registries can be inherited
+
+    Yields:
+        dict: maps property names to functions
+    """
+    registry = dict()
+    for base_class in reversed(cls.__bases__):
+        registry.update(getattr(base_class, registry_name, {}))
+    for function in cls.__dict__.values():
+        for property_name in getattr(function, 'handled_properties', ()):
+            registry[property_name] = function
+    return registry
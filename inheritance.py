@@ -0,0 +1,106 @@
+"""Resolve inheritance between the entries of a yaml data file
+
+Entries can name a parent entry to inherit from, using '$ref' in the new
+spell engine and 'base' in spellgenerator. The InheritanceGraph finds the
+parent of every entry once, rejects cycles, and resolves the entries in
+topological order, so each entry is merged with its parent exactly once no
+matter how long its inheritance chain is.
+"""
+
+
+class InheritanceGraph(object):
+    """The parent/child relationships between the entries of a data file"""
+
+    def __init__(self, entries, parent_key):
+        """
+        Args:
+            entries (dict): maps entry names to dicts of properties
+            parent_key (str): the property that names an entry's parent
+        """
+        self.entries = entries
+        self.parent_key = parent_key
+
+        self.parents = dict()
+        self.children = dict()
+        for name in entries:
+            parent_name = entries[name].get(parent_key)
+            if parent_name is None:
+                continue
+            if parent_name not in entries:
+                raise Exception("Undefined {0} to parent '{1}'".format(
+                    parent_key,
+                    parent_name
+                ))
+            self.parents[name] = parent_name
+            self.children.setdefault(parent_name, list()).append(name)
+
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        """Sort the entry names so that every parent comes before its children
+
+        Yields:
+            list
+        """
+        order = list()
+        # entries whose parents are already in the order
+        ordered = set()
+        for name in self.entries:
+            # walk up to the first ancestor that is already ordered
+            chain = list()
+            in_chain = set()
+            ancestor_name = name
+            while ancestor_name is not None and ancestor_name not in ordered:
+                if ancestor_name in in_chain:
+                    cycle = chain[chain.index(ancestor_name):] + [ancestor_name]
+                    raise Exception("Inheritance cycle through {0} ({1})".format(
+                        self.parent_key,
+                        ' -> '.join(cycle)
+                    ))
+                chain.append(ancestor_name)
+                in_chain.add(ancestor_name)
+                ancestor_name = self.parents.get(ancestor_name)
+            # the ancestors come first
+            for chain_name in reversed(chain):
+                order.append(chain_name)
+                ordered.add(chain_name)
+        return order
+
+    def descendants(self, names):
+        """Find every entry that inherits from the given entries
+
+        Args:
+            names (iterable)
+
+        Yields:
+            set: the given names plus the names of all of their descendants
+        """
+        descendants = set(names)
+        unvisited = list(descendants)
+        while unvisited:
+            for child_name in self.children.get(unvisited.pop(), []):
+                if child_name not in descendants:
+                    descendants.add(child_name)
+                    unvisited.append(child_name)
+        return descendants
+
+    def resolve(self, merge):
+        """Merge every entry with its resolved parent
+
+        Entries without a parent are used as they are, without being copied.
+
+        Args:
+            merge (function): takes the resolved parent and the child entry,
+                and returns the resolved child entry without modifying either
+
+        Yields:
+            dict: maps entry names to resolved entries
+        """
+        resolved = dict()
+        for name in self.order:
+            entry = self.entries[name]
+            if name in self.parents:
+                resolved[name] = merge(resolved[self.parents[name]], entry)
+            else:
+                resolved[name] = entry
+        return resolved
@@ -0,0 +1,318 @@
+"""Compare freshly calculated levels with an older version of the levels
+
+Balance changes are reviewed by reading the diff of the generated levels
+files, which says which levels changed but not why. A LevelDiff compares
+two versions of the corpus and attributes each change in level to the
+properties whose modifiers changed.
+
+Each version is evaluated into EntryResults, which remember a hash of the
+properties of the entry, a hash of the engine's code, and the modifier
+paths it read. Entries whose properties and code are unchanged, and which
+read none of the modifiers that changed, keep their old result instead of
+being leveled again. The results of an older git revision are stored in a
+snapshot keyed by the contents of its files and the engine's code, so a
+regression check against the same revision only levels the entries that
+were edited since, and any change to the engine levels everything again.
+"""
+
+from collections import namedtuple
+import hashlib
+import json
+import os
+import subprocess
+
+from modifier_index import ModifierIndex
+from snapshot import load_content_snapshot, parse_yaml
+
+# modifier_paths is None if the engine doesn't record them, in which case
+# the entry has to be leveled again whenever any modifier changes; the
+# hashes are filled in by evaluate_entries
+EntryResult = namedtuple('EntryResult', 'input_hash code_hash level breakdown modifier_paths error')
+
+# attribution lists (property name, old modifier, new modifier) for every
+# property whose modifier changed, largest change first
+LevelChange = namedtuple('LevelChange', 'name old_level new_level attribution')
+
+
+def input_hash(properties):
+    """Hash the resolved properties of an entry"""
+    return hashlib.sha1(json.dumps(properties, sort_keys=True, default=repr)).hexdigest()
+
+
+def read_revision_file(file_name, revision=None):
+    """Read a file from the working tree, or as it was at a git revision
+
+    Args:
+        file_name (str): path relative to the current directory
+        revision (str): a git revision such as 'HEAD', or None for the
+            working tree
+
+    Yields:
+        str
+    """
+    if revision is None:
+        with open(file_name, 'rb') as data_file:
+            return data_file.read()
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'show', "{0}:./{1}".format(revision, file_name)],
+                stderr=devnull,
+            )
+    except (OSError, subprocess.CalledProcessError):
+        raise Exception("Can't read {0} at revision {1}".format(file_name, revision))
+
+
+def read_levels_file(file_name):
+    """Read the levels written by either engine, skipping comments
+
+    Yields:
+        dict: maps entry names to levels, or None for ignored entries
+    """
+    levels = dict()
+    with open(file_name, 'r') as levels_file:
+        for line in levels_file:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            name, level = line.rsplit(':', 1)
+            levels[name] = parse_level(level.strip())
+    return levels
+
+
+def parse_level(text):
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def changed_modifier_paths(old_table, new_table):
+    """Find the paths of all modifiers that differ between two flat tables
+
+    Args:
+        old_table (dict): maps modifier paths to values, like
+            ModifierIndex.table
+        new_table (dict)
+
+    Yields:
+        set
+    """
+    changed_paths = set()
+    for path in set(old_table) | set(new_table):
+        if (path not in old_table
+                or path not in new_table
+                or old_table[path] != new_table[path]):
+            changed_paths.add(path)
+    return changed_paths
+
+
+def evaluate_entries(entries, evaluate, code_hash, previous=None, changed_paths=None):
+    """Evaluate every entry, reusing previous results whose inputs are the same
+
+    Args:
+        entries (dict): maps entry names to resolved properties
+        evaluate (function): called with (name, properties) to get the
+            EntryResult of an entry
+        code_hash (str): a hash of the code of the engine, from
+            result_cache.source_hash
+        previous (dict): maps entry names to EntryResults of an older
+            version, or None
+        changed_paths (set): the modifier paths that changed since the
+            older version
+
+    Yields:
+        tuple: (dict mapping entry names to EntryResults, number of entries
+            that were reused)
+    """
+    results = dict()
+    reused_count = 0
+    for name, properties in entries.items():
+        digest = input_hash(properties)
+        result = (previous or {}).get(name)
+        if (result is not None
+                and result.input_hash == digest
+                and result.code_hash == code_hash
+                and (not changed_paths
+                     or (result.modifier_paths is not None
+                         and result.modifier_paths.isdisjoint(changed_paths)))):
+            reused_count += 1
+        else:
+            result = evaluate(name, properties)._replace(
+                input_hash=digest, code_hash=code_hash
+            )
+        results[name] = result
+    return results, reused_count
+
+
+def attribute_change(old_breakdown, new_breakdown):
+    """Find the properties whose modifiers differ between two breakdowns
+
+    Yields:
+        list: (property name, old modifier, new modifier), largest change first
+    """
+    if old_breakdown is None or new_breakdown is None:
+        return []
+    attribution = list()
+    for property_name in set(old_breakdown) | set(new_breakdown):
+        old_modifier = old_breakdown.get(property_name)
+        new_modifier = new_breakdown.get(property_name)
+        if old_modifier != new_modifier:
+            attribution.append((property_name, old_modifier, new_modifier))
+    attribution.sort(key=lambda change: (
+        -abs((change[2] or 0) - (change[1] or 0)), change[0]
+    ))
+    return attribution
+
+
+class LevelDiff(object):
+    """The entries that were added, removed or changed level between versions"""
+
+    def __init__(self, old_levels, new_results, old_results=None, reused_count=0):
+        """
+        Args:
+            old_levels (dict): maps entry names to their old levels
+            new_results (dict): maps entry names to their new EntryResults
+            old_results (dict): maps entry names to old EntryResults, which
+                are only needed to attribute changes to properties
+            reused_count (int): the number of new results that were reused
+                from the old ones rather than leveled again
+        """
+        old_results = old_results or dict()
+        self.added = dict()
+        self.removed = dict()
+        self.changed = list()
+        self.errors = dict()
+        self.unchanged_count = 0
+        self.reused_count = reused_count
+        for name in sorted(set(old_levels) | set(new_results)):
+            if name not in new_results:
+                self.removed[name] = old_levels[name]
+                continue
+            result = new_results[name]
+            if result.error is not None:
+                self.errors[name] = result.error
+            elif name not in old_levels:
+                self.added[name] = result.level
+            elif old_levels[name] != result.level:
+                old_result = old_results.get(name)
+                self.changed.append(LevelChange(
+                    name,
+                    old_levels[name],
+                    result.level,
+                    attribute_change(
+                        old_result and old_result.breakdown,
+                        result.breakdown,
+                    ),
+                ))
+            else:
+                self.unchanged_count += 1
+
+    def is_empty(self):
+        return not (self.added or self.removed or self.changed or self.errors)
+
+    def report(self, stream):
+        def format_modifier(modifier):
+            return 'none' if modifier is None else modifier
+
+        for name, level in sorted(self.added.items()):
+            stream.write("added: {0}: {1}\n".format(name, level))
+        for name, level in sorted(self.removed.items()):
+            stream.write("removed: {0}: {1}\n".format(name, level))
+        for change in self.changed:
+            stream.write("changed: {0}: {1} -> {2}".format(
+                change.name, change.old_level, change.new_level
+            ))
+            if change.attribution:
+                stream.write(" ({0})".format(', '.join(
+                    "{0}: {1} -> {2}".format(
+                        property_name,
+                        format_modifier(old_modifier),
+                        format_modifier(new_modifier),
+                    )
+                    for property_name, old_modifier, new_modifier in change.attribution
+                )))
+            stream.write("\n")
+        for name, error in sorted(self.errors.items()):
+            stream.write("error: {0}: {1}\n".format(name, error))
+        stream.write("{0} changed, {1} added, {2} removed, {3} errors, {4} unchanged ({5} not leveled again)\n".format(
+            len(self.changed), len(self.added), len(self.removed),
+            len(self.errors), self.unchanged_count, self.reused_count,
+        ))
+
+
+def diff_levels(data_file_name, modifiers_file_name, load_entries, make_evaluate,
+                code_hash, old_revision='HEAD', new_revision=None, levels_file_name=None):
+    """Compare the levels of two versions of a data file
+
+    Args:
+        data_file_name (str)
+        modifiers_file_name (str)
+        load_entries (function): converts the text of a data file into a
+            dict of resolved entries
+        make_evaluate (function): called with a ModifierIndex to get the
+            function that evaluates an entry into an EntryResult
+        code_hash (str): a hash of the code of the engine, from
+            result_cache.source_hash; results of other code are never reused
+        old_revision (str): the git revision to compare against
+        new_revision (str): the git revision to compare, or None for the
+            working tree
+        levels_file_name (str): if given, the old levels are read from this
+            file, and the old revision is only used to avoid leveling
+            unchanged entries again and to attribute changes
+
+    Yields:
+        LevelDiff
+    """
+    old_results = None
+    old_modifiers = None
+    try:
+        old_texts = [
+            read_revision_file(data_file_name, old_revision),
+            read_revision_file(modifiers_file_name, old_revision),
+        ]
+    except Exception:
+        # without the old inputs, every entry is leveled again
+        if levels_file_name is None:
+            raise
+    else:
+        old_modifiers = ModifierIndex(parse_yaml(old_texts[1]))
+        old_results = load_content_snapshot(
+            data_file_name,
+            old_texts + [code_hash],
+            lambda: evaluate_entries(
+                load_entries(old_texts[0]), make_evaluate(old_modifiers), code_hash
+            )[0],
+            'level-diff',
+        )
+
+    if levels_file_name is None:
+        old_levels = dict(
+            (name, result.level) for name, result in old_results.items()
+            if result.error is None
+        )
+    else:
+        old_levels = read_levels_file(levels_file_name)
+        if old_results is not None:
+            # results that disagree with the levels file can't be trusted
+            old_results = dict(
+                (name, result) for name, result in old_results.items()
+                if name in old_levels and result.level == old_levels[name]
+            )
+
+    new_modifiers = ModifierIndex(parse_yaml(
+        read_revision_file(modifiers_file_name, new_revision)
+    ))
+    changed_paths = None
+    if old_modifiers is not None:
+        changed_paths = changed_modifier_paths(old_modifiers.table, new_modifiers.table)
+    new_results, reused_count = evaluate_entries(
+        load_entries(read_revision_file(data_file_name, new_revision)),
+        make_evaluate(new_modifiers),
+        code_hash,
+        old_results,
+        changed_paths,
+    )
+    return LevelDiff(old_levels, new_results, old_results, reused_count)
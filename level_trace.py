@@ -0,0 +1,109 @@
+"""Record how the level of an entry was calculated, and render it
+
+Explaining a level used to mean printing while calculating it again, and
+reading the modifiers of subeffects back out of the objects that were left
+behind. Instead, each engine records a LevelTrace while it levels an entry:
+the contribution of every property, the modifier paths it read, and the
+traces of the subeffects it contains. A trace is plain tuples, so it can be
+rendered in any format after the entry is leveled, without leveling it again.
+"""
+
+from collections import namedtuple
+import json
+
+# the number of lines shown by format_top_contributors by default
+DEFAULT_TOP_COUNT = 10
+
+
+class LevelTrace(namedtuple('LevelTrace', 'name level contributions')):
+    """How the level of an entry was calculated
+
+    The contributions are in the order that the engine calculated them.
+    """
+    __slots__ = ()
+
+
+# modifier is usually a number, but the legacy engine keeps a list of
+# numbers for modifiers that were added more than once; paths are the
+# modifier paths read by this contribution itself, not by its subtraces
+Contribution = namedtuple('Contribution', 'name value modifier paths subtraces')
+
+# the trace of a subeffect, and the level it contributed to its parent;
+# label names the part of an attack it belongs to, or is None
+Subtrace = namedtuple('Subtrace', 'label level trace')
+
+
+def total_modifier(modifier):
+    """Get the sum of a modifier that may be a list of modifiers"""
+    if isinstance(modifier, list):
+        return sum(modifier)
+    return modifier
+
+
+def trace_to_dict(trace):
+    """Convert a trace into nested dicts and lists that json can encode"""
+    return {
+        'name': trace.name,
+        'level': trace.level,
+        'contributions': [
+            {
+                'name': contribution.name,
+                'value': contribution.value,
+                'modifier': contribution.modifier,
+                'paths': [list(path) for path in sorted(contribution.paths)],
+                'subtraces': [
+                    {
+                        'label': subtrace.label,
+                        'level': subtrace.level,
+                        'trace': trace_to_dict(subtrace.trace),
+                    }
+                    for subtrace in contribution.subtraces
+                ],
+            }
+            for contribution in trace.contributions
+        ],
+    }
+
+
+def format_json(trace):
+    return json.dumps(trace_to_dict(trace), sort_keys=True, default=repr)
+
+
+def collapse_trace(trace, prefix=()):
+    """Collapse a trace into one line per contribution, like collapsed stacks
+
+    Yields:
+        (tuple, number): the names leading to a contribution, and its modifier
+    """
+    for contribution in trace.contributions:
+        stack = prefix + (contribution.name,)
+        yield stack, total_modifier(contribution.modifier)
+        for position, subtrace in enumerate(contribution.subtraces):
+            label = subtrace.label or "sub {0}".format(position + 1)
+            for line in collapse_trace(subtrace.trace, stack + (label,)):
+                yield line
+
+
+def top_contributors(trace, count=DEFAULT_TOP_COUNT):
+    """Find the contributions with the largest modifiers, at any depth
+
+    Args:
+        trace (LevelTrace)
+        count (int): the number of contributions to find, or None for all
+
+    Yields:
+        list: (tuple, number) as given by collapse_trace, largest first
+    """
+    lines = [
+        (stack, modifier) for stack, modifier in collapse_trace(trace)
+        if modifier
+    ]
+    lines.sort(key=lambda line: (-abs(line[1]), line[0]))
+    return lines if count is None else lines[:count]
+
+
+def format_top_contributors(trace, count=DEFAULT_TOP_COUNT):
+    lines = ["{0}: {1}".format(trace.name, trace.level)]
+    for stack, modifier in top_contributors(trace, count):
+        lines.append("{0:>8} {1}".format(modifier, ' > '.join(stack)))
+    return '\n'.join(lines)
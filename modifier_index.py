@@ -0,0 +1,110 @@
+"""A flat, path-keyed index over the nested tables in modifiers.yaml
+
+Both spell engines look up modifiers by walking nested dicts, like
+modifiers['duration']['nonpersonal buff']['short']. The ModifierIndex
+compiles those nested dicts once into a single flat table keyed by the
+whole path, so that every lookup is a single dict access.
+"""
+
+
+def flatten_modifiers(modifiers, prefix=()):
+    """Yield a (path, value) pair for every leaf of a nested modifiers dict
+
+    Args:
+        modifiers (dict)
+        prefix (tuple): path of the dict within the full modifiers dict
+
+    Yields:
+        (tuple, value)
+    """
+    for key, value in modifiers.iteritems():
+        path = prefix + (key,)
+        if isinstance(value, dict):
+            for leaf in flatten_modifiers(value, path):
+                yield leaf
+        else:
+            yield path, value
+
+
+def modifier_path(*parts):
+    """Convert a modifier reference into a flat modifier path
+
+    The last part may be a nested reference in the form used by the yaml
+    files, such as {'immune': 'fear'}, which is expanded into its keys.
+
+    Args:
+        *parts: keys, with an optional nested reference as the last part
+
+    Yields:
+        tuple
+    """
+    path = parts[:-1]
+    thing = parts[-1]
+    while isinstance(thing, dict):
+        if len(thing) != 1:
+            raise Exception(
+                "Can't get modifier for dict that has more than one key: {0}".format(thing)
+            )
+        key, thing = thing.items()[0]
+        path += (key,)
+    return path + (thing,)
+
+
+class ModifierIndex(dict):
+    """The nested modifiers dict plus a precompiled flat lookup table
+
+    A ModifierIndex can still be used like the nested dict it was built from,
+    but leaf values should be retrieved with lookup(), which reads them from
+    a table keyed by the full path, such as
+    ('duration', 'nonpersonal buff', 'short').
+    """
+
+    def __init__(self, modifiers):
+        dict.__init__(self, modifiers)
+        self.table = dict(flatten_modifiers(modifiers))
+
+    def lookup(self, *path):
+        """Get the modifier at the given path
+
+        Args:
+            *path: keys leading to a leaf of the modifiers dict
+
+        Yields:
+            number
+
+        Raises:
+            KeyError: if there is no leaf at the given path
+        """
+        return self.table[path]
+
+    def contains(self, *path):
+        """Test whether there is a modifier at the given path
+
+        Args:
+            *path: keys leading to a leaf of the modifiers dict
+
+        Yields:
+            bool
+        """
+        return path in self.table
+
+
+class RecordingModifiers(object):
+    """Wraps a ModifierIndex to record every path that is looked up
+
+    This lets engines which don't track the modifiers they read find out
+    which modifiers a result depends on.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.table = index.table
+        self.paths = set()
+
+    def lookup(self, *path):
+        self.paths.add(path)
+        return self.index.lookup(*path)
+
+    def contains(self, *path):
+        self.paths.add(path)
+        return self.index.contains(*path)
@@ -0,0 +1,465 @@
+"""Compare the levels that the legacy and new engines give the same spells
+
+While spells are migrated from the legacy spellgenerator to the new spell
+engine, the two corpora describe most spells twice, in slightly different
+terms. The legacy engine writes 'personal only: true' where the new one
+writes 'range: personal', gives areas their own attributes such as
+'burst: medium radius', and splits triggers into three attributes. Each
+corpus resolves its own inheritance first, through 'base' in the legacy
+corpus and '$ref' in the new one, so spells are compared as they are leveled.
+
+This loads both corpora and both modifier tables once, levels the spells
+that both corpora contain with their own engine, and reports the spells
+whose levels disagree. The legacy attributes of each spell are translated
+into new properties, so the report can say whether the two definitions of
+a spell are still the same, and the breakdowns of both engines are shown
+side by side under the names of the new properties.
+
+Both engines reuse the results that they stored in earlier runs, so only
+the spells that changed since the last run are leveled again.
+"""
+
+from collections import namedtuple
+import copy
+import os
+import re
+import sys
+
+LEGACY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(1, LEGACY_DIRECTORY)
+from diagnostics import DiagnosticCollector
+from level_diff import attribute_change, parse_level
+from modifier_index import ModifierIndex
+from result_cache import module_source_hash, ResultCache
+from snapshot import load_yaml_snapshot
+import spellgenerator
+import spell_engine
+from spell_engine import (
+    cached_level_abilities, DEFAULT_PROPERTY_VALUES, Engine, import_yaml_file,
+    ModifierTable, PLURAL_KEY_MAPPINGS,
+)
+
+doc = """
+Usage:
+    engine_diff [<spell>...] [-j=<jobs> | --jobs=<jobs>] [--known=<file>] [--check] [--no-cache]
+    engine_diff (-h | --help)
+
+Options:
+    -j, --jobs=<jobs>  Number of processes to level new abilities with [default: 1]
+    --known=<file>     A report of disagreements that are already known, such
+                       as the output of an earlier run; they are only
+                       counted, unless either level changed since
+    --check            Exit with an error if the engines disagree about any
+                       spell that isn't known
+    --no-cache         Level every spell, instead of reusing the results of
+                       earlier runs of either engine
+    -h, --help         Show this screen and exit
+
+Only the given spells are compared, or every spell in both corpora. The
+legacy engine reads spells.yaml and modifiers.yaml from the parent
+directory, and the new engine reads them from the current directory.
+"""
+
+# maps the modifiers of the legacy engine to the new properties that they
+# correspond to; the legacy engine adds a modifier for each part of an
+# attack, and counts some properties as part of the modifiers of others
+LEGACY_MODIFIER_PROPERTIES = dict(
+    [(area_name, 'area') for area_name in spellgenerator.AREA_NAMES] + [
+        ('attack critical success', 'attack subeffects'),
+        ('attack effect', 'attack subeffects'),
+        ('attack failure', 'attack subeffects'),
+        ('attack success', 'attack subeffects'),
+        ('noncombat buff', 'noncombat'),
+        ('noncritical effect', 'attack subeffects'),
+        ('personal only', 'range'),
+        ('subeffect', 'subeffects'),
+        ('trigger condition', 'trigger'),
+        ('trigger duration', 'trigger'),
+        ('triggered', 'trigger'),
+    ]
+)
+
+# legacy attributes that together are the new 'trigger' property
+LEGACY_TRIGGER_ATTRIBUTES = ('triggered', 'trigger condition', 'trigger duration')
+
+# disagreements list the property names whose translated legacy values
+# differ from the new ones, and the (property name, legacy modifier, new
+# modifier) of every property whose modifier differs, largest change first
+Disagreement = namedtuple(
+    'Disagreement',
+    'name legacy_level new_level changed_properties attribution legacy_breakdown new_breakdown'
+)
+
+# matches the first line of a disagreement in a report
+DISAGREEMENT_PATTERN = re.compile(r'^disagree: (.+): (\S+) -> (\S+) \(')
+
+# the level and breakdown that one engine gave a spell; error is the reason
+# that it couldn't be leveled, and breakdown is only calculated by the
+# legacy engine for spells that disagree
+EngineResult = namedtuple('EngineResult', 'level breakdown error')
+
+
+def normalize_properties(properties):
+    """Write the properties of an ability in a single canonical form
+
+    Singular keys become lists, and properties that are missing, None or
+    equal to their default value are left out, so that properties which
+    level the same compare equal.
+
+    Args:
+        properties (dict): which are not modified
+
+    Yields:
+        dict
+    """
+    normalized = dict()
+    for property_name, value in properties.iteritems():
+        if property_name == 'skip validation':
+            continue
+        if property_name in PLURAL_KEY_MAPPINGS:
+            property_name = PLURAL_KEY_MAPPINGS[property_name]
+            value = [value]
+        if value is None or DEFAULT_PROPERTY_VALUES.get(property_name, None) == value:
+            continue
+        if property_name == 'subeffects':
+            value = [normalize_properties(subeffect) for subeffect in value]
+        elif property_name == 'attack subeffects':
+            value = dict(
+                (part, normalize_properties(subeffect) if isinstance(subeffect, dict) else subeffect)
+                for part, subeffect in value.iteritems()
+            )
+        elif isinstance(value, tuple):
+            value = list(value)
+        normalized[property_name] = value
+    return normalized
+
+
+def translate_legacy_attributes(attributes):
+    """Convert the attributes of a legacy spell into new properties
+
+    Args:
+        attributes (dict): resolved legacy attributes, which are not modified
+
+    Yields:
+        dict: normalized properties, like normalize_properties
+    """
+    properties = dict()
+    for attribute_name, attribute in attributes.iteritems():
+        if attribute_name in spellgenerator.PLURAL_MAPPINGS:
+            attribute_name = spellgenerator.PLURAL_MAPPINGS[attribute_name]
+            attribute = [attribute]
+        if attribute_name in ('ignore', 'personal only') + LEGACY_TRIGGER_ATTRIBUTES:
+            continue
+        elif attribute_name in spellgenerator.AREA_NAMES:
+            # 'burst: medium radius' is 'area: medium radius burst'
+            properties['area'] = "{0} {1}".format(attribute, attribute_name)
+        elif attribute_name == 'noncombat buff':
+            properties['noncombat'] = attribute
+        elif attribute_name == 'subeffects':
+            properties[attribute_name] = [
+                translate_legacy_attributes(subeffect) for subeffect in attribute
+            ]
+        elif attribute_name == 'attack subeffects':
+            properties[attribute_name] = dict(
+                (part, translate_legacy_attributes(subeffect))
+                for part, subeffect in attribute.iteritems()
+            )
+        else:
+            properties[attribute_name] = attribute
+    if attributes.get('personal only'):
+        properties['range'] = 'personal'
+    if attributes.get('triggered'):
+        properties['trigger'] = {
+            'condition': attributes.get('trigger condition'),
+            'duration': attributes.get('trigger duration'),
+        }
+    return normalize_properties(properties)
+
+
+def changed_properties(legacy_attributes, new_properties):
+    """Find the properties that the two definitions of a spell disagree about
+
+    Yields:
+        list: property names, sorted
+    """
+    legacy_properties = translate_legacy_attributes(legacy_attributes)
+    new_properties = normalize_properties(new_properties)
+    return sorted(
+        property_name
+        for property_name in set(legacy_properties) | set(new_properties)
+        if legacy_properties.get(property_name) != new_properties.get(property_name)
+    )
+
+
+def translate_legacy_breakdown(modifiers):
+    """Sum the modifiers of a legacy spell under the new properties they
+    correspond to
+
+    Args:
+        modifiers (dict): the modifiers of a leveled legacy Spell, which may
+            be lists of modifiers
+
+    Yields:
+        dict
+    """
+    breakdown = dict()
+    for modifier_name, modifier in modifiers.iteritems():
+        property_name = LEGACY_MODIFIER_PROPERTIES.get(modifier_name, modifier_name)
+        if isinstance(modifier, list):
+            modifier = sum(modifier)
+        breakdown[property_name] = breakdown.get(property_name, 0) + modifier
+    return breakdown
+
+
+def level_legacy_spell(spell_name, attributes, all_modifiers, cache=None, entry_hash=None):
+    """Level a legacy spell, without modifying its attributes
+
+    Args:
+        spell_name (str)
+        attributes (dict): resolved legacy attributes
+        all_modifiers (ModifierIndex)
+        cache (ResultCache): if given, the level is reused from an earlier
+            run, and the breakdown isn't calculated
+        entry_hash (str): the hash of the spell in the cache
+
+    Yields:
+        EngineResult: whose level is None if the spell is ignored
+    """
+    try:
+        if cache is None:
+            # subspells modify their nested attributes, which resolved
+            # spells share
+            spell = spellgenerator.Spell(
+                spell_name, copy.deepcopy(attributes), all_modifiers,
+                diagnostics=DiagnosticCollector(),
+            )
+            level = spell.calculate_level()
+            breakdown = translate_legacy_breakdown(spell.modifiers)
+        else:
+            level = spellgenerator.calculate_cached_level(
+                spell_name, attributes, all_modifiers, cache, entry_hash
+            )[0]
+            breakdown = None
+    except Exception as e:
+        return EngineResult(None, None, str(e))
+    # ignored spells have no level
+    return EngineResult(None if level == '' else level, breakdown, None)
+
+
+def nonzero_modifiers(breakdown):
+    return dict(
+        (property_name, modifier) for property_name, modifier in breakdown.items()
+        if modifier
+    )
+
+
+def read_known_disagreements(file_name):
+    """Read the disagreements from a report, ignoring everything else
+
+    Yields:
+        dict: maps spell names to (legacy level, new level)
+    """
+    known = dict()
+    with open(file_name, 'r') as report_file:
+        for line in report_file:
+            match = DISAGREEMENT_PATTERN.match(line)
+            if match:
+                known[match.group(1)] = (
+                    parse_level(match.group(2)), parse_level(match.group(3))
+                )
+    return known
+
+
+def record_to_result(record):
+    if record.errors:
+        return EngineResult(None, None, '; '.join(error.message() for error in record.errors))
+    return EngineResult(record.level, record.breakdown, None)
+
+
+class EngineDiff(object):
+    """The spells whose levels the legacy and new engines disagree about"""
+
+    def __init__(self, legacy_spells, new_abilities, legacy_results, new_results,
+                 legacy_breakdown, known=None):
+        """
+        Args:
+            legacy_spells (dict): maps spell names to resolved legacy attributes
+            new_abilities (dict): maps ability names to resolved new properties
+            legacy_results (dict): maps the names of the compared spells to
+                their legacy EngineResults
+            new_results (dict): maps the names of the compared spells to
+                their new EngineResults
+            legacy_breakdown (function): called with a spell name to get the
+                translated legacy breakdown of a spell that disagrees
+            known (dict): maps spell names to the (legacy level, new level)
+                of disagreements that are only counted, like
+                read_known_disagreements
+        """
+        known = known or dict()
+        self.disagreements = list()
+        self.errors = dict()
+        self.agreed_count = 0
+        self.known_count = 0
+        self.ignored_count = 0
+        for name in sorted(legacy_results):
+            legacy_result = legacy_results[name]
+            new_result = new_results[name]
+            if legacy_result.error is not None or new_result.error is not None:
+                self.errors[name] = (legacy_result.error, new_result.error)
+            elif legacy_result.level is None:
+                self.ignored_count += 1
+            elif legacy_result.level == new_result.level:
+                self.agreed_count += 1
+            elif known.get(name) == (legacy_result.level, new_result.level):
+                self.known_count += 1
+            else:
+                legacy_modifiers = legacy_result.breakdown
+                if legacy_modifiers is None:
+                    legacy_modifiers = legacy_breakdown(name)
+                # properties that add nothing to either level aren't shown
+                legacy_modifiers = nonzero_modifiers(legacy_modifiers)
+                new_modifiers = nonzero_modifiers(new_result.breakdown)
+                self.disagreements.append(Disagreement(
+                    name,
+                    legacy_result.level,
+                    new_result.level,
+                    changed_properties(legacy_spells[name], new_abilities[name]),
+                    attribute_change(legacy_modifiers, new_modifiers),
+                    legacy_modifiers,
+                    new_modifiers,
+                ))
+        self.legacy_only_count = len(set(legacy_spells) - set(new_abilities))
+        self.new_only_count = len(set(new_abilities) - set(legacy_spells))
+
+    def is_empty(self):
+        return not (self.disagreements or self.errors)
+
+    def report(self, stream):
+        def format_modifier(modifier):
+            return 'none' if modifier is None else modifier
+
+        for disagreement in self.disagreements:
+            if disagreement.changed_properties:
+                definitions = "properties differ: {0}".format(
+                    ', '.join(disagreement.changed_properties)
+                )
+            else:
+                definitions = "same properties"
+            stream.write("disagree: {0}: {1} -> {2} ({3})\n".format(
+                disagreement.name, disagreement.legacy_level,
+                disagreement.new_level, definitions,
+            ))
+            # the properties whose modifiers differ come first, then the
+            # ones that both engines agree about
+            for property_name, legacy_modifier, new_modifier in disagreement.attribution:
+                stream.write("    {0}: {1} -> {2}\n".format(
+                    property_name,
+                    format_modifier(legacy_modifier),
+                    format_modifier(new_modifier),
+                ))
+            for property_name, modifier in sorted(disagreement.new_breakdown.items()):
+                if disagreement.legacy_breakdown.get(property_name) == modifier:
+                    stream.write("    {0}: {1}\n".format(property_name, modifier))
+        for name, (legacy_error, new_error) in sorted(self.errors.items()):
+            if legacy_error is not None:
+                stream.write("error: {0}: legacy: {1}\n".format(name, legacy_error))
+            if new_error is not None:
+                stream.write("error: {0}: new: {1}\n".format(name, new_error))
+        stream.write("{0} disagree, {1} errors, {2} agree, {3} known disagreements, {4} ignored by legacy, {5} only in legacy, {6} only in new\n".format(
+            len(self.disagreements), len(self.errors), self.agreed_count,
+            self.known_count, self.ignored_count, self.legacy_only_count,
+            self.new_only_count,
+        ))
+
+
+def diff_engines(legacy_data_file_name, legacy_modifiers_file_name,
+                 new_data_file_name, new_modifiers_file_name,
+                 spell_names=None, jobs=1, use_cache=True, known=None):
+    """Level the spells that both corpora contain with both engines
+
+    Args:
+        legacy_data_file_name (str)
+        legacy_modifiers_file_name (str)
+        new_data_file_name (str)
+        new_modifiers_file_name (str)
+        spell_names (list): the spells to compare, or None for every spell
+            that both corpora contain
+        jobs (int): number of processes to level new abilities with
+        use_cache (bool): reuse the results of earlier runs of either engine
+        known (dict): disagreements that are only counted, like
+            read_known_disagreements
+
+    Yields:
+        EngineDiff
+    """
+    legacy_spells = load_yaml_snapshot(
+        legacy_data_file_name, spellgenerator.resolve_spells, 'resolved',
+        module_source_hash(*spellgenerator.RESOLVING_MODULES)
+    )
+    legacy_spells.pop('default spell', None)
+    all_modifiers = ModifierIndex(load_yaml_snapshot(legacy_modifiers_file_name))
+    new_abilities = import_yaml_file(new_data_file_name)
+    engine = Engine(ModifierTable(new_modifiers_file_name), jobs)
+
+    names = set(legacy_spells) & set(new_abilities)
+    if spell_names is not None:
+        for spell_name in spell_names:
+            if spell_name not in names:
+                raise Exception("Spell '{0}' isn't in both corpora".format(spell_name))
+        names = set(spell_names)
+
+    legacy_cache = new_cache = None
+    if use_cache:
+        legacy_cache = ResultCache.for_data_file(
+            legacy_data_file_name,
+            module_source_hash(*spellgenerator.LEVELING_MODULES),
+        )
+        new_cache = ResultCache.for_data_file(
+            new_data_file_name,
+            module_source_hash(*spell_engine.LEVELING_MODULES),
+        )
+    try:
+        legacy_results = dict()
+        for name in names:
+            entry_hash = None
+            if legacy_cache is not None:
+                entry_hash = legacy_cache.entry_hash(name, legacy_spells[name])
+            legacy_results[name] = level_legacy_spell(
+                name, legacy_spells[name], all_modifiers, legacy_cache, entry_hash
+            )
+        new_data = dict((name, new_abilities[name]) for name in names)
+        if new_cache is None:
+            records = engine.level_data(new_data)
+        else:
+            records = cached_level_abilities(new_data, engine, new_cache)
+        new_results = dict((record.name, record_to_result(record)) for record in records)
+    finally:
+        for cache in (legacy_cache, new_cache):
+            if cache is not None:
+                cache.close()
+
+    def legacy_breakdown(name):
+        return level_legacy_spell(name, legacy_spells[name], all_modifiers).breakdown
+
+    return EngineDiff(legacy_spells, new_abilities, legacy_results, new_results,
+                      legacy_breakdown, known)
+
+
+def main(args):
+    engine_diff = diff_engines(
+        os.path.join(LEGACY_DIRECTORY, 'spells.yaml'),
+        os.path.join(LEGACY_DIRECTORY, 'modifiers.yaml'),
+        'spells.yaml',
+        'modifiers.yaml',
+        args['<spell>'] or None,
+        int(args['--jobs']),
+        not args['--no-cache'],
+        read_known_disagreements(args['--known']) if args['--known'] else None,
+    )
+    engine_diff.report(sys.stdout)
+    if args['--check'] and not engine_diff.is_empty():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    from docopt import docopt
+    main(docopt(doc))
@@ -0,0 +1,121 @@
+"""Writers that stream ability levels to a file as they are calculated
+
+Every writer takes records with name, level, and breakdown attributes one
+at a time, so nothing needs to keep the levels of the whole corpus in
+memory. Output is buffered and flushed in batches, so consumers can start
+reading before the whole corpus has been leveled.
+"""
+
+import csv
+from contextlib import contextmanager
+import json
+import os
+
+
+@contextmanager
+def atomic_output(file_name):
+    """Write to a temporary file that replaces the given file on success
+
+    Readers of the file never see a partially written file, and the old file
+    is left untouched if writing fails.
+    """
+    temporary_file_name = "{0}.{1}.tmp".format(file_name, os.getpid())
+    output_file = open(temporary_file_name, 'w')
+    try:
+        yield output_file
+        output_file.close()
+        os.rename(temporary_file_name, file_name)
+    except:
+        output_file.close()
+        os.remove(temporary_file_name)
+        raise
+
+
+class LevelWriter(object):
+    """Write records to a stream in batches of formatted lines
+
+    Subclasses change the format of the lines by overriding format.
+    """
+
+    # number of records to collect before writing them to the stream
+    batch_size = 256
+
+    def __init__(self, stream, columns=None):
+        """
+        Args:
+            stream (file)
+            columns (list): names of the properties that may be in a
+                record's breakdown
+        """
+        self.stream = stream
+        self.columns = columns
+        self.lines = list()
+
+    def format(self, record):
+        return "{}: {}\n".format(record.name, record.level)
+
+    def write(self, record):
+        self.lines.append(self.format(record))
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+        self.flush()
+
+    def flush(self):
+        self.stream.writelines(self.lines)
+        self.stream.flush()
+        self.lines = list()
+
+
+class YamlLevelWriter(LevelWriter):
+    """Write one 'name: level' line per record, like levels.yaml, which is
+    the format of every LevelWriter"""
+
+
+class JsonLinesLevelWriter(LevelWriter):
+    """Write one json object per record, including its breakdown"""
+
+    def format(self, record):
+        return json.dumps({
+            'name': record.name,
+            'level': record.level,
+            'breakdown': record.breakdown,
+        }, sort_keys=True) + "\n"
+
+
+class _RowBuffer(object):
+    """Collects the lines formatted by a csv.writer"""
+
+    def __init__(self):
+        self.lines = list()
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+class CsvLevelWriter(LevelWriter):
+    """Write one row per record, with a column for each property"""
+
+    def __init__(self, stream, columns=None):
+        super(CsvLevelWriter, self).__init__(stream, columns)
+        self.rows = _RowBuffer()
+        self.csv_writer = csv.writer(self.rows, lineterminator='\n')
+        self.csv_writer.writerow(['name', 'level'] + list(self.columns))
+        self.lines.append(self.rows.lines.pop())
+
+    def format(self, record):
+        self.csv_writer.writerow(
+            [record.name, record.level]
+            + [record.breakdown.get(column, '') for column in self.columns]
+        )
+        return self.rows.lines.pop()
+
+
+LEVEL_WRITERS = {
+    'csv': CsvLevelWriter,
+    'jsonl': JsonLinesLevelWriter,
+    'yaml': YamlLevelWriter,
+}
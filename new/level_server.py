@@ -0,0 +1,366 @@
+"""Answer level queries over HTTP from a corpus that stays loaded
+
+Tools such as the spell editor and the wiki build level abilities thousands
+of times per session, and running the engine for each one pays for Python
+start-up, importing modules and parsing the yaml every time. The server
+loads the corpus and the modifiers once, levels every ability up front, and
+keeps the JSON response for each one ready to send.
+
+Everything that is derived from one version of the files lives in a
+LevelState, which is never modified after it is built, apart from caches
+that are only used under its lock. When the files change, a new state is
+built in the background and then replaces the old one in a single
+assignment, so each request sees either the old files or the new ones. A
+state that can't be built, such as from a file that is being saved, is
+reported and the old state is kept.
+
+Requests and responses are JSON:
+
+    GET  /status                   when the data was loaded, and how much
+    GET  /levels                   the level of every ability
+    GET  /abilities/<name>         the level, breakdown and warnings of an ability
+    GET  /abilities/<name>/explain?format=text|json|top
+    POST /level                    {"name": ..., "properties": {...}} levels
+                                   an ability that isn't in the corpus; it
+                                   may use '$ref' to extend one that is
+    POST /batch                    {"abilities": [name or {"name": ...,
+                                   "properties": ...}, ...]}
+"""
+
+import BaseHTTPServer
+import json
+import os
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from diagnostics import DiagnosticError
+from level_trace import trace_to_dict
+from spell_engine import (
+    Engine, EXPLANATION_FORMATTERS, import_yaml_file, inherit_ref,
+    ModifierTable, TracingAbility,
+)
+
+doc = """
+Usage:
+    level_server (items | spells) [--host=<host>] [--port=<port>] [--interval=<seconds>]
+    level_server (-h | --help)
+
+Options:
+    --host=<host>         Address to listen on [default: 127.0.0.1]
+    --port=<port>         Port to listen on [default: 8765]
+    --interval=<seconds>  Seconds to wait between checks for changed files [default: 1]
+    -h, --help            Show this screen and exit
+"""
+
+# the largest request body that is read, to protect the server from
+# clients that send more than they should
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+class RequestError(Exception):
+    """Raised for a request that can't be answered, with its HTTP status"""
+
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+def file_signature(file_name):
+    stat = os.stat(file_name)
+    return (stat.st_mtime, stat.st_size)
+
+
+def diagnostic_to_dict(diagnostic):
+    return {
+        'code': diagnostic.code,
+        'severity': diagnostic.severity,
+        'message': diagnostic.message(),
+    }
+
+
+def record_to_dict(record):
+    return {
+        'name': record.name,
+        'level': record.level,
+        'breakdown': record.breakdown,
+        'warnings': [diagnostic_to_dict(warning) for warning in record.warnings],
+        'errors': [diagnostic_to_dict(error) for error in record.errors],
+    }
+
+
+class LevelState(object):
+    """The corpus, modifiers and levels from one version of the files"""
+
+    def __init__(self, data_file_name, modifiers_file_name):
+        # the signatures are taken first, so a change made while the state
+        # is being built is noticed by the next check
+        self.signatures = (
+            file_signature(data_file_name),
+            file_signature(modifiers_file_name),
+        )
+        self.loaded_at = time.time()
+        self.data = import_yaml_file(data_file_name)
+        self.modifiers = ModifierTable(modifiers_file_name)
+        # load the modifiers now rather than in the first request
+        self.modifiers.index
+        self.engine = Engine(self.modifiers)
+
+        self.levels = dict()
+        self.responses = dict()
+        for record in self.engine.evaluate_many(self.data.iteritems()):
+            self.levels[record.name] = record.level
+            self.responses[record.name] = json.dumps(
+                record_to_dict(record), sort_keys=True
+            )
+        self.levels_response = json.dumps(self.levels, sort_keys=True)
+
+        # the subability cache of the modifiers isn't safe to share between
+        # threads, so anything that levels abilities holds this lock
+        self.lock = threading.Lock()
+        self.explanations = dict()
+
+    def resolve(self, ability_name, properties):
+        """Apply the '$ref' of an ability that isn't in the corpus"""
+        if not isinstance(properties, dict):
+            raise RequestError(400, "The properties of '{0}' must be an object".format(ability_name))
+        if '$ref' not in properties:
+            return properties
+        try:
+            parent = self.data[properties['$ref']]
+        except (KeyError, TypeError):
+            raise RequestError(400, "Unknown '$ref' {0!r} in '{1}'".format(
+                properties['$ref'], ability_name
+            ))
+        return inherit_ref(parent, properties)
+
+    def evaluate(self, ability_name, properties):
+        """Level an ability that isn't in the corpus
+
+        Yields:
+            dict: the response
+        """
+        properties = self.resolve(ability_name, properties)
+        with self.lock:
+            record = self.engine.evaluate(ability_name, properties)
+        return record_to_dict(record)
+
+    def explain(self, ability_name, explain_format):
+        """Explain the level of an ability in the corpus
+
+        Yields:
+            dict: the response
+        """
+        if explain_format not in EXPLANATION_FORMATTERS:
+            raise RequestError(400, "Unknown explanation format '{0}'".format(explain_format))
+        key = (ability_name, explain_format)
+        with self.lock:
+            if key not in self.explanations:
+                try:
+                    trace = TracingAbility(
+                        ability_name, self.data[ability_name], self.modifiers
+                    ).trace()
+                except DiagnosticError as e:
+                    raise RequestError(422, str(e))
+                if explain_format == 'json':
+                    explanation = trace_to_dict(trace)
+                else:
+                    explanation = EXPLANATION_FORMATTERS[explain_format](trace)
+                self.explanations[key] = {
+                    'name': ability_name,
+                    'format': explain_format,
+                    'explanation': explanation,
+                }
+            return self.explanations[key]
+
+
+class LevelService(object):
+    """Keeps an up to date LevelState of a data file and modifiers file"""
+
+    def __init__(self, data_file_name, modifiers_file_name='modifiers.yaml'):
+        self.data_file_name = data_file_name
+        self.modifiers_file_name = modifiers_file_name
+        self.state = LevelState(data_file_name, modifiers_file_name)
+        self.reload_count = 0
+        self.failed_signatures = None
+
+    def reload_if_changed(self):
+        """Replace the state if either file changed since it was built
+
+        Yields:
+            bool: whether the state was replaced
+        """
+        signatures = (
+            file_signature(self.data_file_name),
+            file_signature(self.modifiers_file_name),
+        )
+        if signatures in (self.state.signatures, self.failed_signatures):
+            return False
+        try:
+            state = LevelState(self.data_file_name, self.modifiers_file_name)
+        except Exception as e:
+            # keep answering from the old files until they are fixed
+            sys.stderr.write("Error: {0}\n".format(e))
+            self.failed_signatures = signatures
+            return False
+        self.state = state
+        self.reload_count += 1
+        self.failed_signatures = None
+        return True
+
+    def watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                sys.stderr.write("Error: {0}\n".format(e))
+
+    def status(self):
+        state = self.state
+        return {
+            'data file': self.data_file_name,
+            'modifiers file': self.modifiers_file_name,
+            'abilities': len(state.levels),
+            'loaded at': state.loaded_at,
+            'reloads': self.reload_count,
+        }
+
+
+class LevelRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keeping connections open and sending each response in a single
+    # packet is most of the latency of a cached response
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # clients make thousands of requests, which aren't worth logging
+        pass
+
+    def send_json(self, status, body):
+        """Send a response, which may be JSON text that is already encoded"""
+        if not isinstance(body, basestring):
+            body = json.dumps(body, sort_keys=True, default=repr)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise RequestError(400, "Invalid Content-Length")
+        if length > MAX_REQUEST_SIZE:
+            raise RequestError(413, "The request is too large")
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError as e:
+            raise RequestError(400, "Invalid JSON: {0}".format(e))
+
+    def handle_request(self, method):
+        try:
+            # each request uses one state, even if the files are reloaded
+            # while it is being answered
+            state = self.server.service.state
+            url = urlparse.urlparse(self.path)
+            status, body = method(state, url)
+        except RequestError as e:
+            status, body = e.status, {'error': str(e)}
+        except Exception as e:
+            status, body = 500, {'error': str(e)}
+        self.send_json(status, body)
+
+    def do_GET(self):
+        self.handle_request(self.get)
+
+    def do_POST(self):
+        self.handle_request(self.post)
+
+    def get(self, state, url):
+        if url.path == '/status':
+            return 200, self.server.service.status()
+        if url.path == '/levels':
+            return 200, state.levels_response
+        if url.path.startswith('/abilities/'):
+            ability_name = urllib.unquote(url.path[len('/abilities/'):])
+            explain = ability_name.endswith('/explain')
+            if explain:
+                ability_name = ability_name[:-len('/explain')]
+            if ability_name not in state.responses:
+                raise RequestError(404, "Unknown ability '{0}'".format(ability_name))
+            if explain:
+                query = urlparse.parse_qs(url.query)
+                return 200, state.explain(ability_name, query.get('format', ['text'])[0])
+            return 200, state.responses[ability_name]
+        raise RequestError(404, "Unknown path '{0}'".format(url.path))
+
+    def post(self, state, url):
+        if url.path == '/level':
+            request = self.read_json()
+            return 200, self.evaluate(state, request)
+        if url.path == '/batch':
+            request = self.read_json()
+            abilities = request.get('abilities') if isinstance(request, dict) else None
+            if not isinstance(abilities, list):
+                raise RequestError(400, "A batch needs a list of 'abilities'")
+            results = list()
+            for ability in abilities:
+                if isinstance(ability, basestring):
+                    if ability not in state.responses:
+                        raise RequestError(404, "Unknown ability '{0}'".format(ability))
+                    # cached responses are already encoded
+                    results.append(state.responses[ability])
+                else:
+                    results.append(json.dumps(self.evaluate(state, ability), sort_keys=True))
+            return 200, '{{"results": [{0}]}}'.format(', '.join(results))
+        raise RequestError(404, "Unknown path '{0}'".format(url.path))
+
+    def evaluate(self, state, request):
+        if not isinstance(request, dict) or 'properties' not in request:
+            raise RequestError(400, "An ability needs 'properties'")
+        return state.evaluate(request.get('name', 'ability'), request['properties'])
+
+
+class LevelServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, LevelRequestHandler)
+        self.service = service
+
+
+def main(args):
+    if args['items']:
+        data_file_name = 'magic_items.yaml'
+    elif args['spells']:
+        data_file_name = 'spells.yaml'
+    else:
+        raise Exception("I don't know what data to use")
+
+    service = LevelService(data_file_name)
+    watcher = threading.Thread(target=service.watch, args=(float(args['--interval']),))
+    watcher.daemon = True
+    watcher.start()
+
+    server = LevelServer((args['--host'], int(args['--port'])), service)
+    print "Serving {0} on http://{1}:{2}/".format(
+        data_file_name, *server.server_address
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    from docopt import docopt
+    main(docopt(doc))
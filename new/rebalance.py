@@ -0,0 +1,502 @@
+"""Level every ability against several candidate modifier tables at once
+
+Leveling the whole corpus once per candidate table repeats all of the
+parsing, validation and branching that doesn't depend on the table. Instead,
+each ability is compiled once into a plan: a linear combination of modifier
+table entries, plus the few special cases (such as the dispellable modifier)
+that aren't linear. The plans of the whole corpus are then evaluated against
+every candidate table together as numpy arrays.
+
+The same plans answer which abilities depend on each modifier, and how far
+a change of one in that modifier moves them.
+
+Candidate tables must contain every modifier that the base table does for
+the corpus; plans assume that the same entries exist, even if their values
+change.
+"""
+
+import csv
+import math
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from handler_registry import handles
+from modifier_index import ModifierIndex
+from spell_engine import (
+    Ability, import_yaml_file, load_yaml_file, ModifierTable,
+    register_modifier_handlers,
+)
+
+doc = """
+Usage:
+    rebalance (items | spells) <modifiers>... [--all] [--base=<modifiers>]
+    rebalance sensitivity (items | spells) [--all] [--base=<modifiers>]
+    rebalance (-h | --help)
+
+Options:
+    --all                Show every ability, not just ones whose level changes,
+                         or every modifier, not just ones that abilities use
+    --base=<modifiers>   The modifiers to compare against [default: modifiers.yaml]
+    -h, --help           Show this screen and exit
+"""
+
+
+class NonlinearTerm(object):
+    """A function of a linear expression, such as a threshold
+
+    Args:
+        function_name (str): a key of NONLINEAR_FUNCTIONS
+        argument (LinearExpression)
+    """
+    __slots__ = ('function_name', 'argument', '_key')
+
+    def __init__(self, function_name, argument):
+        self.function_name = function_name
+        self.argument = argument
+        self._key = (function_name, argument.key())
+
+    def __eq__(self, other):
+        return isinstance(other, NonlinearTerm) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.function_name, self.argument)
+
+
+class LinearExpression(object):
+    """A constant plus a weighted sum of terms
+
+    Terms are either modifier paths, which are looked up in the modifier
+    table, or NonlinearTerms.
+    """
+    __slots__ = ('terms', 'constant')
+
+    def __init__(self, terms=None, constant=0):
+        self.terms = terms or dict()
+        self.constant = constant
+
+    @classmethod
+    def of(cls, value):
+        if isinstance(value, LinearExpression):
+            return value
+        return cls(constant=value)
+
+    @classmethod
+    def nonlinear(cls, function_name, argument):
+        argument = cls.of(argument)
+        if not argument.terms:
+            # constant arguments can be evaluated right away
+            return NONLINEAR_FUNCTIONS[function_name](
+                np.array([argument.constant], dtype=float)
+            )[0]
+        return cls({NonlinearTerm(function_name, argument): 1})
+
+    def key(self):
+        return (frozenset(self.terms.items()), self.constant)
+
+    def scaled(self, factor):
+        return LinearExpression(
+            dict((term, coefficient * factor)
+                 for term, coefficient in self.terms.items()),
+            self.constant * factor
+        )
+
+    def __add__(self, other):
+        other = LinearExpression.of(other)
+        terms = dict(self.terms)
+        for term, coefficient in other.terms.items():
+            terms[term] = terms.get(term, 0) + coefficient
+        return LinearExpression(terms, self.constant + other.constant)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return self.scaled(-1)
+
+    def __sub__(self, other):
+        return self + -LinearExpression.of(other)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, factor):
+        return self.scaled(factor)
+
+    __rmul__ = __mul__
+
+    def __div__(self, divisor):
+        return self.scaled(1.0 / divisor)
+
+    __truediv__ = __div__
+
+    def __repr__(self):
+        return "LinearExpression({0!r}, {1!r})".format(self.terms, self.constant)
+
+
+def _dispellable(duration):
+    # see Ability._dispellable_modifier
+    return np.where(duration > 1, np.floor(duration / 4) + 1, 0)
+
+
+def _enemies_area(area):
+    # see Ability._targets_modifier
+    return np.where(area >= 5, 2, 1)
+
+
+def _negative_half(area):
+    # see Ability._targets_modifier, for knowledge abilities, whose area
+    # modifier was already halved into a float
+    return -area / 2.0
+
+
+def _negative_floor_half(area):
+    # see Ability._targets_modifier; python 2 floors the division of the
+    # integer area modifiers in the table
+    return np.floor(-area / 2)
+
+
+# vectorized versions of the calculations that aren't linear
+NONLINEAR_FUNCTIONS = {
+    'dispellable': _dispellable,
+    'enemies area': _enemies_area,
+    'negative floor half': _negative_floor_half,
+    'negative half': _negative_half,
+}
+
+
+@register_modifier_handlers
+class PlanAbility(Ability):
+    """An Ability whose modifiers are LinearExpressions of the table
+
+    Only the structure of the modifier table (which entries exist) is used,
+    so a plan is valid for any table with the same entries.
+    """
+    __slots__ = ()
+
+    def lookup_modifier(self, *path):
+        self.modifier_paths.add(path)
+        if not self.modifiers.contains(*path):
+            raise KeyError(path)
+        return LinearExpression({path: 1})
+
+    def validate(self):
+        # validation compares levels, which a plan doesn't have; abilities
+        # are validated when they are leveled normally
+        pass
+
+    @handles('dispellable')
+    def _dispellable_modifier(self):
+        if self.dispellable or self.duration is None:
+            return 0
+        return LinearExpression.nonlinear('dispellable', self.get_modifier('duration'))
+
+    @handles('targets')
+    def _targets_modifier(self):
+        if self.targets_type == 'area':
+            if self.targets == 'automatically find one':
+                # the area modifier is only an integer if it wasn't halved
+                if self.knowledge is not None:
+                    function_name = 'negative half'
+                else:
+                    function_name = 'negative floor half'
+                return LinearExpression.nonlinear(function_name, self.get_modifier('area'))
+            elif self.targets == 'enemies':
+                return LinearExpression.nonlinear('enemies area', self.get_modifier('area'))
+        return super(PlanAbility, self)._targets_modifier()
+
+
+def compile_plans(data, modifiers):
+    """Compile every ability into a LinearExpression of its spell level
+
+    Args:
+        data (dict): maps ability names to properties
+        modifiers (ModifierTable): the table whose entries the plans use
+
+    Yields:
+        dict: maps ability names to LinearExpressions
+    """
+    # plans must not share cached subabilities with normal abilities
+    plan_modifiers = ModifierTable(modifiers=modifiers.index)
+    return dict(
+        (ability_name, LinearExpression.of(
+            PlanAbility(ability_name, dict(properties), plan_modifiers).spell_level()
+        ))
+        for ability_name, properties in data.items()
+    )
+
+
+class PlanEvaluator(object):
+    """Evaluates a fixed set of plans against any number of tables"""
+
+    def __init__(self, plans):
+        """
+        Args:
+            plans (dict): maps ability names to LinearExpressions
+        """
+        self.names = sorted(plans.keys())
+        # every distinct term gets a column, with the terms that a
+        # nonlinear term depends on coming before it
+        self.columns = dict()
+        self.paths = list()
+        self.nonlinear_terms = list()
+        for name in self.names:
+            self._add_columns(plans[name])
+        self.paths_count = len(self.paths)
+        for index, term in enumerate(self.nonlinear_terms):
+            self.columns[term] = self.paths_count + index
+
+        self.constants = np.array(
+            [plans[name].constant for name in self.names], dtype=float
+        )
+        self.rows, self.column_indices, self.coefficients = self._coo_arrays(
+            [plans[name] for name in self.names]
+        )
+        self.nonlinear_arguments = [
+            (term.argument.constant, self._coo_arrays([term.argument]))
+            for term in self.nonlinear_terms
+        ]
+
+    def _add_columns(self, expression):
+        for term in expression.terms:
+            if term in self.columns:
+                continue
+            if isinstance(term, NonlinearTerm):
+                self._add_columns(term.argument)
+                # mark the term as seen; its index is assigned later
+                self.columns[term] = None
+                self.nonlinear_terms.append(term)
+            else:
+                self.columns[term] = len(self.paths)
+                self.paths.append(term)
+
+    def _coo_arrays(self, expressions):
+        rows = list()
+        column_indices = list()
+        coefficients = list()
+        for row, expression in enumerate(expressions):
+            for term, coefficient in expression.terms.items():
+                rows.append(row)
+                column_indices.append(self.columns[term])
+                coefficients.append(coefficient)
+        return (
+            np.array(rows, dtype=int),
+            np.array(column_indices, dtype=int),
+            np.array(coefficients, dtype=float),
+        )
+
+    def table_values(self, tables):
+        """Look up every path in every table
+
+        Args:
+            tables (list): ModifierIndexes
+
+        Yields:
+            numpy.ndarray: shape (paths, tables)
+        """
+        values = np.empty((self.paths_count, len(tables)), dtype=float)
+        for table_index, table in enumerate(tables):
+            for path_index, path in enumerate(self.paths):
+                try:
+                    values[path_index, table_index] = table.lookup(*path)
+                except KeyError:
+                    raise Exception("Modifier table {0} is missing {1}".format(
+                        table_index, path
+                    ))
+        return values
+
+    def dependencies(self):
+        """Find the paths that each ability's level depends on
+
+        This includes the paths used by nonlinear terms, such as the
+        duration that the dispellable modifier depends on.
+
+        Yields:
+            list: for each ability, the set of path indexes in self.paths
+        """
+        term_paths = list()
+        for index, term in enumerate(self.nonlinear_terms):
+            constant, (rows, column_indices, coefficients) = \
+                self.nonlinear_arguments[index]
+            term_paths.append(self._column_paths(column_indices, term_paths))
+
+        dependencies = [set() for name in self.names]
+        for row, column_index in zip(self.rows, self.column_indices):
+            dependencies[row].update(
+                self._column_paths([column_index], term_paths)
+            )
+        return dependencies
+
+    def _column_paths(self, column_indices, term_paths):
+        paths = set()
+        for column_index in column_indices:
+            if column_index < self.paths_count:
+                paths.add(column_index)
+            else:
+                paths.update(term_paths[column_index - self.paths_count])
+        return paths
+
+    def evaluate(self, tables):
+        """Calculate the level of every ability under every table
+
+        Args:
+            tables (list): ModifierIndexes
+
+        Yields:
+            numpy.ndarray: shape (abilities, tables), with rows in the
+                order of self.names
+        """
+        return self.evaluate_values(self.table_values(tables))
+
+    def evaluate_values(self, values):
+        """Calculate the level of every ability from the values of its paths
+
+        Args:
+            values (numpy.ndarray): shape (paths, tables), such as from
+                table_values()
+
+        Yields:
+            numpy.ndarray: shape (abilities, tables)
+        """
+        table_count = values.shape[1]
+        columns = np.empty(
+            (self.paths_count + len(self.nonlinear_terms), table_count),
+            dtype=float
+        )
+        columns[:self.paths_count] = values
+        # nonlinear terms only depend on earlier columns
+        for index, term in enumerate(self.nonlinear_terms):
+            constant, (rows, column_indices, coefficients) = \
+                self.nonlinear_arguments[index]
+            argument = constant + (
+                coefficients[:, np.newaxis] * columns[column_indices]
+            ).sum(axis=0)
+            columns[self.paths_count + index] = \
+                NONLINEAR_FUNCTIONS[term.function_name](argument)
+
+        levels = np.repeat(self.constants[:, np.newaxis], table_count, axis=1)
+        np.add.at(
+            levels,
+            self.rows,
+            self.coefficients[:, np.newaxis] * columns[self.column_indices]
+        )
+        return levels
+
+
+def modifier_sensitivity(evaluator, base_table, step=1, batch_size=64):
+    """Find how much each ability moves when each modifier changes by a step
+
+    Every modifier is moved up and down by the step in its own table, and
+    all of the tables are evaluated together in batches.
+
+    Args:
+        evaluator (PlanEvaluator)
+        base_table (ModifierIndex)
+        step (number)
+        batch_size (int): number of modifiers to evaluate together
+
+    Yields:
+        dict: maps each modifier path to a list of
+            (ability name, change when lowered, change when raised) for
+            every ability whose level depends on the modifier
+    """
+    base_values = evaluator.table_values([base_table])
+    base_levels = evaluator.evaluate_values(base_values)[:, 0]
+
+    dependents = dict((path_index, list()) for path_index in range(evaluator.paths_count))
+    for row, path_indexes in enumerate(evaluator.dependencies()):
+        for path_index in path_indexes:
+            dependents[path_index].append(row)
+
+    sensitivity = dict()
+    for start in range(0, evaluator.paths_count, batch_size):
+        path_indexes = range(start, min(start + batch_size, evaluator.paths_count))
+        # for the Nth path in the batch, table 2N lowers it by the step and
+        # table 2N + 1 raises it
+        values = np.repeat(base_values, 2 * len(path_indexes), axis=1)
+        for batch_index, path_index in enumerate(path_indexes):
+            values[path_index, 2 * batch_index] -= step
+            values[path_index, 2 * batch_index + 1] += step
+        changes = evaluator.evaluate_values(values) - base_levels[:, np.newaxis]
+
+        for batch_index, path_index in enumerate(path_indexes):
+            sensitivity[evaluator.paths[path_index]] = [
+                (
+                    evaluator.names[row],
+                    changes[row, 2 * batch_index],
+                    changes[row, 2 * batch_index + 1],
+                )
+                for row in dependents[path_index]
+            ]
+    return sensitivity
+
+
+def format_change(change):
+    return ('+' if change >= 0 else '') + format_level(change)
+
+
+def print_sensitivity(sensitivity, base_table, show_all=False):
+    paths = sorted(base_table.table) if show_all else sorted(sensitivity)
+    for path in paths:
+        changes = sensitivity.get(path, [])
+        print "{0} ({1} abilities)".format(' -> '.join(str(key) for key in path), len(changes))
+        for ability_name, lowered_change, raised_change in sorted(changes):
+            print "    {0}: {1} / {2}".format(
+                ability_name,
+                format_change(lowered_change),
+                format_change(raised_change),
+            )
+
+
+def format_level(level):
+    # match the levels written by spell_engine
+    if level == math.floor(level):
+        return str(int(level))
+    return str(level)
+
+
+def main(args):
+    if args['items']:
+        data_file_name = 'magic_items.yaml'
+    elif args['spells']:
+        data_file_name = 'spells.yaml'
+    else:
+        raise Exception("I don't know what data to use")
+
+    data = import_yaml_file(data_file_name)
+    base_modifiers = ModifierTable(args['--base'])
+    evaluator = PlanEvaluator(compile_plans(data, base_modifiers))
+
+    if args['sensitivity']:
+        print_sensitivity(
+            modifier_sensitivity(evaluator, base_modifiers.index),
+            base_modifiers.index,
+            args['--all'],
+        )
+        return
+
+    table_file_names = [args['--base']] + args['<modifiers>']
+    tables = [base_modifiers.index] + [
+        ModifierIndex(load_yaml_file(file_name))
+        for file_name in args['<modifiers>']
+    ]
+    levels = evaluator.evaluate(tables)
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['name'] + table_file_names)
+    for row, ability_name in enumerate(evaluator.names):
+        if args['--all'] or (levels[row] != levels[row, 0]).any():
+            writer.writerow(
+                [ability_name] + [format_level(level) for level in levels[row]]
+            )
+
+if __name__ == "__main__":
+    from docopt import docopt
+    main(docopt(doc))
@@ -0,0 +1,355 @@
+"""Find the property values that give an ability a target level
+
+Designers often know the level they want an ability to have, and want to
+know which ranges, areas, durations and targets would get it there. Trying
+every combination means leveling millions of abilities. Instead, since the
+level of an ability is the sum of the modifiers of its properties, each
+modifier is tabulated once as a function of only the varied properties it
+depends on, such as targets depending on area and range.
+
+A branch and bound search then assigns the varied properties one at a time.
+The smallest and largest values that each modifier can still take bound
+the level of every completion of a partial assignment, and assignments
+whose bounds miss the target are skipped along with all of their
+completions. Each combination that is found is leveled as a real Ability
+before it is returned, so validation still applies to every combination.
+"""
+
+from collections import namedtuple
+import heapq
+import itertools
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from diagnostics import DiagnosticError
+from spell_engine import (
+    Ability, DEFAULT_MODIFIER_TABLE, DEFAULT_PROPERTY_VALUES, import_yaml_file,
+    KNOWN_ABILITY_PROPERTIES, ModifierTable, REQUIRED_PROPERTIES,
+)
+
+doc = """
+Usage:
+    solver (items | spells) <ability> <level> [--vary=<property>...] [--top=<count>] [--within=<levels>]
+    solver (-h | --help)
+
+Options:
+    --vary=<property>    A property to find values for; may be repeated
+                         [default: range area duration targets]
+    --top=<count>        Only show this many combinations, preferring the
+                         ones that change the fewest properties
+    --within=<levels>    Also accept levels this far from the target [default: 0]
+    -h, --help           Show this screen and exit
+"""
+
+# maps properties to the other properties that their modifier depends on,
+# directly or through the modifiers of other properties
+PROPERTY_DEPENDENCIES = {
+    'area': ('knowledge',),
+    'dispellable': ('buffs', 'duration', 'knowledge', 'noncombat', 'range', 'trigger'),
+    'duration': ('buffs', 'knowledge', 'noncombat', 'range', 'trigger'),
+    'limit affected': ('buffs',),
+    'range': ('buffs',),
+    'targets': ('area', 'buffs', 'knowledge', 'range'),
+}
+
+# properties whose values don't come from a modifier table of their own
+BOOLEAN_PROPERTIES = ('dispellable', 'noncombat')
+
+# levels are sums of halves, so this only absorbs rounding errors
+EPSILON = 1e-9
+
+# changes maps property names to their new values, or None to remove them
+Solution = namedtuple('Solution', 'level changes')
+
+
+def candidate_values(property_name, index):
+    """Get every value of a property that the modifiers know about
+
+    Args:
+        property_name (str)
+        index (ModifierIndex)
+
+    Yields:
+        list: values, including None if the property can be left out
+    """
+    if property_name in BOOLEAN_PROPERTIES:
+        values = [False, True]
+    elif property_name == 'area':
+        area_types = [path[1] for path in index.table if path[0] == 'area type']
+        values = sorted(
+            "{0} {1} {2}".format(path[2], path[1], area_type)
+            for path in index.table if path[0] == 'area'
+            for area_type in area_types
+        )
+    else:
+        values = sorted(set(
+            path[-1] for path in index.table
+            if path[0] == property_name and len(path) > 1
+        ))
+    if not values:
+        raise Exception("Property '{0}' has no values to choose from".format(
+            property_name
+        ))
+    if (property_name not in REQUIRED_PROPERTIES
+            and property_name not in DEFAULT_PROPERTY_VALUES):
+        values.append(None)
+    return values
+
+
+class Factor(object):
+    """The modifier of one property, tabulated over the varied properties
+    that it depends on
+
+    Args:
+        property_name (str)
+        scope (tuple): the varied properties that the modifier depends on
+        values (dict): maps tuples of the values of the scope to modifiers;
+            combinations that the modifier can't be calculated for are left
+            out
+    """
+
+    def __init__(self, property_name, scope, values):
+        self.property_name = property_name
+        self.scope = scope
+        self.values = values
+
+    def prepare_bounds(self, order):
+        """Tabulate the range of the modifier after each step of a search
+
+        Args:
+            order (list): the varied properties in the order they are assigned
+        """
+        # the positions in the scope of the properties assigned after each
+        # step, and the bounds of the modifier for each of their values
+        self.assigned_positions = list()
+        self.bounds = list()
+        for depth in range(len(order) + 1):
+            positions = [
+                position for position, property_name in enumerate(self.scope)
+                if property_name in order[:depth]
+            ]
+            bounds = dict()
+            for key, value in self.values.items():
+                assigned_key = tuple(key[position] for position in positions)
+                low, high = bounds.get(assigned_key, (value, value))
+                bounds[assigned_key] = (min(low, value), max(high, value))
+            self.assigned_positions.append(positions)
+            self.bounds.append(bounds)
+
+    def bounds_after(self, depth, assignment):
+        """Get the (min, max) of the modifier, or None if it is impossible"""
+        return self.bounds[depth].get(tuple(
+            assignment[self.scope[position]]
+            for position in self.assigned_positions[depth]
+        ))
+
+
+class AbilitySolver(object):
+    """Finds the values of some properties that give an ability a level"""
+
+    def __init__(self, ability_name, properties, property_names, modifiers=None):
+        """
+        Args:
+            ability_name (str)
+            properties (dict): the properties of the ability to start from,
+                which must already be valid
+            property_names (list): the properties to find values for, which
+                must have single values such as 'medium radius burst'
+            modifiers (ModifierTable)
+        """
+        self.ability_name = ability_name
+        self.properties = dict(properties)
+        self.modifiers = modifiers or DEFAULT_MODIFIER_TABLE
+        for property_name in property_names:
+            if isinstance(self.properties.get(property_name), (dict, list)):
+                raise Exception("Can't find values for property '{0}', which has more than one value".format(
+                    property_name
+                ))
+        base_ability = Ability(ability_name, dict(properties), self.modifiers)
+        self.candidates = dict(
+            (property_name, candidate_values(property_name, self.modifiers.index))
+            for property_name in property_names
+        )
+
+        self.factors = list()
+        for property_name in KNOWN_ABILITY_PROPERTIES:
+            scope = tuple(
+                related_name for related_name in KNOWN_ABILITY_PROPERTIES
+                if related_name in self.candidates
+                and (related_name == property_name
+                     or related_name in PROPERTY_DEPENDENCIES.get(property_name, ()))
+            )
+            if scope:
+                self.factors.append(self._tabulate(property_name, scope))
+
+        # the part of the level that no varied property affects
+        breakdown = base_ability.breakdown()
+        self.constant = base_ability.spell_level() - sum(
+            breakdown.get(factor.property_name, 0) for factor in self.factors
+        )
+
+        # assigning the properties that the most modifiers depend on first
+        # lets the bounds tighten as early as possible
+        self.order = sorted(property_names, key=lambda property_name: (
+            -sum(1 for factor in self.factors if property_name in factor.scope),
+            -len(self.candidates[property_name]),
+            property_name,
+        ))
+        for factor in self.factors:
+            factor.prepare_bounds(self.order)
+
+    def changed_properties(self, changes):
+        properties = dict(self.properties)
+        for property_name, value in changes.items():
+            if value is None:
+                properties.pop(property_name, None)
+            else:
+                properties[property_name] = value
+        return properties
+
+    def level_with(self, changes):
+        """Get the level of the ability with some properties changed
+
+        Yields:
+            number: the level, or None if the changed ability is invalid
+        """
+        try:
+            return Ability(
+                self.ability_name, self.changed_properties(changes), self.modifiers
+            ).spell_level()
+        except (DiagnosticError, KeyError):
+            return None
+
+    def _tabulate(self, property_name, scope):
+        values = dict()
+        for key in itertools.product(*[
+                self.candidates[related_name] for related_name in scope]):
+            properties = self.changed_properties(dict(zip(scope, key)))
+            # only this property's modifier is calculated, so a failure
+            # means that this combination is impossible for it
+            properties['skip validation'] = True
+            try:
+                ability = Ability(self.ability_name, properties, self.modifiers)
+                if ability.get_property(property_name) is None:
+                    values[key] = 0
+                else:
+                    values[key] = ability.get_modifier(property_name)
+            except (DiagnosticError, KeyError):
+                pass
+        return Factor(property_name, scope, values)
+
+    def option_count(self):
+        """Count the combinations of the candidate values"""
+        count = 1
+        for values in self.candidates.values():
+            count *= len(values)
+        return count
+
+    def solutions(self, target, within=0):
+        """Find every combination that gives the ability a level near a target
+
+        Args:
+            target (number)
+            within (number): the largest accepted distance from the target
+
+        Yields:
+            Solution
+        """
+        low = target - within - EPSILON
+        high = target + within + EPSILON
+
+        def search(depth, assignment):
+            level_low = level_high = self.constant
+            for factor in self.factors:
+                bounds = factor.bounds_after(depth, assignment)
+                if bounds is None:
+                    return
+                level_low += bounds[0]
+                level_high += bounds[1]
+            if level_high < low or level_low > high:
+                return
+            if depth == len(self.order):
+                yield dict(assignment)
+                return
+            property_name = self.order[depth]
+            for value in self.candidates[property_name]:
+                assignment[property_name] = value
+                for changes in search(depth + 1, assignment):
+                    yield changes
+            del assignment[property_name]
+
+        for changes in search(0, dict()):
+            # make sure the combination is really valid and at the target
+            level = self.level_with(changes)
+            if level is not None and low <= level <= high:
+                yield Solution(level, changes)
+
+    def changed_count(self, solution):
+        """Count the properties that a solution changes from the ability"""
+        return sum(
+            1 for property_name, value in solution.changes.items()
+            if self.properties.get(property_name) != value
+        )
+
+    def best_solutions(self, target, within=0, count=None):
+        """Find the solutions that change the fewest properties
+
+        Args:
+            target (number)
+            within (number)
+            count (int): the number of solutions to find, or None for all
+
+        Yields:
+            list: Solutions
+        """
+        def key(solution):
+            return (
+                self.changed_count(solution),
+                abs(solution.level - target),
+                sorted(solution.changes.items()),
+            )
+        solutions = self.solutions(target, within)
+        if count is None:
+            return sorted(solutions, key=key)
+        return heapq.nsmallest(count, solutions, key=key)
+
+
+def format_solution(solution):
+    level = solution.level
+    # levels of whole numbers are written without a fraction, like in the
+    # levels files
+    if level == int(level):
+        level = int(level)
+    return "{0}: {1}".format(level, ', '.join(
+        "{0}: {1}".format(property_name, 'none' if value is None else value)
+        for property_name, value in sorted(solution.changes.items())
+    ))
+
+
+def main(args):
+    if args['items']:
+        data_file_name = 'magic_items.yaml'
+    elif args['spells']:
+        data_file_name = 'spells.yaml'
+    else:
+        raise Exception("I don't know what data to use")
+
+    data = import_yaml_file(data_file_name)
+    ability_name = args['<ability>']
+    try:
+        properties = data[ability_name]
+    except KeyError:
+        raise Exception("Unknown ability '{0}'".format(ability_name))
+
+    solver = AbilitySolver(
+        ability_name, properties, args['--vary'], ModifierTable('modifiers.yaml')
+    )
+    count = int(args['--top']) if args['--top'] else None
+    for solution in solver.best_solutions(
+            float(args['<level>']), float(args['--within']), count):
+        print format_solution(solution)
+
+if __name__ == "__main__":
+    from docopt import docopt
+    main(docopt(doc))
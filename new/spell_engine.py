@@ -1,18 +1,90 @@
-from docopt import docopt
-import yaml
+from collections import namedtuple, OrderedDict
+import heapq
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+# modules shared with the legacy spellgenerator live in the parent directory
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from diagnostics import (
+    Diagnostic, DiagnosticCollector, DiagnosticError, ERROR, is_suppressed, WARNING
+)
+from handler_registry import collect_handlers, handles
+from inheritance import InheritanceGraph
+from level_diff import changed_modifier_paths, diff_levels, EntryResult
+from level_output import atomic_output, LEVEL_WRITERS
+from level_trace import (
+    Contribution, format_json, format_top_contributors, LevelTrace, Subtrace,
+)
+from modifier_index import ModifierIndex, modifier_path
+from profiling import PROFILER
+from property_index import load_property_index, parse_query
+from result_cache import module_source_hash, ResultCache
+from snapshot import load_yaml_snapshot, parse_yaml
+from spell_query import CorpusIndex, level_filters, load_corpus_index
 
 doc = """
 Usage:
-    spell_engine items [-v | --verbose] [-t | --tofile] [-a=<ability> | --ability=<ability>]
-    spell_engine spells [-v | --verbose] [-t | --tofile] [-a=<ability> | --ability=<ability>]
+    spell_engine items [-v | --verbose] [-t | --tofile] [-a=<ability> | --ability=<ability>] [-j=<jobs> | --jobs=<jobs>] [-f=<format> | --format=<format>] [--profile] [--suppress=<rule>...] [--no-cache] [--explain=<format>]
+    spell_engine spells [-v | --verbose] [-t | --tofile] [-a=<ability> | --ability=<ability>] [-j=<jobs> | --jobs=<jobs>] [-f=<format> | --format=<format>] [--profile] [--suppress=<rule>...] [--no-cache] [--explain=<format>]
+    spell_engine watch (items | spells) [--interval=<seconds>]
+    spell_engine find (items | spells) <query>
+    spell_engine query (items | spells) [--level=<levels>] [--where=<filter>...] [--sort=<key>]
+    spell_engine diff (items | spells) [--levels=<file>] [--from=<revision>] [--to=<revision>] [--check]
     spell_engine (-h | --help)
 
 Options:
     -a, --ability=<ability>  Only show information for the given ability
+    --explain=<format>       Format of the verbose explanation of each level:
+                             text, json, or top, which shows the largest
+                             modifiers at any depth [default: text]
+    -f, --format=<format>    Format of the levels: yaml, jsonl, or csv [default: yaml]
     -h, --help               Show this screen and exit
+    -t, --tofile             Write the levels to a file named after the format
+    --interval=<seconds>     Seconds to wait between checks for changes [default: 1]
+    -j, --jobs=<jobs>        Number of processes to level abilities with [default: 1]
+    --level=<levels>         Only show abilities with levels such as 3-5, 3-, or 4
+    --where=<filter>         Only show abilities matching a filter such as
+                             'area >= medium radius' or 'duration: short'
+    --sort=<key>             Sort abilities by name or level [default: name]
+    --levels=<file>          The levels file to compare against; this is
+                             levels.yaml unless --from is given
+    --from=<revision>        The git revision of the data to compare against
+    --to=<revision>          The git revision of the data to compare, instead
+                             of the working tree
+    --check                  Exit with an error if any level changed
+    --profile                Report the time spent in each modifier to stderr;
+                             this always levels abilities in one process
+    --suppress=<rule>        Don't report warnings matching a rule such as
+                             'weak-success' or 'fireball:*'
+    --no-cache               Level every ability, instead of reusing the
+                             results of earlier runs whose inputs are the same
     -v, --verbose            Show more output
+
+A find query is a property, such as 'buffs', or a property and value, such
+as 'condition: dazed'. It matches abilities that use the property anywhere,
+including in their subeffects.
+
+Warnings are reported to stderr after every ability has been leveled.
+
+A diff lists the abilities that were added, removed or changed level, and
+the properties whose modifiers changed. Abilities whose properties and
+modifiers are the same as in the revision being compared against (HEAD by
+default) are not leveled again.
 """
 
+# the modules whose code affects levels; results that are kept between runs
+# are only reused if none of them changed
+LEVELING_MODULES = [__name__, 'diagnostics', 'handler_registry', 'inheritance', 'modifier_index']
+# the corpus index also depends on the code that builds it
+CORPUS_INDEX_MODULES = LEVELING_MODULES + ['property_index', 'spell_query']
+# the modules whose code resolves inheritance in the data files, which
+# snapshots of the resolved data depend on
+RESOLVING_MODULES = [__name__, 'inheritance']
+PROPERTY_INDEX_MODULES = RESOLVING_MODULES + ['property_index']
+
 # let's declare some things we know about the properties
 
 # this is the list of all valid property names
@@ -71,6 +143,30 @@ PLURAL_KEY_MAPPINGS = {
     'condition': 'conditions',
 }
 
+# maps diagnostic codes to their messages
+DIAGNOSTIC_TEMPLATES = {
+    'duration-without-purpose': "Ability('{name}') has duration with no purpose",
+    'incorrect-critical-success': "Ability('{name}') has critical success with incorrect level {0} instead of {1}",
+    'incorrect-failure': "Ability('{name}') has failure with incorrect level {0} instead of {1}",
+    'invalid-area': "Ability('{name}') has invalid area '{0}'",
+    'misplaced-property': "Ability('{name}') has property '{0}' that should only be in its subeffects",
+    'missing-duration': "Ability('{name}') is missing required property 'duration'",
+    'missing-modifier': "Ability('{name}') has no modifier for '{0}'",
+    'missing-primary-property': "Ability('{name}') must have a primary property",
+    'missing-property': "Ability('{name}') must have property '{0}'",
+    'multiple-primary-properties': "Ability('{name}') must have exactly one primary property",
+    'nonpositive-attack-subeffect': "Ability('{name}') has nonpositive attack subeffect '{0}' with level {1}",
+    'nonpositive-property': "Ability('{name}') has nonpositive property '{0}'",
+    'nonpositive-subeffect': "Ability('{name}') has nonpositive subeffect with level {0}",
+    'nonpositive-success': "Ability('{name}') has success with nonpositive level {0}",
+    'small-area-for-five': "Ability('{name}') has too small of an area for targets='five'",
+    'trivial-undispellable-duration': "Ability('{name}') is not dispellable, but has trivial duration {0}",
+    'unexpected-attack-subeffect': "Ability('{name}') has unexpected key '{0}' in attack_subeffects",
+    'unknown-duration-type': "Ability('{name}') could not determine duration_type",
+    'unknown-property': "Ability('{name}') has unknown property '{0}'",
+    'unrecognized-duration': "Ability('{name}') has unrecognized duration '{0}'",
+}
+
 # these properties have default values
 DEFAULT_PROPERTY_VALUES = {
     'casting time': 'standard',
@@ -82,27 +178,32 @@ DEFAULT_PROPERTY_VALUES = {
 }
 
 
+def load_yaml_file(file_name):
+    return load_yaml_snapshot(file_name)
+
+
+def inherit_ref(parent, thing):
+    new_thing = parent.copy()
+    new_thing.update(thing)
+    del new_thing['$ref']
+    return new_thing
+
+
+def resolve_refs(data):
+    """Handle $ref inheritance between the entries of a yaml file
+
+    Args:
+        data (dict): entries loaded from a yaml file, which are not modified
+
+    Yields:
+        dict
+    """
+    return InheritanceGraph(data, '$ref').resolve(inherit_ref)
+
+
 def import_yaml_file(file_name):
-    with open(file_name, 'r') as yaml_file:
-        data = yaml.load(yaml_file)
-
-        # handle $ref inheritance
-        for key in data:
-            if '$ref' in data[key]:
-                parent_name = data[key]['$ref']
-                try:
-                    parent = data[parent_name]
-                except KeyError:
-                    raise Exception(
-                        "Undefined $ref to parent '{0}'".format(parent_name)
-                    )
-                new_thing = parent.copy()
-                new_thing.update(data[key])
-                del new_thing['$ref']
-                data[key] = new_thing
-        return data
-# these modifiers are used in Ability
-RAW_MODIFIERS = import_yaml_file('modifiers.yaml')
+    return load_yaml_snapshot(file_name, resolve_refs, 'resolved',
+                              module_source_hash(*RESOLVING_MODULES))
 
 
 def is_close(x, y, threshold=1):
@@ -119,15 +220,221 @@ def is_close(x, y, threshold=1):
     return abs(x - y) <= threshold
 
 
-class Ability:
-    def __init__(self, name, properties):
-        self.name = name
+def freeze(value):
+    """Convert a value loaded from yaml into a canonical hashable form
+
+    Equal values always produce equal frozen forms, regardless of dict
+    ordering, so the frozen form can be used as a content-based cache key.
+
+    Args:
+        value: a dict, list, or scalar loaded from yaml
+
+    Yields:
+        hashable
+    """
+    if isinstance(value, dict):
+        return frozenset(
+            (key, freeze(subvalue)) for key, subvalue in value.iteritems()
+        )
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(subvalue) for subvalue in value)
+    else:
+        return value
+
+
+class LruCache(object):
+    """A bounded cache which evicts its least recently used entries"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return None
+        # reinsert the entry to mark it as the most recently used
+        self.entries[key] = value
+        return value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
 
-        # meta stuff to strip from properties before processing
-        self.skip_validation = properties.pop('skip validation', False)
+class ModifierTable(object):
+    """The modifiers used to level abilities
+
+    The modifiers file is only read the first time a modifier is needed, so
+    creating a ModifierTable is free. A single table can be shared by any
+    number of abilities.
+    """
+
+    def __init__(self, file_name=None, modifiers=None):
+        """
+        Args:
+            file_name (str): yaml file to load the modifiers from
+            modifiers (dict): already loaded modifiers to use instead of a file
+        """
+        self.file_name = file_name
+        if modifiers is not None:
+            self.index = ModifierIndex(modifiers)
+
+        # subabilities are shared by every ability which uses this table,
+        # since many abilities have identical subeffects
+        self.subability_cache = LruCache(max_size=4096)
+        # abilities keep the modifier paths they read, and most of them read
+        # the same few paths, so each path is only stored once
+        self.paths = dict()
+
+    def __getattr__(self, name):
+        # this is only called if the modifiers haven't been loaded yet
+        if name == 'index':
+            self.index = ModifierIndex(import_yaml_file(self.file_name))
+            return self.index
+        raise AttributeError(name)
+
+    def lookup(self, *path):
+        return self.index.lookup(*path)
+
+    def contains(self, *path):
+        return self.index.contains(*path)
+
+
+# abilities use the modifiers next to this file unless they are given
+# a different ModifierTable
+DEFAULT_MODIFIER_TABLE = ModifierTable(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'modifiers.yaml'
+))
+
+
+# the level, breakdown, and diagnostics of an ability, from one evaluation
+# warnings and errors are lists of Diagnostics
+AbilityEvaluation = namedtuple('AbilityEvaluation', 'level breakdown warnings errors')
+
+
+def register_modifier_handlers(cls):
+    """Build the registry that maps property names to modifier methods
+
+    Every property with a handler is also given a fixed ordinal, which is
+    its position in the property tables of the class.
+    """
+    cls.modifier_handlers = collect_handlers(cls, 'modifier_handlers')
+
+    # properties inherited from base classes keep their ordinals
+    inherited_names = getattr(cls, 'property_names', ())
+    cls.property_names = inherited_names + tuple(sorted(
+        set(cls.modifier_handlers) - set(inherited_names)
+    ))
+    cls.property_ordinals = dict(
+        (property_name, ordinal)
+        for ordinal, property_name in enumerate(cls.property_names)
+    )
+    cls.property_attribute_names = tuple(
+        property_name.replace(' ', '_') for property_name in cls.property_names
+    )
+    # default values are shared by every ability instead of being copied
+    cls.property_defaults = tuple(
+        DEFAULT_PROPERTY_VALUES.get(property_name)
+        for property_name in cls.property_names
+    )
+    cls.default_property_mask = sum(
+        1 << cls.property_ordinals[property_name]
+        for property_name in DEFAULT_PROPERTY_VALUES
+    )
+    return cls
+
+
+@register_modifier_handlers
+class Ability(object):
+    # corpora can have hundreds of thousands of abilities, so each property
+    # is stored in its own slot rather than in per-instance dicts
+    __slots__ = [
+        'name',
+        'modifiers',
+        'skip_validation',
+        '_breakdown',
+        '_level',
+        '_modifiers',
+        '_attack_sublevels',
+        'modifier_paths',
+        'subabilities',
+        'warnings',
+        'errors',
+        '_collect_errors',
+        # bit N is set if the property with ordinal N is present
+        '_present_properties',
+        '_unknown_properties',
+        # derived properties
+        'area_size',
+        'area_shape',
+        'area_type',
+        'duration_type',
+        'limit_affected_type',
+        'targets_type',
+    ] + [
+        property_name.replace(' ', '_')
+        for property_name in KNOWN_ABILITY_PROPERTIES
+    ]
+
+    def __init__(self, name, properties, modifiers=None, collect_errors=False):
+        """
+        Args:
+            name (str)
+            properties (dict): which are not modified
+            modifiers (ModifierTable)
+            collect_errors (bool): record the errors of an invalid ability
+                in errors, for evaluate to return, instead of raising the
+                first one
+        """
+        self.name = name
+        if modifiers is None:
+            modifiers = DEFAULT_MODIFIER_TABLE
+        self.modifiers = modifiers
+        self._breakdown = None
+        self._level = None
+        # validation and leveling share the modifiers they calculate
+        self._modifiers = None
+        self._attack_sublevels = None
+
+        # track every modifier path this ability reads, so we know which
+        # abilities are affected by a change to the modifiers
+        self.modifier_paths = set()
+        # most abilities have no subabilities, warnings or errors, so these
+        # share an empty tuple until something is added to them
+        self.subabilities = ()
+        # warnings are collected as Diagnostics rather than printed, since
+        # abilities may be leveled in other processes
+        self.warnings = ()
+        self.errors = ()
+        self._collect_errors = collect_errors
+
+        # meta stuff to skip while processing properties, which are never
+        # modified, since callers and subabilities share them
+        # this is either true, to skip validation entirely, or a list of
+        # the diagnostic codes to suppress
+        self.skip_validation = properties.get('skip validation', False)
+
+        # start with the default values
+        for attribute_name, default_value in zip(self.property_attribute_names,
+                                                 self.property_defaults):
+            setattr(self, attribute_name, default_value)
+        present_properties = self.default_property_mask
+        self._unknown_properties = None
 
-        self.properties = dict()
         for property_name in properties:
+            if property_name == 'skip validation':
+                continue
             property_value = properties[property_name]
 
             # convert singular keys to plural keys
@@ -135,18 +442,33 @@ class Ability:
                 property_name = PLURAL_KEY_MAPPINGS[property_name]
                 property_value = [property_value]
 
-            # set the property
-            self.properties[property_name] = property_value
+            ordinal = self.property_ordinals.get(property_name)
+            if ordinal is None:
+                # validate rejects unknown properties
+                if self._unknown_properties is None:
+                    self._unknown_properties = dict()
+                self._unknown_properties[property_name] = property_value
+                continue
 
-        # set default values
-        for property_name in DEFAULT_PROPERTY_VALUES:
-            if (self.properties.get(property_name) is None
-                    or self.properties[property_name] == [None]):
-                self.properties[property_name] = \
-                    DEFAULT_PROPERTY_VALUES[property_name]
+            # missing values of properties with defaults use the default
+            if (self.property_defaults[ordinal] is not None
+                    and (property_value is None or property_value == [None])):
+                continue
 
-        self.generate_derived_properties()
-        self.validate()
+            # set the property
+            setattr(self, self.property_attribute_names[ordinal], property_value)
+            present_properties |= 1 << ordinal
+        self._present_properties = present_properties
+
+        try:
+            self.generate_derived_properties()
+            self.validate()
+        except DiagnosticError as e:
+            # an error that stops validation is collected after the errors
+            # that were found before it
+            if not collect_errors:
+                raise
+            self.add_error(e.diagnostic)
 
     def generate_derived_properties(self):
         # generate area_size, area_shape, and area_type
@@ -159,9 +481,7 @@ class Ability:
                 self.area_size, self.area_shape, self.area_type = \
                     self.area.split()
             except KeyError:
-                self.die("has invalid area '{0}'".format(
-                    self.area
-                ))
+                self.die('invalid-area', self.area)
 
         # generate duration_type
         if self.duration is None:
@@ -187,7 +507,7 @@ class Ability:
             elif self.has_subeffects:
                 self.duration_type = 'subeffect'
             else:
-                self.die("could not determine duration_type")
+                self.die('unknown-duration-type')
 
         # generate limit_affected_type
         if self.limit_affected is None:
@@ -204,6 +524,44 @@ class Ability:
         else:
             self.targets_type = 'normal'
 
+    def has_property(self, property_name):
+        ordinal = self.property_ordinals.get(property_name)
+        if ordinal is None:
+            return (self._unknown_properties is not None
+                    and property_name in self._unknown_properties)
+        return bool(self._present_properties >> ordinal & 1)
+
+    def get_property(self, property_name):
+        ordinal = self.property_ordinals.get(property_name)
+        if ordinal is None:
+            return (self._unknown_properties or {}).get(property_name)
+        return getattr(self, self.property_attribute_names[ordinal])
+
+    def property_items(self):
+        """Get the present properties, in ordinal order
+
+        Unknown properties come last, since they have no ordinal.
+
+        Yields:
+            list: (property name, value) tuples
+        """
+        items = list()
+        present_properties = self._present_properties
+        for ordinal, attribute_name in enumerate(self.property_attribute_names):
+            if present_properties >> ordinal & 1:
+                items.append((
+                    self.property_names[ordinal],
+                    getattr(self, attribute_name)
+                ))
+        if self._unknown_properties is not None:
+            items.extend(sorted(self._unknown_properties.items()))
+        return items
+
+    @property
+    def properties(self):
+        """The present properties, including defaults, as a new dict"""
+        return dict(self.property_items())
+
     def get_modifier(self, property_name):
         """Get the modifier for a given property name
 
@@ -213,10 +571,61 @@ class Ability:
         Yields:
             int
         """
-        modifier_function_name = "_{0}_modifier".format(
-            property_name.replace(' ', '_')
-        )
-        return getattr(self, modifier_function_name)()
+        modifiers = self._modifiers
+        if modifiers is None:
+            modifiers = self._modifiers = dict()
+        elif property_name in modifiers:
+            return modifiers[property_name]
+
+        try:
+            handler = self.modifier_handlers[property_name]
+        except KeyError:
+            self.die('unknown-property', property_name)
+        modifier = handler(self)
+        # the handler may have replaced the modifiers while calculating the
+        # modifiers of other properties
+        modifiers = self._modifiers
+        if modifiers is self._breakdown:
+            # the breakdown shares the modifiers, and must not change
+            modifiers = self._modifiers = dict(modifiers)
+        modifiers[property_name] = modifier
+        return modifier
+
+    def record_modifier_path(self, path):
+        self.modifier_paths.add(self.modifiers.paths.setdefault(path, path))
+
+    def record_subabilities(self, property_name, parts):
+        """Record the subabilities behind the modifier of a property
+
+        Only a TracingAbility keeps them.
+
+        Args:
+            property_name (str)
+            parts (list): (label, Ability) tuples
+        """
+        pass
+
+    def lookup_modifier(self, *path):
+        self.record_modifier_path(path)
+        try:
+            return self.modifiers.lookup(*path)
+        except KeyError:
+            self.die('missing-modifier', ': '.join(str(part) for part in path))
+
+    def has_modifier(self, *path):
+        self.record_modifier_path(path)
+        return self.modifiers.contains(*path)
+
+    def all_modifier_paths(self):
+        """Get the modifier paths read by this ability and its subabilities
+
+        Yields:
+            set
+        """
+        paths = set(self.modifier_paths)
+        for subability in self.subabilities:
+            paths.update(subability.all_modifier_paths())
+        return paths
 
     @property
     def has_subeffects(self):
@@ -224,33 +633,28 @@ class Ability:
                 or self.subeffects is not None)
 
     def validate(self):
-        if self.skip_validation:
+        if self.skip_validation is True:
             return
 
         # make sure there are no unrecognized properties
-        for property_name in self.properties:
-            if property_name not in KNOWN_ABILITY_PROPERTIES:
-                self.die("has unknown property '{0}'".format(
-                    property_name
-                ))
+        if self._unknown_properties is not None:
+            self.reject('unknown-property', min(self._unknown_properties))
 
         # make sure that all required properties are present
         for property_name in REQUIRED_PROPERTIES:
-            if property_name not in self.properties:
-                self.die("must have property '{0}'".format(
-                    property_name
-                ))
+            if not self.has_property(property_name):
+                self.reject('missing-property', property_name)
 
         # make sure the ability has exactly one primary property
         primary_property_count = 0
         for property_name in PRIMARY_PROPERTIES:
-            if property_name in self.properties:
+            if self.has_property(property_name):
                 primary_property_count += 1
                 break
         if not primary_property_count:
-            self.die("must have a primary property")
+            self.reject('missing-primary-property')
         if primary_property_count > 1:
-            self.die("must have exactly one primary property")
+            self.reject('multiple-primary-properties')
 
         # here we check a bunch of weird edge cases
 
@@ -258,25 +662,21 @@ class Ability:
         # of abilities with subeffects are not present there
         if self.has_subeffects:
             for property_name in ['duration', 'dispellable']:
-                if (property_name in self.properties
-                        and self.properties[property_name] != DEFAULT_PROPERTY_VALUES[property_name]):
-                    self.warn("has property '{0}' that should only be in its subeffects".format(property_name))
+                if (self.has_property(property_name)
+                        and self.get_property(property_name) != DEFAULT_PROPERTY_VALUES[property_name]):
+                    self.warn('misplaced-property', property_name)
 
         # make sure that modifiers which should be positive are
         for property_name in PRIMARY_PROPERTIES:
-            if (property_name in self.properties
+            if (self.has_property(property_name)
                     and self.get_modifier(property_name) <= 0):
-                self.warn("has nonpositive property '{0}'".format(
-                    property_name
-                ))
+                self.warn('nonpositive-property', property_name)
         # also check that each subability is individually positive
         if self.subeffects is not None:
             for subeffect_properties in self.subeffects:
                 subability = self.create_subability(subeffect_properties)
                 if subability.level() <= 0:
-                    self.warn("has nonpositive subeffect with level {}".format(
-                        subability.level()
-                    ))
+                    self.warn('nonpositive-subeffect', subability.level())
         # attack subeffects are also handled better below
         # this won't catch errors such as 'success' being < 3
         if self.attack_subeffects is not None:
@@ -285,10 +685,8 @@ class Ability:
                 if property_name in self.attack_subeffects:
                     subability = self.create_subability(self.attack_subeffects[property_name])
                     if subability.level() <= 0:
-                        self.warn("has nonpositive attack subeffect '{}' with level {}".format(
-                            property_name,
-                            subability.level()
-                        ))
+                        self.warn('nonpositive-attack-subeffect',
+                                  property_name, subability.level())
 
         # abilities with a duration must have something to apply
         # the duration to
@@ -298,27 +696,25 @@ class Ability:
                          or self.knowledge is not None)
         if (self.duration is not None
                 and not need_duration):
-            self.die("has duration with no purpose")
+            self.reject('duration-without-purpose')
 
         # abilities that need a duration must have a duration
         if (self.duration is None
                 and need_duration):
-            self.die("is missing required property 'duration'")
+            self.reject('missing-duration')
 
         # abilities with targets = 'five' should not have small areas
         if (self.targets == 'five'
                 and self.area is not None
-                and self._area_modifier() <= 2):
-            self.die("has too small of an area for targets='five'")
+                and self.get_modifier('area') <= 2):
+            self.reject('small-area-for-five')
 
         # make sure that attack_subeffects has no extraneous keys
         if self.attack_subeffects is not None:
             for key in self.attack_subeffects:
                 if key not in ['critical success', 'effect', 'failure',
                                'noncritical effect', 'success']:
-                    self.warn("has unexpected key '{0}' in attack_subeffects".format(
-                        key
-                    ))
+                    self.warn('unexpected-attack-subeffect', key)
 
         # make sure that all of the levels of subabilities within
         # attack_subeffects make sense
@@ -342,82 +738,148 @@ class Ability:
             )
             if ('success' in sublevels
                     and unmodified_success_modifier <= 0):
-                self.warn("has success with nonpositive level {0}".format(
-                    unmodified_success_modifier
-                ))
+                self.warn('nonpositive-success', unmodified_success_modifier)
 
             if ('failure' in sublevels
                     and not is_close(level_modifier - 3,
                                      sublevels['failure'])):
-                self.warn("has failure with incorrect level {0} instead of {1}".format(
-                    sublevels['failure'],
-                    level_modifier - 3,
-                ))
+                self.warn('incorrect-failure',
+                          sublevels['failure'], level_modifier - 3)
 
             if 'critical success' in sublevels and not is_close(
                     level_modifier + 9,
                     sublevels['critical success'],
             ):
-                self.warn("has critical success with incorrect level {0} instead of {1}".format(
-                    sublevels['critical success'],
-                    level_modifier + 9,
-                ))
+                self.warn('incorrect-critical-success',
+                          sublevels['critical success'], level_modifier + 9)
 
         # make sure that dispellable abilities have a reasonable duration
         if not self.dispellable and (self.duration is None
                                      or self.duration in ('round', 'concentration')):
-            self.die("is not dispellable, but has trivial duration {0}".format(self.duration))
+            self.reject('trivial-undispellable-duration', self.duration)
 
+    def diagnostic(self, code, severity, arguments):
+        return Diagnostic(code, severity, self.name,
+                          DIAGNOSTIC_TEMPLATES[code], arguments)
 
-    def die(self, message):
-        raise Exception("{0} {1} (properties: {2})".format(
-            self,
-            message,
-            self.properties
-        ))
+    def die(self, code, *arguments):
+        """Raise a DiagnosticError for a problem that prevents leveling
 
-    def warn(self, message):
-        print "Warning: {0} {1}".format(
-            self,
-            message
+        The properties are only formatted if the error is printed.
+        """
+        raise DiagnosticError(
+            self.diagnostic(code, ERROR, arguments),
+            self.properties,
+            "(properties: {0})",
         )
 
-    def level(self):
-        level = 0
+    def reject(self, code, *arguments):
+        """Die because the ability is invalid, unless the code is suppressed
+
+        Abilities that collect their errors record the error and carry on
+        validating instead.
+        """
+        if is_suppressed(code, self.skip_validation):
+            return
+        if self._collect_errors:
+            self.add_error(self.diagnostic(code, ERROR, arguments))
+        else:
+            self.die(code, *arguments)
+
+    def add_error(self, diagnostic):
+        if not self.errors:
+            self.errors = list()
+        self.errors.append(diagnostic)
 
-        # call all the calculation functions
+    def warn(self, code, *arguments):
+        if not is_suppressed(code, self.skip_validation):
+            if not self.warnings:
+                self.warnings = list()
+            self.warnings.append(self.diagnostic(code, WARNING, arguments))
 
-        for property_name in self.properties:
-            if self.properties[property_name] is not None:
-                level += self.get_modifier(property_name)
+    def all_warnings(self, name=None):
+        """Get the warnings of this ability and all of its subabilities
 
-        return level
+        Subabilities are shared between abilities, so their warnings are
+        attributed to the given name rather than the name they were created
+        with.
+
+        Args:
+            name (str): the name to report the warnings under
+
+        Yields:
+            list: Diagnostics, without duplicates
+        """
+        if name is None:
+            name = self.name
+        warnings = [
+            warning._replace(entry_name=name) for warning in self.warnings
+        ]
+        for subability in self.subabilities:
+            for warning in subability.all_warnings(name + '**subability'):
+                if warning not in warnings:
+                    warnings.append(warning)
+        return warnings
+
+    def breakdown(self):
+        """Get the modifier of every property that affects the level
+
+        Yields:
+            dict
+        """
+        # abilities never change after they are created, so the modifiers
+        # only need to be calculated once
+        if self._breakdown is None:
+            breakdown = dict()
+            # call all the calculation functions
+            for property_name, property_value in self.property_items():
+                if property_value is not None:
+                    breakdown[property_name] = self.get_modifier(property_name)
+            # the modifiers usually hold exactly the breakdown, and then
+            # they are shared instead of being stored twice
+            if (self._modifiers is not None
+                    and len(breakdown) == len(self._modifiers)):
+                breakdown = self._modifiers
+            self._breakdown = breakdown
+        return self._breakdown
+
+    def level(self):
+        if self._level is None:
+            breakdown = self.breakdown()
+            level = 0
+            for property_name, property_value in self.property_items():
+                if property_name in breakdown:
+                    level += breakdown[property_name]
+            self._level = level
+        return self._level
 
     def spell_level(self):
         return self.level() - 4
 
-    def explain_level(self):
-        print self
-        for property_name in self.properties:
-            # only print non-default properties
-            if not (property_name in DEFAULT_PROPERTY_VALUES
-                    and self.properties[property_name] == DEFAULT_PROPERTY_VALUES[property_name]):
-                print "    {0}: {1}".format(
-                    property_name,
-                    self.get_modifier(property_name),
-                )
-            # subeffects should be explained individually
-            if property_name == 'attack subeffects':
-                print "        {0}".format(
-                    self._calculate_attack_subability_levels()
+    def evaluate(self):
+        """Get the results of leveling and validating this ability together
+
+        Validation already calculated most of the modifiers, so this only
+        calculates the ones that validation didn't need. An ability that
+        collected validation errors isn't leveled, and its level and
+        breakdown are None.
+
+        Yields:
+            AbilityEvaluation
+        """
+        if not self.errors:
+            try:
+                return AbilityEvaluation(
+                    self.spell_level(),
+                    self.breakdown(),
+                    self.all_warnings(),
+                    [],
                 )
-            elif property_name == 'subeffects':
-                for subeffect_properties in self.subeffects:
-                    subability = self.create_subability(subeffect_properties)
-                    print "        sub: {0}".format(
-                        subability.level()
-                    )
-        print "total:", self.spell_level()
+            except DiagnosticError as e:
+                if not self._collect_errors:
+                    raise
+                self.add_error(e.diagnostic)
+        return AbilityEvaluation(None, None, self.all_warnings(), list(self.errors))
 
     def __str__(self):
         return "Ability('{0}')".format(self.name)
@@ -428,15 +890,30 @@ class Ability:
         Args:
             properties (dict)
 
+        Identical subabilities are only created and validated once, and then
+        shared through the subability cache of the ModifierTable.
+
         Yields:
             Ability
         """
-        return Ability(self.name + '**subability', properties)
-
+        # subabilities are instances of the same class as this ability
+        key = (self.__class__, freeze(properties))
+        subability = self.modifiers.subability_cache.get(key)
+        if subability is None:
+            subability = self.__class__(self.name + '**subability',
+                                        properties, self.modifiers)
+            self.modifiers.subability_cache.set(key, subability)
+        if not self.subabilities:
+            self.subabilities = [subability]
+        elif subability not in self.subabilities:
+            self.subabilities.append(subability)
+        return subability
+
+    @handles('area')
     def _area_modifier(self):
-        modifier = RAW_MODIFIERS['area'][self.area_shape][self.area_size]
+        modifier = self.lookup_modifier('area', self.area_shape, self.area_size)
 
-        modifier += RAW_MODIFIERS['area type'][self.area_type]
+        modifier += self.lookup_modifier('area type', self.area_type)
 
         # knowledge spells pay less for areas
         if self.knowledge is not None:
@@ -444,6 +921,7 @@ class Ability:
         else:
             return modifier
 
+    @handles('attack subeffects')
     def _attack_subeffects_modifier(self, show_warnings=True):
 
         # first, get the levels of all possible subabilities
@@ -463,20 +941,32 @@ class Ability:
 
         return level_modifier
 
+    @handles('battlefield effects')
     def _battlefield_effects_modifier(self):
         modifier = 0
 
         for effect in self.battlefield_effects:
-            try:
-                modifier += RAW_MODIFIERS['battlefield effects'][effect]
-            except KeyError:
-                modifier += RAW_MODIFIERS['conditions'][effect]
+            if self.has_modifier('battlefield effects', effect):
+                modifier += self.lookup_modifier('battlefield effects', effect)
+            else:
+                modifier += self.lookup_modifier('conditions', effect)
 
         return modifier
 
     def _calculate_attack_subability_levels(self):
+        """Get the levels of each part of the attack subeffects
+
+        The levels are calculated once and shared by validation, leveling
+        and explanations, so they must not be modified.
+
+        Yields:
+            dict
+        """
+        if self._attack_sublevels is not None:
+            return self._attack_sublevels
         sublevels = dict()
 
+        parts = list()
         for modifier_name in ['critical success', 'effect', 'failure',
                               'noncritical effect', 'success']:
             if modifier_name in self.attack_subeffects:
@@ -484,6 +974,8 @@ class Ability:
                     self.attack_subeffects[modifier_name]
                 )
                 sublevels[modifier_name] = subability.level()
+                parts.append((modifier_name, subability))
+        self.record_subabilities('attack subeffects', parts)
 
         # adjust the sublevels to include shared effects
         if 'effect' in sublevels:
@@ -500,205 +992,841 @@ class Ability:
             if 'failure' in sublevels:
                 sublevels['failure'] += sublevels['noncritical effect']
 
+        self._attack_sublevels = sublevels
         return sublevels
 
 
+    @handles('breakable')
     def _breakable_modifier(self):
-        return RAW_MODIFIERS['breakable'][self.breakable]
+        return self.lookup_modifier('breakable', self.breakable)
 
+    @handles('buffs')
     def _buffs_modifier(self):
         modifier = 0
 
         for buff in self.buffs:
-            try:
-                modifier += RAW_MODIFIERS['buffs'][buff]
-            except TypeError:
-                # the buff is a nested modifier
-                top_level_name = buff.keys()[0]
-                value = buff[top_level_name]
-                modifier += RAW_MODIFIERS['buffs'][top_level_name][value]
+            # the buff may be a nested modifier
+            modifier += self.lookup_modifier(*modifier_path('buffs', buff))
 
         return modifier
 
+    @handles('casting time')
     def _casting_time_modifier(self):
-        return RAW_MODIFIERS['casting time'][self.casting_time]
+        return self.lookup_modifier('casting time', self.casting_time)
 
+    @handles('conditions')
     def _conditions_modifier(self):
         modifier = 0
         for condition in self.conditions:
-            modifier += RAW_MODIFIERS['conditions'][condition]
+            modifier += self.lookup_modifier('conditions', condition)
         return modifier
 
+    @handles('choose effect')
     def _choose_effect_modifier(self):
-        return RAW_MODIFIERS['choose effect'][self.choose_effect]
+        return self.lookup_modifier('choose effect', self.choose_effect)
 
+    @handles('components')
     def _components_modifier(self):
-        return RAW_MODIFIERS['components'][self.components]
+        return self.lookup_modifier('components', self.components)
 
+    @handles('damage')
     def _damage_modifier(self):
-        try:
-            return RAW_MODIFIERS['damage'][self.damage]
-        except TypeError:
-            # the damage is a nested modifier
-            top_level_name = self.damage.keys()[0]
-            value = self.damage[top_level_name]
-            return RAW_MODIFIERS['damage'][top_level_name][value]
+        # the damage may be a nested modifier
+        return self.lookup_modifier(*modifier_path('damage', self.damage))
 
+    @handles('dispellable')
     def _dispellable_modifier(self):
         if self.dispellable:
             return 0
         # if the duration is effectively free, not being dispellable is useless
-        elif self.duration is None or self._duration_modifier() <= 1:
+        elif self.duration is None or self.get_modifier('duration') <= 1:
             return 0
         # for normal durations, being dispellable doesn't matter much
         else:
-            return int(self._duration_modifier() / 4) + 1
+            return int(self.get_modifier('duration') / 4) + 1
 
+    @handles('duration')
     def _duration_modifier(self):
         # if the duration only exists to be passed on to
         # subeffects, don't record a duration modifier here
         if self.duration_type == 'subeffect':
             return 0
         else:
-            try:
-                return RAW_MODIFIERS['duration'][self.duration_type][self.duration]
-            except KeyError:
-                self.die("has unrecognized duration '{}'".format(self.duration))
+            if not self.has_modifier('duration', self.duration_type, self.duration):
+                self.die('unrecognized-duration', self.duration)
+            return self.lookup_modifier('duration', self.duration_type, self.duration)
 
+    @handles('expended')
     def _expended_modifier(self):
-        return RAW_MODIFIERS['expended'][self.expended]
+        return self.lookup_modifier('expended', self.expended)
 
+    @handles('instant effect')
     def _instant_effect_modifier(self):
-        return RAW_MODIFIERS['instant effect'][self.instant_effect]
+        return self.lookup_modifier('instant effect', self.instant_effect)
 
+    @handles('knowledge')
     def _knowledge_modifier(self):
-        return RAW_MODIFIERS['knowledge'][self.knowledge]
+        return self.lookup_modifier('knowledge', self.knowledge)
 
+    @handles('limit affected')
     def _limit_affected_modifier(self):
-        modifiers = RAW_MODIFIERS['limit affected']
-        return modifiers[self.limit_affected_type][self.limit_affected]
+        return self.lookup_modifier('limit affected', self.limit_affected_type,
+                                self.limit_affected)
 
+    @handles('misc')
     def _misc_modifier(self):
         return self.misc
 
+    @handles('noncombat')
     def _noncombat_modifier(self):
         # being noncombat has no direct effect on an ability's level
         # but some other calculations use it
         return 0
 
+    @handles('range')
     def _range_modifier(self):
         if self.buffs is not None:
-            return RAW_MODIFIERS['range']['buff'][self.range]
+            return self.lookup_modifier('range', 'buff', self.range)
         else:
-            return RAW_MODIFIERS['range']['normal'][self.range]
+            return self.lookup_modifier('range', 'normal', self.range)
 
+    @handles('shapeable')
     def _shapeable_modifier(self):
-        return RAW_MODIFIERS['shapeable'][self.shapeable]
+        return self.lookup_modifier('shapeable', self.shapeable)
 
+    @handles('spell resistance')
     def _spell_resistance_modifier(self):
-        return RAW_MODIFIERS['spell resistance'][self.spell_resistance]
+        return self.lookup_modifier('spell resistance', self.spell_resistance)
 
+    @handles('subeffects')
     def _subeffects_modifier(self):
         modifier = 0
+        parts = list()
         for subeffect_properties in self.subeffects:
             subability = self.create_subability(subeffect_properties)
             modifier += subability.level()
+            parts.append((None, subability))
+        self.record_subabilities('subeffects', parts)
         return modifier
 
+    @handles('targets')
     def _targets_modifier(self):
         if self.targets == 'automatically find one':
             if self.targets_type == 'area':
                 # reduce the area cost by half
-                return - self._area_modifier() / 2
+                return - self.get_modifier('area') / 2
             else:
                 # double the range modifier
                 return self._range_modifier()
         elif self.targets == 'enemies' and self.targets_type == 'area':
             # 'enemies' matters more for larger areas
-            if self._area_modifier() >= 5:
+            if self.get_modifier('area') >= 5:
                 return 2
             else:
                 return 1
         else:
-            return RAW_MODIFIERS['targets'][self.targets_type][self.targets]
+            return self.lookup_modifier('targets', self.targets_type, self.targets)
 
+    @handles('teleport')
     def _teleport_modifier(self):
         modifier = 0
-        modifier += RAW_MODIFIERS['teleport']['range'][
-            self.teleport['range']
-        ]
-        modifier += RAW_MODIFIERS['teleport']['type'][
-            self.teleport['type']
-        ]
+        modifier += self.lookup_modifier('teleport', 'range', self.teleport['range'])
+        modifier += self.lookup_modifier('teleport', 'type', self.teleport['type'])
         return modifier
 
+    @handles('trigger')
     def _trigger_modifier(self):
         modifier = 0
-        modifier += RAW_MODIFIERS['trigger']['condition'][
-            self.trigger['condition']
-        ]
-        modifier += RAW_MODIFIERS['trigger']['duration'][
-            self.trigger['duration']
-        ]
+        modifier += self.lookup_modifier('trigger', 'condition', self.trigger['condition'])
+        modifier += self.lookup_modifier('trigger', 'duration', self.trigger['duration'])
         return modifier
 
 
-# here we do some witchcraft to automatically add properties to Ability
-# we do this because I'm too lazy to type all the @property boilerplate
-def create_ability_property(property_name):
-    def get_property(ability):
-        return ability.properties.get(property_name, None)
-    python_property_name = property_name.replace(' ', '_')
-    setattr(Ability, python_property_name, property(get_property))
-for property_name in KNOWN_ABILITY_PROPERTIES:
-    create_ability_property(property_name)
+# the hot paths reported by --profile
+PROFILER.instrument_registry(Ability.modifier_handlers, 'Ability')
+PROFILER.instrument(Ability, [
+    method_name for method_name in dir(Ability)
+    if method_name.startswith('_') and method_name.endswith('_modifier')
+] + [
+    '__init__',
+    'create_subability',
+    'has_modifier',
+    'lookup_modifier',
+    'validate',
+])
+
+
+class TracingAbility(Ability):
+    """An Ability that also records the paths and subabilities behind the
+    modifier of each property, so that its level can be explained
+
+    Plain abilities only record the modifier paths they read in total, since
+    most abilities are never explained.
+    """
+    __slots__ = [
+        'property_paths',
+        'property_subabilities',
+        '_current_property',
+    ]
+
+    def __init__(self, *args, **kwargs):
+        self.property_paths = dict()
+        self.property_subabilities = dict()
+        self._current_property = None
+        super(TracingAbility, self).__init__(*args, **kwargs)
+
+    def get_modifier(self, property_name):
+        # modifiers can depend on the modifiers of other properties
+        outer_property = self._current_property
+        self._current_property = property_name
+        try:
+            return super(TracingAbility, self).get_modifier(property_name)
+        finally:
+            self._current_property = outer_property
+
+    def record_modifier_path(self, path):
+        super(TracingAbility, self).record_modifier_path(path)
+        if self._current_property is not None:
+            paths = self.property_paths.get(self._current_property)
+            if paths is None:
+                paths = self.property_paths[self._current_property] = set()
+            paths.add(path)
+
+    def record_subabilities(self, property_name, parts):
+        self.property_subabilities[property_name] = parts
+
+    def trace(self):
+        """Record how the level of this ability was calculated
+
+        Leveling already calculated every modifier and subability, so this
+        only collects them.
+
+        Yields:
+            LevelTrace
+        """
+        breakdown = self.breakdown()
+        contributions = list()
+        for property_name, property_value in self.property_items():
+            subtraces = list()
+            for label, subability in self.property_subabilities.get(property_name, ()):
+                # parts of attacks contribute their shared effects too
+                if label is None:
+                    sublevel = subability.level()
+                else:
+                    sublevel = self._attack_sublevels[label]
+                subtraces.append(Subtrace(label, sublevel, subability.trace()))
+            contributions.append(Contribution(
+                property_name,
+                property_value,
+                breakdown.get(property_name),
+                frozenset(self.property_paths.get(property_name, ())),
+                subtraces,
+            ))
+        return LevelTrace(self.name, self.spell_level(), contributions)
+
+    def explain_level(self):
+        print format_explanation(self.trace())
+
+
+# the result of leveling a single ability; errors is a list of the
+# Diagnostics that prevented it from being leveled, in which case the level
+# and breakdown are None
+LevelRecord = namedtuple('LevelRecord', 'name level breakdown warnings modifier_paths errors')
+
+# the number of abilities sent to a worker process at a time
+DEFAULT_CHUNK_SIZE = 64
+
+
+def level_ability(ability_name, properties, modifiers=None):
+    """Level and validate an ability in a single pass
+
+    Unlike creating an Ability, this never raises for an invalid ability;
+    the reasons that it is invalid are returned as errors instead, including
+    an error that stopped validation or leveling partway. Other exceptions
+    are bugs in the engine, and are raised.
+
+    Args:
+        ability_name (str)
+        properties (dict): which are not modified
+        modifiers (ModifierTable)
+
+    Yields:
+        LevelRecord
+    """
+    with PROFILER.entry(ability_name):
+        ability = Ability(ability_name, properties, modifiers, collect_errors=True)
+        evaluation = ability.evaluate()
+        return LevelRecord(
+            ability_name,
+            evaluation.level,
+            evaluation.breakdown,
+            evaluation.warnings,
+            ability.all_modifier_paths(),
+            evaluation.errors,
+        )
+
+
+def evaluate_ability(ability_name, properties, modifiers=None):
+    """Level and validate an ability, like level_ability
+
+    Yields:
+        AbilityEvaluation
+    """
+    record = level_ability(ability_name, properties, modifiers)
+    return AbilityEvaluation(record.level, record.breakdown, record.warnings, record.errors)
 
 
-def calculate_ability_levels(data):
+def iter_chunks(items, chunk_size):
+    """Split an iterable into lists, without reading it all at once"""
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# each worker process loads its own copy of the modifiers once
+WORKER_MODIFIERS = None
+
+
+def _initialize_worker(modifiers):
+    global WORKER_MODIFIERS
+    WORKER_MODIFIERS = modifiers
+
+
+def _level_chunk(chunk):
+    return [
+        level_ability(ability_name, properties, WORKER_MODIFIERS)
+        for ability_name, properties in chunk
+    ]
+
+
+class Engine(object):
+    """Levels abilities with one ModifierTable
+
+    This is the entry point for anything that levels many abilities,
+    including the command line. The properties that are given are never
+    modified, and abilities that can't be leveled get records with errors
+    instead of raising.
+    """
+
+    def __init__(self, modifiers=None, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Args:
+            modifiers (ModifierTable)
+            jobs (int): number of processes to level abilities with
+            chunk_size (int): number of abilities sent to a process at a time
+        """
+        self.modifiers = modifiers or DEFAULT_MODIFIER_TABLE
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+
+    def evaluate(self, ability_name, properties):
+        """Level a single ability
+
+        Yields:
+            LevelRecord
+        """
+        return level_ability(ability_name, properties, self.modifiers)
+
+    def evaluate_many(self, abilities, jobs=None):
+        """Level many abilities, optionally with multiple processes
+
+        Records are generated as soon as they are calculated, and the
+        abilities are only read as they are needed.
+
+        Args:
+            abilities (iterable): (ability name, properties) tuples
+            jobs (int): number of processes to use instead of the engine's
+
+        Yields:
+            LevelRecord: one record per ability, in the order they were given
+        """
+        if jobs is None:
+            jobs = self.jobs
+        if jobs <= 1:
+            for ability_name, properties in abilities:
+                yield level_ability(ability_name, properties, self.modifiers)
+            return
+
+        pool = multiprocessing.Pool(
+            jobs,
+            initializer=_initialize_worker,
+            initargs=(self.modifiers,),
+        )
+        try:
+            # imap returns the chunks in order, so the merged results are the
+            # same as they would be with a single process
+            for chunk_records in pool.imap(_level_chunk, iter_chunks(abilities, self.chunk_size)):
+                for record in chunk_records:
+                    yield record
+        finally:
+            pool.terminate()
+
+    def level_data(self, data):
+        """Level every ability in the data
+
+        Args:
+            data (dict): maps ability names to properties
+
+        Yields:
+            LevelRecord: one record per ability, sorted by name
+        """
+        return self.evaluate_many(sorted(data.items()))
+
+
+def cached_level_abilities(data, engine, cache):
+    """Level every ability in the data, reusing results from a ResultCache
+
+    Only the abilities whose properties or modifiers changed since their
+    results were stored are leveled.
+
+    Args:
+        data (dict): maps ability names to properties
+        engine (Engine): levels the changed abilities
+        cache (ResultCache)
+
+    Yields:
+        LevelRecord: one record per ability, sorted by name
+    """
+    table = engine.modifiers.index.table
+    entry_hashes = dict()
+    cached_records = dict()
+    changed_data = dict()
+    for ability_name, properties in data.items():
+        entry_hashes[ability_name] = cache.entry_hash(ability_name, properties)
+        stored = cache.get(entry_hashes[ability_name], table)
+        if stored is None:
+            changed_data[ability_name] = properties
+        else:
+            cached_records[ability_name] = LevelRecord(*stored)
+
+    for record in heapq.merge(sorted(cached_records.values()),
+                              engine.level_data(changed_data)):
+        if record.name not in cached_records:
+            # records are stored as plain tuples, since the class of a
+            # record depends on whether this module was run as a script
+            cache.put(entry_hashes[record.name], record.modifier_paths, table, tuple(record))
+        yield record
+
+
+def collect_warnings(records, collector):
+    """Add the warnings of each record to a collector as it passes through
+
+    Like creating an Ability, this raises for the first ability that
+    couldn't be leveled.
+
+    Args:
+        records (iterable): LevelRecords
+        collector (DiagnosticCollector)
+    """
+    for record in records:
+        if record.errors:
+            raise DiagnosticError(record.errors[0])
+        collector.extend(record.warnings)
+        yield record
+
+
+def calculate_ability_levels(data, modifiers=None, jobs=1, collector=None):
+    """
+    Args:
+        collector (DiagnosticCollector): collects the warnings; if None,
+            they are reported to stderr at the end
+    """
+    report = collector is None
+    if report:
+        collector = DiagnosticCollector()
     ability_levels = dict()
-    for ability_name in data:
-        ability = Ability(ability_name, data[ability_name])
-        ability_levels[ability_name] = ability.spell_level()
+    records = Engine(modifiers, jobs).level_data(data)
+    for record in collect_warnings(records, collector):
+        ability_levels[record.name] = record.level
+    if report:
+        collector.report(sys.stderr)
     return ability_levels
 
 
-def explain_ability_levels(data):
+def format_explanation(trace):
+    """Format a LevelTrace of an ability as a text explanation"""
+    lines = ["Ability('{0}')".format(trace.name)]
+    for contribution in trace.contributions:
+        # only show non-default properties
+        if not (contribution.name in DEFAULT_PROPERTY_VALUES
+                and contribution.value == DEFAULT_PROPERTY_VALUES[contribution.name]):
+            lines.append("    {0}: {1}".format(contribution.name, contribution.modifier))
+        # subeffects are explained individually
+        if contribution.name == 'attack subeffects':
+            lines.append("        {0}".format(dict(
+                (subtrace.label, subtrace.level) for subtrace in contribution.subtraces
+            )))
+        else:
+            for subtrace in contribution.subtraces:
+                lines.append("        sub: {0}".format(subtrace.level))
+    lines.append("total: {0}".format(trace.level))
+    return '\n'.join(lines)
+
+
+# maps the formats of --explain to functions that format a LevelTrace
+EXPLANATION_FORMATTERS = {
+    'json': format_json,
+    'text': format_explanation,
+    'top': format_top_contributors,
+}
+
+
+def explain_ability_levels(data, modifiers=None, collector=None, explain_format='text'):
+    if collector is None:
+        collector = DiagnosticCollector()
+    try:
+        formatter = EXPLANATION_FORMATTERS[explain_format]
+    except KeyError:
+        raise Exception("Unknown explanation format '{0}'".format(explain_format))
+    # json explanations are written one per line, so warnings go to stderr
+    warning_stream = sys.stderr if explain_format == 'json' else sys.stdout
     for ability_name in data:
-        ability = Ability(ability_name, data[ability_name])
-        ability.explain_level()
+        with PROFILER.entry(ability_name):
+            ability = TracingAbility(ability_name, data[ability_name], modifiers)
+            # warnings are shown with the explanation they belong to
+            collector.extend(ability.all_warnings())
+            collector.report(warning_stream)
+            collector.take()
+            print formatter(ability.trace())
+
+
+def write_levels_file(file_name, ability_levels):
+    with atomic_output(file_name) as levels_file:
+        for ability_name in sorted(ability_levels.keys()):
+            levels_file.write("{}: {}\n".format(
+                ability_name,
+                ability_levels[ability_name]
+            ))
+
+
+def patch_levels_file(file_name, changed_levels, removed_names):
+    """Update the lines of a levels file for only the given abilities
+
+    Args:
+        file_name (str)
+        changed_levels (dict): new levels of added or changed abilities
+        removed_names (set): names of abilities to remove from the file
+    """
+    with open(file_name, 'r') as levels_file:
+        lines = levels_file.readlines()
+
+    entries = list()
+    for line in lines:
+        ability_name = line.rstrip('\n').rsplit(': ', 1)[0]
+        if ability_name in removed_names or ability_name in changed_levels:
+            continue
+        entries.append((ability_name, line.rstrip('\n') + '\n'))
+    for ability_name, level in changed_levels.items():
+        entries.append((ability_name, "{}: {}\n".format(ability_name, level)))
+    # the lines are sorted by name like write_levels_file writes them, even
+    # if the file was edited out of order
+    entries.sort(key=lambda entry: entry[0])
+
+    with atomic_output(file_name) as levels_file:
+        levels_file.writelines(line for ability_name, line in entries)
+
+
+class LevelWatcher(object):
+    """Keep the levels file up to date while the data files are edited
+
+    The parsed data and the levels of every ability stay in memory, so after
+    a change only the affected abilities are leveled again.
+    """
+
+    def __init__(self, data_file_name, levels_file_name,
+                 modifiers_file_name='modifiers.yaml'):
+        self.data_file_name = data_file_name
+        self.levels_file_name = levels_file_name
+        self.modifiers_file_name = modifiers_file_name
+
+        self.modifiers = ModifierTable(modifiers_file_name)
+        self.raw_data = dict()
+        self.data = dict()
+        self.ability_levels = dict()
+        # abilities which could not be leveled are retried after any change
+        self.failed_names = set()
+        self.modifier_paths = dict()
+        self.file_signatures = dict()
+
+    def file_changed(self, file_name):
+        stat = os.stat(file_name)
+        signature = (stat.st_mtime, stat.st_size)
+        if self.file_signatures.get(file_name) == signature:
+            return False
+        self.file_signatures[file_name] = signature
+        return True
+
+    def level_abilities(self, ability_names, report_changes=True):
+        """Level the given abilities and remember which modifiers they read
+
+        Abilities that can't be leveled any more lose their old level.
+
+        Yields:
+            tuple: (dict of the new levels of the abilities that changed
+                level, set of the names of the abilities that lost their level)
+        """
+        changed_levels = dict()
+        failed_names = set()
+        engine = Engine(self.modifiers)
+        for record in engine.evaluate_many(
+                (ability_name, self.data[ability_name])
+                for ability_name in sorted(ability_names)):
+            ability_name = record.name
+            level = record.level
+            if record.errors:
+                for error in record.errors:
+                    print "Error: {0}".format(error.message())
+                self.failed_names.add(ability_name)
+                self.modifier_paths.pop(ability_name, None)
+                if ability_name in self.ability_levels:
+                    if report_changes:
+                        print "{}: {} -> error".format(
+                            ability_name,
+                            self.ability_levels[ability_name]
+                        )
+                    del self.ability_levels[ability_name]
+                    failed_names.add(ability_name)
+                continue
+            if report_changes:
+                for warning in record.warnings:
+                    print warning
+            self.failed_names.discard(ability_name)
+            self.modifier_paths[ability_name] = record.modifier_paths
+            if self.ability_levels.get(ability_name) != level:
+                if report_changes:
+                    print "{}: {} -> {}".format(
+                        ability_name,
+                        self.ability_levels.get(ability_name),
+                        level
+                    )
+                self.ability_levels[ability_name] = level
+                changed_levels[ability_name] = level
+        return changed_levels, failed_names
+
+    def start(self):
+        self.file_changed(self.modifiers_file_name)
+        self.file_changed(self.data_file_name)
+        self.raw_data = load_yaml_file(self.data_file_name)
+        self.data = resolve_refs(self.raw_data)
+        self.level_abilities(self.data.keys(), report_changes=False)
+        write_levels_file(self.levels_file_name, self.ability_levels)
+
+    def update_modifiers(self):
+        # the new table also starts with an empty subability cache, since
+        # the cached subabilities were leveled with the old modifiers
+        new_modifiers = ModifierTable(self.modifiers_file_name)
+        changed_paths = changed_modifier_paths(
+            self.modifiers.index.table,
+            new_modifiers.index.table
+        )
+        self.modifiers = new_modifiers
+
+        return set(self.failed_names) | set(
+            ability_name for ability_name in self.modifier_paths
+            if not self.modifier_paths[ability_name].isdisjoint(changed_paths)
+        )
+
+    def update_data(self):
+        new_raw_data = load_yaml_file(self.data_file_name)
+        changed_names = set(
+            key for key in new_raw_data
+            if key not in self.raw_data
+            or freeze(new_raw_data[key]) != freeze(self.raw_data[key])
+        )
+        removed_names = set(self.raw_data) - set(new_raw_data)
+        graph = InheritanceGraph(new_raw_data, '$ref')
+        self.raw_data = new_raw_data
+        self.data = graph.resolve(inherit_ref)
+        for ability_name in removed_names:
+            self.ability_levels.pop(ability_name, None)
+            self.modifier_paths.pop(ability_name, None)
+            self.failed_names.discard(ability_name)
+
+        affected_names = graph.descendants(changed_names)
+        return (affected_names | self.failed_names), removed_names
+
+    def check(self):
+        """Level the abilities affected by any changes since the last check"""
+        affected_names = set()
+        removed_names = set()
+        if self.file_changed(self.modifiers_file_name):
+            affected_names |= self.update_modifiers()
+        if self.file_changed(self.data_file_name):
+            new_affected_names, removed_names = self.update_data()
+            affected_names |= new_affected_names
+
+        changed_levels, failed_names = self.level_abilities(affected_names)
+        if changed_levels or removed_names or failed_names:
+            patch_levels_file(self.levels_file_name, changed_levels,
+                              removed_names | failed_names)
+        for ability_name in sorted(removed_names):
+            print "{}: removed".format(ability_name)
+
+    def watch(self, interval):
+        self.start()
+        while True:
+            time.sleep(interval)
+            try:
+                self.check()
+            except Exception as e:
+                # keep watching so the file can be fixed
+                print "Error: {0}".format(e)
+
+
+def make_diff_evaluator(index):
+    """Get a function that evaluates abilities with the given modifiers
+
+    Args:
+        index (ModifierIndex)
+
+    Yields:
+        function: called with (ability name, properties) to get an
+            EntryResult
+    """
+    engine = Engine(ModifierTable(modifiers=index))
+
+    def evaluate(ability_name, properties):
+        record = engine.evaluate(ability_name, properties)
+        if record.errors:
+            return EntryResult(None, None, None, None, None, '; '.join(
+                error.message() for error in record.errors
+            ))
+        return EntryResult(None, None, record.level, record.breakdown,
+                           record.modifier_paths, None)
+    return evaluate
+
+
+def build_corpus_index(data_file_name, modifiers):
+    data = import_yaml_file(data_file_name)
+    levels = dict()
+    errors = dict()
+    for record in Engine(modifiers).level_data(data):
+        if record.errors:
+            # one invalid ability shouldn't stop queries about the others
+            errors[record.name] = '; '.join(error.message() for error in record.errors)
+        else:
+            levels[record.name] = record.level
+    return CorpusIndex(
+        load_property_index(data_file_name, resolve_refs,
+                            module_source_hash(*PROPERTY_INDEX_MODULES),
+                            PLURAL_KEY_MAPPINGS),
+        levels,
+        ['area'],
+        errors,
+    )
 
 
 def main(args):
     if args['items']:
-        data = import_yaml_file('magic_items.yaml')
+        data_file_name = 'magic_items.yaml'
     elif args['spells']:
-        data = import_yaml_file('spells.yaml')
+        data_file_name = 'spells.yaml'
     else:
         raise Exception("I don't know what data to use")
 
+    if args['watch']:
+        watcher = LevelWatcher(data_file_name, 'levels.yaml')
+        watcher.watch(float(args['--interval']))
+        return
+
+    if args['query']:
+        corpus_index = load_corpus_index(
+            data_file_name,
+            'modifiers.yaml',
+            lambda: build_corpus_index(data_file_name, ModifierTable('modifiers.yaml')),
+            module_source_hash(*CORPUS_INDEX_MODULES),
+        )
+        for ability_name, error in sorted(corpus_index.errors.items()):
+            sys.stderr.write("error: {0}: {1}\n".format(ability_name, error))
+        filters = args['--where']
+        if args['--level']:
+            filters = level_filters(args['--level']) + filters
+        for ability_name, level in corpus_index.select(filters, args['--sort']):
+            print "{}: {}".format(ability_name, level)
+        return
+
+    if args['diff']:
+        levels_file_name = args['--levels']
+        if levels_file_name is None and args['--from'] is None:
+            levels_file_name = 'levels.yaml'
+        level_diff = diff_levels(
+            data_file_name,
+            'modifiers.yaml',
+            lambda text: resolve_refs(parse_yaml(text)),
+            make_diff_evaluator,
+            module_source_hash(*LEVELING_MODULES),
+            args['--from'] or 'HEAD',
+            args['--to'],
+            levels_file_name,
+        )
+        level_diff.report(sys.stdout)
+        if args['--check'] and not level_diff.is_empty():
+            sys.exit(1)
+        return
+
+    if args['find']:
+        property_index = load_property_index(
+            data_file_name, resolve_refs,
+            module_source_hash(*PROPERTY_INDEX_MODULES), PLURAL_KEY_MAPPINGS
+        )
+        for ability_name in property_index.find(*parse_query(args['<query>'])):
+            print ability_name
+        return
+
+    data = import_yaml_file(data_file_name)
+    modifiers = ModifierTable('modifiers.yaml')
+
     if args['--ability']:
         data = {
             args['--ability']: data[args['--ability']]
         }
         args['--verbose'] = True
 
+    jobs = int(args['--jobs'])
+    if args['--profile']:
+        PROFILER.enable()
+        # the calls made in worker processes can't be recorded
+        jobs = 1
+
+    engine = Engine(modifiers, jobs)
+    collector = DiagnosticCollector(args['--suppress'])
+    cache = None
+    if not (args['--no-cache'] or args['--profile'] or args['--verbose']):
+        cache = ResultCache.for_data_file(data_file_name, module_source_hash(*LEVELING_MODULES))
+    try:
+        write_ability_levels(args, data, engine, collector, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+        collector.report(sys.stderr)
+        if args['--profile']:
+            PROFILER.report(sys.stderr)
+
+
+def write_ability_levels(args, data, engine, collector, cache=None):
     if args['--verbose']:
-        explain_ability_levels(data)
-    elif args['--tofile']:
-        with open('levels.yaml', 'w') as levels_file:
-            ability_levels = calculate_ability_levels(data)
-            for ability_name in sorted(ability_levels.keys()):
-                levels_file.write("{}: {}\n".format(
-                    ability_name,
-                    ability_levels[ability_name]
-                ))
+        explain_ability_levels(data, engine.modifiers, collector, args['--explain'])
+        return
+
+    output_format = args['--format']
+    try:
+        writer_class = LEVEL_WRITERS[output_format]
+    except KeyError:
+        raise Exception("Unknown format '{0}'".format(output_format))
+    if cache is None:
+        records = engine.level_data(data)
     else:
-        ability_levels = calculate_ability_levels(data)
-        for ability_name in sorted(ability_levels.keys()):
-            print "{}: {}".format(
-                ability_name,
-                ability_levels[ability_name]
-            )
+        records = cached_level_abilities(data, engine, cache)
+    records = collect_warnings(records, collector)
+    if args['--tofile']:
+        with atomic_output('levels.' + output_format) as levels_file:
+            writer_class(levels_file, KNOWN_ABILITY_PROPERTIES).write_all(records)
+    else:
+        writer_class(sys.stdout, KNOWN_ABILITY_PROPERTIES).write_all(records)
 
 if __name__ == "__main__":
+    from docopt import docopt
     main(docopt(doc))
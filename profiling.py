@@ -0,0 +1,206 @@
+"""Count calls and time spent in the hot paths of the spell engines
+
+Profiling works by replacing methods of the engine classes with wrappers
+that record each call, so nothing is wrapped unless profiling is enabled
+and the instrumentation costs nothing in normal runs. Calls are grouped by
+the top-level entry (usually a spell) that was being leveled when they
+happened, which makes it easy to find pathologically expensive entries.
+"""
+
+from functools import wraps
+import time
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_CONTEXT = _NullContext()
+
+
+class _EntryContext(object):
+    """Attributes the calls made inside it to a top-level entry"""
+
+    def __init__(self, profiler, entry_name):
+        self.profiler = profiler
+        self.entry_name = entry_name
+
+    def __enter__(self):
+        self.previous_entry_name = self.profiler.entry_name
+        self.profiler.entry_name = self.entry_name
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.entry_seconds[self.entry_name] = (
+            self.profiler.entry_seconds.get(self.entry_name, 0)
+            + time.time() - self.start_time
+        )
+        self.profiler.entry_name = self.previous_entry_name
+        return False
+
+
+class Profiler(object):
+    """Records the calls to instrumented methods while it is enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        self.entry_name = None
+        # maps entry names to {counter name: [calls, seconds]}
+        self.entry_stats = dict()
+        self.entry_seconds = dict()
+        self.targets = list()
+        self._restores = list()
+
+    def instrument(self, cls, method_names, prefix=None):
+        """Register methods to be wrapped whenever profiling is enabled
+
+        Args:
+            cls (class)
+            method_names (iterable): names of methods of the class
+            prefix (str): name of the counters for the methods, which is
+                the class name by default
+        """
+        self._add_target(
+            self._wrap_methods, cls, sorted(method_names), prefix or cls.__name__
+        )
+
+    def instrument_registry(self, registry, prefix):
+        """Register the handlers in a registry to be wrapped when enabled
+
+        Handlers called through a registry don't go through the methods of
+        their class, so they have to be wrapped where they are stored.
+
+        Args:
+            registry (dict): maps property names to handler functions
+            prefix (str): name of the counters for the handlers
+        """
+        self._add_target(self._wrap_registry, registry, prefix)
+
+    def _add_target(self, wrap, *args):
+        self.targets.append((wrap, args))
+        if self.enabled:
+            wrap(*args)
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        for wrap, args in self.targets:
+            wrap(*args)
+
+    def disable(self):
+        """Restore the original methods, keeping the recorded stats"""
+        for restore in reversed(self._restores):
+            restore()
+        self._restores = list()
+        self.enabled = False
+
+    def _wrap_methods(self, cls, method_names, prefix):
+        for method_name in method_names:
+            original = cls.__dict__.get(method_name)
+            if original is None:
+                # the method was inherited, so the wrapper is removed
+                self._restores.append(
+                    lambda cls=cls, name=method_name: delattr(cls, name)
+                )
+            else:
+                self._restores.append(
+                    lambda cls=cls, name=method_name, original=original:
+                        setattr(cls, name, original)
+                )
+            method = getattr(cls, method_name)
+            setattr(cls, method_name, self._timed(
+                getattr(method, '__func__', method),
+                "{0}.{1}".format(prefix, method_name),
+            ))
+
+    def _wrap_registry(self, registry, prefix):
+        self._restores.append(
+            lambda registry=registry, originals=dict(registry):
+                registry.update(originals)
+        )
+        for property_name, function in registry.items():
+            registry[property_name] = self._timed(
+                function,
+                "{0}.{1}".format(prefix, function.__name__),
+            )
+
+    def _timed(self, function, counter_name):
+        profiler = self
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.record(counter_name, time.time() - start_time)
+        return timed_function
+
+    def record(self, counter_name, seconds=0):
+        stats = self.entry_stats.setdefault(self.entry_name, dict())
+        counter = stats.setdefault(counter_name, [0, 0.0])
+        counter[0] += 1
+        counter[1] += seconds
+
+    def entry(self, entry_name):
+        """Get a context that attributes calls inside it to the given entry
+
+        Leveling loops can always use this, since it does nothing when
+        profiling is disabled.
+        """
+        if not self.enabled:
+            return NULL_CONTEXT
+        return _EntryContext(self, entry_name)
+
+    def totals(self):
+        """Combine the stats of every entry
+
+        Yields:
+            dict: maps counter names to [calls, seconds]
+        """
+        totals = dict()
+        for stats in self.entry_stats.values():
+            for counter_name, (calls, seconds) in stats.items():
+                total = totals.setdefault(counter_name, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+        return totals
+
+    def report(self, stream, entry_limit=10):
+        """Write a summary of the recorded stats
+
+        Times are cumulative, so the time of a method includes the time of
+        every instrumented method that it called.
+
+        Args:
+            stream (file)
+            entry_limit (int): number of the most expensive entries to show
+        """
+        def write_counters(stats, indent):
+            for counter_name, (calls, seconds) in sorted(
+                    stats.items(), key=lambda item: (-item[1][1], item[0])):
+                stream.write("{0}{1:<48} {2:>9} {3:>10.4f}s\n".format(
+                    indent, counter_name, calls, seconds
+                ))
+
+        stream.write("Profile: {0:<46} {1:>9} {2:>11}\n".format(
+            'all entries', 'calls', 'seconds'
+        ))
+        write_counters(self.totals(), '    ')
+
+        expensive_entries = sorted(
+            self.entry_seconds.items(),
+            key=lambda item: (-item[1], item[0])
+        )[:entry_limit]
+        for entry_name, seconds in expensive_entries:
+            stream.write("\n{0}: {1:.4f}s\n".format(entry_name, seconds))
+            write_counters(self.entry_stats.get(entry_name, {}), '    ')
+
+
+# the engines share one profiler, so a single flag turns profiling on
+PROFILER = Profiler()
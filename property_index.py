@@ -0,0 +1,136 @@
+"""Find the entries of a data file that use a property or property value
+
+Filtering the corpus by property used to mean building every spell and
+checking its attributes. A PropertyIndex is built once, when the data file
+is loaded, and maps every property name and value to the entries that use
+it anywhere, including inside nested subeffects. It is stored in a snapshot
+next to the data file, so it is only rebuilt when the file changes.
+"""
+
+from snapshot import load_yaml_snapshot, parse_yaml
+
+# properties whose values are effects with properties of their own
+NESTING_PROPERTIES = ('attack subeffects', 'subeffects')
+
+
+def property_values(value):
+    """Get the indexable values of a property
+
+    Lists are indexed by their elements, and dicts such as
+    {'bonuses': 'attack'} by their keys and by their own values.
+
+    Yields:
+        list
+    """
+    if isinstance(value, list):
+        values = list()
+        for element in value:
+            values.extend(property_values(element))
+        return values
+    elif isinstance(value, dict):
+        values = list()
+        for key, subvalue in value.items():
+            values.append(key)
+            values.extend(property_values(subvalue))
+        return values
+    elif value is None:
+        return []
+    else:
+        return [value]
+
+
+def nested_effects(property_name, value):
+    """Get the effects nested in the value of a nesting property"""
+    if property_name == 'subeffects':
+        return [effect for effect in value if isinstance(effect, dict)]
+    elif property_name == 'attack subeffects':
+        return [effect for effect in value.values() if isinstance(effect, dict)]
+    return []
+
+
+class PropertyIndex(object):
+    """Maps property names and values to the entries that use them"""
+
+    def __init__(self, entries, plural_mappings=None):
+        """
+        Args:
+            entries (dict): maps entry names to resolved properties
+            plural_mappings (dict): maps singular property names to the
+                plural names that they are indexed under
+        """
+        self.plural_mappings = plural_mappings or dict()
+        # maps property names to the names of entries with that property
+        self.names_by_property = dict()
+        # maps (property name, value) to the names of entries with that value
+        self.names_by_value = dict()
+        for entry_name, properties in entries.items():
+            self._add_effect(entry_name, properties)
+
+    def _add_effect(self, entry_name, properties):
+        for property_name, value in properties.items():
+            property_name = self.plural_mappings.get(property_name, property_name)
+            self.names_by_property.setdefault(property_name, set()).add(entry_name)
+            if property_name in NESTING_PROPERTIES:
+                for effect in nested_effects(property_name, value):
+                    self._add_effect(entry_name, effect)
+                continue
+            for indexed_value in property_values(value):
+                try:
+                    self.names_by_value.setdefault(
+                        (property_name, indexed_value), set()
+                    ).add(entry_name)
+                except TypeError:
+                    # values that can't be hashed can't be searched for
+                    pass
+
+    def find(self, property_name, value=None):
+        """Find the entries that use a property, or a value of a property
+
+        Args:
+            property_name (str)
+            value: a value of the property, or None to match any value
+
+        Yields:
+            list: sorted entry names
+        """
+        property_name = self.plural_mappings.get(property_name, property_name)
+        if value is None:
+            names = self.names_by_property.get(property_name, ())
+        else:
+            names = self.names_by_value.get((property_name, value), ())
+        return sorted(names)
+
+
+def parse_query(query):
+    """Parse a query such as 'conditions' or 'condition: dazed'
+
+    Values are parsed as yaml, like the values in the data files.
+
+    Yields:
+        tuple: (property name, value or None)
+    """
+    if ':' not in query:
+        return query.strip(), None
+    property_name, value = query.split(':', 1)
+    return property_name.strip(), parse_yaml(value.strip())
+
+
+def load_property_index(file_name, resolve, code_hash, plural_mappings=None):
+    """Load the PropertyIndex of a data file, using a snapshot if possible
+
+    Args:
+        file_name (str)
+        resolve (function): resolves the inheritance of the parsed data
+        code_hash (str): a hash of the code of resolve and of this module,
+            from result_cache.module_source_hash
+        plural_mappings (dict)
+
+    Yields:
+        PropertyIndex
+    """
+    return load_yaml_snapshot(
+        file_name,
+        lambda data: PropertyIndex(resolve(data), plural_mappings),
+        'property-index',
+        code_hash
+    )
@@ -0,0 +1,261 @@
+"""A persistent store of leveling results that survives between runs
+
+Most runs of the spell engines level a corpus in which almost nothing has
+changed since the last run. The ResultCache stores the result of leveling
+each entry in a SQLite file in the snapshot directory, keyed by a hash of
+the engine's source, the name of the entry and its resolved properties.
+Each result also remembers the modifier paths that the entry read and a
+hash of their values, and it is only reused while those values are the
+same, so editing a modifier only invalidates the entries that read it.
+
+The store is only an optimization. It is bounded to a number of entries,
+evicting the least recently used ones. A corrupt store is replaced, and a
+store that is locked by another run or unwritable is skipped, rather than
+either being treated as an error.
+"""
+
+import cPickle as pickle
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from snapshot import SNAPSHOT_DIRECTORY_NAME
+
+# increase this whenever the format of the stored results changes
+CACHE_VERSION = 1
+
+# the number of results to keep, which is enough for several corpora
+DEFAULT_MAX_ENTRIES = 20000
+
+# seconds to wait for another run to unlock the store before skipping it
+LOCK_TIMEOUT = 2.0
+
+
+def source_hash(*file_names):
+    """Hash the source of the modules that calculate the results
+
+    Args:
+        file_names (str): module files, which may be compiled .pyc files
+    """
+    digest = hashlib.sha1(str(CACHE_VERSION))
+    for file_name in file_names:
+        source_name = os.path.splitext(file_name)[0] + '.py'
+        with open(source_name, 'rb') as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def module_source_hash(*module_names):
+    """Hash the source of imported modules, like source_hash
+
+    Args:
+        module_names (str): names of modules that are already imported,
+            including '__main__' for a script
+    """
+    return source_hash(*[
+        sys.modules[module_name].__file__ for module_name in module_names
+    ])
+
+
+def modifiers_hash(paths, table):
+    """Hash the values of the given modifier paths
+
+    Paths that are missing from the table are hashed differently from
+    paths with a value of None, since abilities test whether some paths
+    exist.
+
+    Args:
+        paths (iterable): modifier paths
+        table (dict): maps modifier paths to values, like ModifierIndex.table
+    """
+    values = [
+        (path, True, table[path]) if path in table else (path, False)
+        for path in sorted(paths)
+    ]
+    return hashlib.sha1(repr(values)).hexdigest()
+
+
+def is_corrupt(error):
+    """Test whether an error from SQLite means that the store is corrupt
+
+    Operational errors, such as a store that is locked by another run or
+    can't be written, say nothing about the store itself.
+    """
+    return (isinstance(error, sqlite3.DatabaseError)
+            and not isinstance(error, sqlite3.OperationalError))
+
+
+class ResultCache(object):
+    """Results of leveling entries, stored in a SQLite file"""
+
+    def __init__(self, file_name, code_hash, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            file_name (str)
+            code_hash (str): a hash of the code that calculates the
+                results, from source_hash
+            max_entries (int)
+        """
+        self.file_name = file_name
+        self.code_hash = code_hash
+        self.max_entries = max_entries
+        self.hit_count = 0
+        self.miss_count = 0
+        self._used_keys = list()
+        self._new_rows = list()
+        self.connection = self._connect()
+
+    @classmethod
+    def for_data_file(cls, data_file_name, code_hash):
+        """Open the cache in the snapshot directory next to a data file"""
+        directory = os.path.join(
+            os.path.dirname(os.path.abspath(data_file_name)),
+            SNAPSHOT_DIRECTORY_NAME,
+        )
+        return cls(os.path.join(directory, 'results.sqlite'), code_hash)
+
+    def _connect(self):
+        for attempt in range(2):
+            try:
+                directory = os.path.dirname(self.file_name)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                connection = sqlite3.connect(self.file_name, timeout=LOCK_TIMEOUT)
+                connection.text_factory = str
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS results ("
+                    " entry_hash TEXT NOT NULL,"
+                    " modifiers_hash TEXT NOT NULL,"
+                    " paths BLOB NOT NULL,"
+                    " result BLOB NOT NULL,"
+                    " last_used INTEGER NOT NULL,"
+                    " PRIMARY KEY (entry_hash, modifiers_hash))"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+                )
+                connection.commit()
+                return connection
+            except OSError:
+                return None
+            except sqlite3.Error as e:
+                # a corrupt store is replaced with an empty one, once
+                if attempt > 0 or not is_corrupt(e):
+                    return None
+                self._remove_file()
+        return None
+
+    def _remove_file(self):
+        try:
+            os.remove(self.file_name)
+        except OSError:
+            pass
+
+    def _disable(self, error):
+        # results are recalculated for the rest of the run, and a corrupt
+        # store is removed so that the next run starts a new one
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except sqlite3.Error:
+                pass
+        self.connection = None
+        if is_corrupt(error):
+            self._remove_file()
+
+    def entry_hash(self, name, properties):
+        """Hash the inputs of an entry other than the modifiers"""
+        return hashlib.sha1("{0}\n{1}\n{2}".format(
+            self.code_hash,
+            name,
+            json.dumps(properties, sort_keys=True, default=repr),
+        )).hexdigest()
+
+    def get(self, entry_hash, table):
+        """Get the stored result of an entry, if the modifiers it read are
+        the same
+
+        Args:
+            entry_hash (str): from entry_hash
+            table (dict): the current modifiers, like ModifierIndex.table
+
+        Yields:
+            the stored result, or None
+        """
+        if self.connection is None:
+            return None
+        try:
+            rows = self.connection.execute(
+                "SELECT modifiers_hash, paths, result FROM results WHERE entry_hash = ?",
+                (entry_hash,),
+            ).fetchall()
+        except sqlite3.Error as e:
+            self._disable(e)
+            return None
+        for stored_modifiers_hash, paths, result in rows:
+            try:
+                if modifiers_hash(pickle.loads(str(paths)), table) == stored_modifiers_hash:
+                    result = pickle.loads(str(result))
+                    self._used_keys.append((entry_hash, stored_modifiers_hash))
+                    self.hit_count += 1
+                    return result
+            except Exception:
+                # an unreadable result is a miss, and is replaced when
+                # the entry's new result is stored
+                continue
+        self.miss_count += 1
+        return None
+
+    def put(self, entry_hash, paths, table, result):
+        """Store the result of an entry
+
+        The result is written when the cache is closed.
+
+        Args:
+            entry_hash (str)
+            paths (iterable): the modifier paths that the entry read
+            table (dict): the modifiers that the result was calculated with
+            result: any picklable value
+        """
+        if self.connection is None:
+            return
+        self._new_rows.append((
+            entry_hash,
+            modifiers_hash(paths, table),
+            sqlite3.Binary(pickle.dumps(set(paths), pickle.HIGHEST_PROTOCOL)),
+            sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL)),
+        ))
+
+    def close(self):
+        """Write new results, mark used ones, and evict the oldest results"""
+        if self.connection is None:
+            return
+        now = int(time.time())
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                    [row + (now,) for row in self._new_rows],
+                )
+                self.connection.executemany(
+                    "UPDATE results SET last_used = ? WHERE entry_hash = ? AND modifiers_hash = ?",
+                    [(now,) + key for key in self._used_keys],
+                )
+                entry_count = self.connection.execute(
+                    "SELECT COUNT(*) FROM results"
+                ).fetchone()[0]
+                if entry_count > self.max_entries:
+                    self.connection.execute(
+                        "DELETE FROM results WHERE rowid IN ("
+                        " SELECT rowid FROM results ORDER BY last_used LIMIT ?)",
+                        (entry_count - self.max_entries,),
+                    )
+            self.connection.close()
+        except sqlite3.Error as e:
+            self._disable(e)
+        self.connection = None
+        self._new_rows = list()
+        self._used_keys = list()
@@ -0,0 +1,165 @@
+"""On-disk snapshots of parsed yaml data files
+
+Parsing yaml is most of the startup time of both spell engines. Instead of
+parsing a data file on every run, we keep a pickled snapshot of the parsed
+(and optionally resolved) data next to it. Snapshots are keyed by a hash of
+the file contents, so any edit to the yaml file invalidates its snapshot.
+"""
+
+import cPickle as pickle
+import glob
+import hashlib
+import os
+
+SNAPSHOT_DIRECTORY_NAME = '.snapshots'
+
+# increase this whenever the way data is resolved changes, so that old
+# snapshots are ignored
+SNAPSHOT_VERSION = 1
+
+
+def parse_yaml(text):
+    # yaml is slow to import, and isn't needed if every snapshot is fresh
+    import yaml
+    # prefer the C-accelerated loader when libyaml is available
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    return yaml.load(text, Loader=SafeLoader)
+
+
+def snapshot_file_name(file_name, tag, digest):
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    return os.path.join(
+        directory,
+        SNAPSHOT_DIRECTORY_NAME,
+        "{0}.{1}.{2}.pickle".format(base_name, tag, digest)
+    )
+
+
+def read_snapshot(snapshot_name):
+    """Read a snapshot, or return None if it is missing or unreadable"""
+    try:
+        with open(snapshot_name, 'rb') as snapshot_file:
+            return pickle.load(snapshot_file)
+    except Exception:
+        # a corrupt snapshot is no worse than a missing one
+        return None
+
+
+def write_snapshot(snapshot_name, data):
+    """Atomically replace any older snapshots of the same file and tag"""
+    try:
+        directory = os.path.dirname(snapshot_name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary_name = "{0}.{1}.tmp".format(snapshot_name, os.getpid())
+        with open(temporary_name, 'wb') as snapshot_file:
+            pickle.dump(data, snapshot_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_name, snapshot_name)
+    except (IOError, OSError):
+        # snapshots are only an optimization, so failing to write one
+        # (for example in a read-only checkout) is not an error
+        return
+
+    stale_pattern = snapshot_name.rsplit('.', 2)[0] + '.*.pickle'
+    for stale_name in glob.glob(stale_pattern):
+        if stale_name != snapshot_name:
+            try:
+                os.remove(stale_name)
+            except OSError:
+                pass
+
+
+def load_yaml_snapshot(file_name, resolve=None, tag='raw', code_hash=None):
+    """Load a yaml file, using a snapshot of its parsed data if possible
+
+    Args:
+        file_name (str)
+        resolve (function): optionally transforms the parsed data before it
+            is stored in the snapshot, such as by resolving inheritance
+        tag (str): distinguishes snapshots of the same file that were made
+            with different resolve functions
+        code_hash (str): a hash of the code of resolve, from
+            result_cache.module_source_hash, so that editing it invalidates
+            the snapshot
+
+    Yields:
+        the parsed and resolved data
+    """
+    with open(file_name, 'rb') as yaml_file:
+        text = yaml_file.read()
+    digest = hashlib.sha1(text)
+    if code_hash is not None:
+        digest.update(code_hash)
+    snapshot_name = snapshot_file_name(
+        file_name,
+        "{0}-v{1}".format(tag, SNAPSHOT_VERSION),
+        digest.hexdigest()
+    )
+
+    data = read_snapshot(snapshot_name)
+    if data is None:
+        data = parse_yaml(text)
+        if resolve is not None:
+            data = resolve(data)
+        write_snapshot(snapshot_name, data)
+    return data
+
+
+def load_snapshot(file_names, build, tag, extra_texts=()):
+    """Load data derived from several files, using a snapshot if possible
+
+    The snapshot is stored next to the first file, and is keyed by a hash of
+    the contents of all of them, so editing any of the files invalidates it.
+
+    Args:
+        file_names (list)
+        build (function): called with no arguments to build the data if
+            there is no snapshot
+        tag (str): distinguishes the snapshots of different kinds of data
+        extra_texts (list): anything else that the data depends on, such
+            as a hash of the code that builds it
+
+    Yields:
+        the built data
+    """
+    texts = list()
+    for file_name in file_names:
+        with open(file_name, 'rb') as data_file:
+            texts.append(data_file.read())
+    texts.extend(extra_texts)
+    return load_content_snapshot(file_names[0], texts, build, tag)
+
+
+def load_content_snapshot(file_name, texts, build, tag):
+    """Load data derived from the given contents, using a snapshot if possible
+
+    This is for contents that aren't in files on disk, such as the contents
+    of files at an older git revision.
+
+    Args:
+        file_name (str): the snapshot is stored next to this file
+        texts (list): the contents that the data is derived from
+        build (function): called with no arguments to build the data if
+            there is no snapshot
+        tag (str): distinguishes the snapshots of different kinds of data
+
+    Yields:
+        the built data
+    """
+    digest = hashlib.sha1()
+    for text in texts:
+        digest.update(hashlib.sha1(text).digest())
+    snapshot_name = snapshot_file_name(
+        file_name,
+        "{0}-v{1}".format(tag, SNAPSHOT_VERSION),
+        digest.hexdigest()
+    )
+
+    data = read_snapshot(snapshot_name)
+    if data is None:
+        data = build()
+        write_snapshot(snapshot_name, data)
+    return data
@@ -0,0 +1,182 @@
+"""Query the corpus of either spell engine by level and property
+
+A CorpusIndex holds the level of every entry along with its PropertyIndex,
+and is stored in a snapshot keyed by both the data file and the modifiers
+file. Queries are answered from the index, without leveling anything, so
+they stay fast no matter how large the corpus is.
+
+Filters look like 'level >= 3', 'range: close', 'duration = short', or
+'area >= medium radius'. Areas are compared by size, and only match areas
+of the same shape if a shape is given.
+"""
+
+from bisect import bisect_left, bisect_right
+import re
+
+from property_index import parse_query
+from snapshot import load_snapshot
+
+# area sizes from smallest to largest
+AREA_SIZES = ['small', 'medium', 'large', 'huge', 'gargantuan', 'colossal']
+
+FILTER_PATTERN = re.compile(r'^\s*([^<>=:]+?)\s*(>=|<=|=|:|<|>)\s*(.+?)\s*$')
+
+# levels can be negative, so '-2-0' is the range from -2 to 0
+LEVEL_PATTERN = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*$')
+LEVEL_RANGE_PATTERN = re.compile(r'^\s*(-?\d+(?:\.\d+)?)?\s*-\s*(-?\d+(?:\.\d+)?)?\s*$')
+
+
+class CorpusIndex(object):
+    """The levels and property index of every entry in a data file"""
+
+    def __init__(self, property_index, levels, area_properties, errors=None):
+        """
+        Args:
+            property_index (PropertyIndex)
+            levels (dict): maps entry names to levels
+            area_properties (list): the properties whose values are areas,
+                such as 'medium radius burst' or 'medium radius'
+            errors (dict): maps the names of entries that couldn't be
+                leveled to the reason, which no query matches
+        """
+        self.property_index = property_index
+        self.levels = levels
+        self.errors = errors or dict()
+        self.names_by_level = sorted(
+            (level, name) for name, level in levels.items()
+        )
+        self.level_keys = [level for level, name in self.names_by_level]
+
+        # maps area shapes to (size rank, entry name), sorted by size
+        self.areas_by_shape = dict()
+        for (property_name, value), names in property_index.names_by_value.items():
+            if property_name not in area_properties or not isinstance(value, basestring):
+                continue
+            words = value.split()
+            if len(words) < 2 or words[0] not in AREA_SIZES:
+                continue
+            for name in names:
+                for shape in (words[1], None):
+                    self.areas_by_shape.setdefault(shape, []).append(
+                        (AREA_SIZES.index(words[0]), name)
+                    )
+        for areas in self.areas_by_shape.values():
+            areas.sort()
+
+    def names_with_level(self, operator, level):
+        low, high = 0, len(self.names_by_level)
+        if operator in ('=', ':'):
+            low = bisect_left(self.level_keys, level)
+            high = bisect_right(self.level_keys, level)
+        elif operator == '>=':
+            low = bisect_left(self.level_keys, level)
+        elif operator == '>':
+            low = bisect_right(self.level_keys, level)
+        elif operator == '<=':
+            high = bisect_right(self.level_keys, level)
+        elif operator == '<':
+            high = bisect_left(self.level_keys, level)
+        return set(name for level, name in self.names_by_level[low:high])
+
+    def names_with_area(self, operator, area):
+        words = area.split()
+        try:
+            rank = AREA_SIZES.index(words[0])
+        except ValueError:
+            raise Exception("Unknown area size '{0}'".format(words[0]))
+        shape = words[1] if len(words) > 1 else None
+        areas = self.areas_by_shape.get(shape, [])
+        ranks = [area_rank for area_rank, name in areas]
+        low, high = 0, len(areas)
+        if operator in ('=', ':'):
+            low, high = bisect_left(ranks, rank), bisect_right(ranks, rank)
+        elif operator == '>=':
+            low = bisect_left(ranks, rank)
+        elif operator == '>':
+            low = bisect_right(ranks, rank)
+        elif operator == '<=':
+            high = bisect_right(ranks, rank)
+        elif operator == '<':
+            high = bisect_left(ranks, rank)
+        return set(name for area_rank, name in areas[low:high])
+
+    def names_matching(self, text):
+        """Find the entries that match a single filter
+
+        Args:
+            text (str): a filter such as 'level >= 3' or 'range: close'
+
+        Yields:
+            set: entry names
+        """
+        match = FILTER_PATTERN.match(text)
+        if match is None:
+            # a bare property name matches any value
+            return set(self.property_index.find(text.strip()))
+        property_name, operator, value = match.groups()
+        if property_name == 'level':
+            return self.names_with_level(operator, float(value))
+        elif property_name == 'area':
+            return self.names_with_area(operator, value)
+        elif operator in ('=', ':'):
+            return set(self.property_index.find(
+                *parse_query("{0}: {1}".format(property_name, value))
+            ))
+        raise Exception("Only level and area can be compared with '{0}'".format(
+            operator
+        ))
+
+    def select(self, filters=(), sort='name'):
+        """Find the entries that match every filter
+
+        Args:
+            filters (list): filter strings
+            sort (str): 'name' or 'level'
+
+        Yields:
+            list: (entry name, level) tuples
+        """
+        names = set(self.levels)
+        for text in filters:
+            names &= self.names_matching(text)
+        if sort == 'level':
+            key = lambda name: (self.levels[name], name)
+        elif sort == 'name':
+            key = None
+        else:
+            raise Exception("Unknown sort key '{0}'".format(sort))
+        return [(name, self.levels[name]) for name in sorted(names, key=key)]
+
+
+def level_filters(levels):
+    """Convert a level range such as '3-5', '3-', '-2-0' or '4' into filters"""
+    if LEVEL_PATTERN.match(levels):
+        return ["level = {0}".format(levels.strip())]
+    match = LEVEL_RANGE_PATTERN.match(levels)
+    if match is None or match.groups() == (None, None):
+        raise Exception("Invalid level range '{0}'".format(levels))
+    low, high = match.groups()
+    filters = list()
+    if low:
+        filters.append("level >= {0}".format(low))
+    if high:
+        filters.append("level <= {0}".format(high))
+    return filters
+
+
+def load_corpus_index(data_file_name, modifiers_file_name, build, code_hash):
+    """Load the CorpusIndex of a data file, using a snapshot if possible
+
+    Args:
+        data_file_name (str)
+        modifiers_file_name (str): the modifiers that the levels depend on
+        build (function): builds the CorpusIndex with no arguments
+        code_hash (str): a hash of the code that calculates the levels,
+            from result_cache.source_hash
+
+    Yields:
+        CorpusIndex
+    """
+    return load_snapshot(
+        [data_file_name, modifiers_file_name], build, 'corpus-index', [code_hash]
+    )
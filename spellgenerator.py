@@ -1,6 +1,23 @@
 import argparse
-from pprint import pprint, PrettyPrinter
-import yaml
+import copy
+import sys
+from pprint import pformat, PrettyPrinter
+
+from diagnostics import (
+    Diagnostic, DiagnosticCollector, DiagnosticError, ERROR, is_suppressed, WARNING
+)
+from handler_registry import collect_handlers, handles
+from inheritance import InheritanceGraph
+from level_diff import diff_levels, EntryResult
+from level_trace import (
+    Contribution, format_json, format_top_contributors, LevelTrace, Subtrace,
+)
+from modifier_index import ModifierIndex, modifier_path, RecordingModifiers
+from profiling import PROFILER
+from property_index import load_property_index, parse_query
+from result_cache import module_source_hash, ResultCache
+from snapshot import load_yaml_snapshot, parse_yaml
+from spell_query import CorpusIndex, level_filters, load_corpus_index
 
 pprinter = PrettyPrinter(indent=4, width=60)
 
@@ -22,6 +39,44 @@ PLURAL_MAPPINGS = {
 NESTING_ATTRIBUTES = set('subeffects, attack subeffects'.split(', '))
 SUBSPELL_INHERITED_ATTRIBUTES = set(list(SINGLE_MODIFIERS) + list(AREA_NAMES) + 'dispellable, duration, ignore warnings'.split(', '))
 
+# maps diagnostic codes to their messages
+DIAGNOSTIC_TEMPLATES = {
+    'area-without-targets': "Spell {name} with area must have targets",
+    'buff-without-duration': "Spell {name} with buff must have duration",
+    'condition-without-duration': "Spell {name} with condition must have duration",
+    'effect-stronger-than-success': "Spell {name} has effect more powerful than success",
+    'existing-attribute': "Spell {name} already has attribute {0}, but require_nonexisting is true",
+    'invalid-attribute': "Spell {name} had weird error getting attribute {0}: {1}",
+    'invalid-trigger': "Spell {name} has invalid trigger {0}",
+    'missing-attribute': "Spell {name} does not have attribute {0}",
+    'missing-modifier': "Spell {name} does not have modifier {0}",
+    'missing-primary-attribute': "Spell {name} has no primary attributes",
+    'multiple-primary-attributes': "Spell {name} has too many primary attributes",
+    'noncritical-effect-stronger-than-success': "Spell {name} has noncritical effect more powerful than success",
+    'nonpositive-level': "Spell {name} has nonpositive raw level {0}, which is usually bad",
+    'none-modifier': "Spell {name} can't add modifier {0} with value of None",
+    'personal-long-not-close': "spell {name} with 'personal long' duration should be close range",
+    'strong-critical-success': "Spell {name} has crit success subeffect with level {0}, which may be too strong",
+    'strong-failure': "Spell {name} has failure subeffect with level {0}, which may be too strong",
+    'targets-without-area': "Spell {name} with non-specific targets {0} must have area",
+    'trigger-without-condition': "Spell {name} with trigger must have both 'triggered: true' and 'trigger condition'",
+    'unrecognized-attribute': "Spell {name} has unrecognized attribute {0}",
+    'unrecognized-modifier': "Spell {name} has unrecognized modifier {0}",
+    'weak-critical-success': "Spell {name} has crit success subeffect with level {0}, which may be too weak",
+    'weak-failure': "Spell {name} has failure subeffect with level {0}, which may be too weak",
+    'weak-success': "Spell {name} has success subeffect with level {0}, which may be too weak",
+}
+
+# the modules whose code affects levels; results that are kept between runs
+# are only reused if none of them changed
+LEVELING_MODULES = [__name__, 'diagnostics', 'handler_registry', 'inheritance', 'modifier_index']
+# the corpus index also depends on the code that builds it
+CORPUS_INDEX_MODULES = LEVELING_MODULES + ['property_index', 'spell_query']
+# the modules whose code resolves inheritance in the data files, which
+# snapshots of the resolved data depend on
+RESOLVING_MODULES = [__name__, 'inheritance']
+PROPERTY_INDEX_MODULES = RESOLVING_MODULES + ['property_index']
+
 # list: 0th is spell point cost of 0th level spells, 1st is spell point cost of
 # 1st level spells, etc.
 # Every 3 levels, the power of a spell (the spell point cost) doubles
@@ -47,27 +102,141 @@ def initialize_argument_parser():
     parser.add_argument('-m', '--magicitems', dest='magic_items', type=str,
                         nargs='*', help = 'if provided, process abilities instead of spells')
     parser.add_argument('-t', '--type', dest='type', type=str,
-            help='type of spells to get')
+            help="only get spells using this attribute, or this attribute value such as 'condition: dazed'")
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
             help='generate more output')
+    parser.add_argument('--level', dest='level', type=str,
+            help='only get spells with levels such as 3-5, 3-, or 4')
+    parser.add_argument('-w', '--where', dest='where', type=str, action='append',
+            help="only get spells matching a filter such as 'area >= medium radius'; may be repeated")
+    parser.add_argument('--sort', dest='sort', choices=['name', 'level'], default='name',
+            help='order of spells found with --level or --where')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+            help='report the time spent in each modifier to stderr')
+    parser.add_argument('--diff', dest='diff', nargs='?', const='levels.yaml',
+            help='compare the levels with a levels file, levels.yaml by default, and show what changed')
+    parser.add_argument('--from', dest='diff_from', type=str,
+            help='with --diff, compare with the data at this git revision instead of a levels file')
+    parser.add_argument('--check', dest='check', action='store_true',
+            help='with --diff, exit with an error if any level changed')
+    parser.add_argument('--suppress', dest='suppress', type=str, action='append', default=[],
+            help="don't report warnings matching a rule such as 'weak-success' or 'grease:*'; may be repeated")
+    parser.add_argument('--explain', dest='explain', choices=['text', 'json', 'top'], default='text',
+            help='format of the explanation of each level with --spell or --verbose; top shows the largest modifiers at any depth')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+            help='level every spell, instead of reusing the levels of spells that are unchanged since the last run')
     return vars(parser.parse_args())
 
-def import_data(args):
-    with open('modifiers.yaml', 'r') as modifiersfile:
-        modifiers = yaml.load(modifiersfile)
+def data_file_name(args):
     if args.get('abilities') is not None:
-        filename = 'abilities.yaml'
+        return 'abilities.yaml'
     elif args.get('magic_items') is not None:
-        filename = 'magic_items.yaml'
+        return 'magic_items.yaml'
     else:
-        filename = 'spells.yaml'
-    with open(filename, 'r') as spellsfile:
-        spells = yaml.load(spellsfile)
+        return 'spells.yaml'
+
+def import_data(args):
+    modifiers = load_yaml_snapshot('modifiers.yaml')
+    spells = load_yaml_snapshot(data_file_name(args), resolve_spells, 'resolved',
+        module_source_hash(*RESOLVING_MODULES))
     return {
-        'modifiers': modifiers,
+        'modifiers': ModifierIndex(modifiers),
         'spells': spells,
     }
 
+def build_corpus_index(filename, spells, all_modifiers, diagnostics=None):
+    if diagnostics is None:
+        diagnostics = DiagnosticCollector()
+    levels = dict()
+    errors = dict()
+    for spell_name in spells:
+        if spell_name == 'default spell':
+            continue
+        try:
+            level = Spell.create_by_name(spell_name, spells, all_modifiers, diagnostics=diagnostics).calculate_level()
+        except Exception as e:
+            # one broken spell shouldn't stop queries about the others
+            errors[spell_name] = str(e)
+            continue
+        # ignored spells have no level
+        if level != '':
+            levels[spell_name] = level
+    # the warnings are only found when the index is built
+    diagnostics.report(sys.stderr, '#')
+    diagnostics.take()
+    return CorpusIndex(
+        load_property_index(filename, resolve_spells,
+            module_source_hash(*PROPERTY_INDEX_MODULES), PLURAL_MAPPINGS),
+        levels,
+        AREA_NAMES,
+        errors,
+    )
+
+def load_diff_spells(text):
+    spells = resolve_spells(parse_yaml(text))
+    del spells['default spell']
+    return spells
+
+def make_diff_evaluator(all_modifiers):
+    def evaluate(spell_name, attributes):
+        # subspells modify their nested attributes, which resolved spells
+        # share, so the attributes are copied to keep their hashes stable
+        # the paths are recorded so that the spell is only leveled again if
+        # one of the modifiers it read changes
+        recording_modifiers = RecordingModifiers(all_modifiers)
+        spell = Spell(spell_name, copy.deepcopy(attributes), recording_modifiers)
+        try:
+            level = spell.calculate_level()
+        except Exception as e:
+            return EntryResult(None, None, None, None, None, str(e))
+        breakdown = dict()
+        for modifier_name, modifier in spell.modifiers.items():
+            breakdown[modifier_name] = sum(modifier) if isinstance(modifier, list) else modifier
+        # ignored spells have no level
+        return EntryResult(None, None, None if level == '' else level, breakdown,
+            recording_modifiers.paths, None)
+    return evaluate
+
+def calculate_cached_level(spell_name, attributes, all_modifiers, cache, entry_hash):
+    """Get the level and warnings of a spell from a ResultCache, or
+    calculate and store them
+
+    Yields:
+        tuple: (level, list of Diagnostics)
+    """
+    stored = cache.get(entry_hash, all_modifiers.table)
+    if stored is None:
+        recording_modifiers = RecordingModifiers(all_modifiers)
+        spell_diagnostics = DiagnosticCollector()
+        spell = Spell(spell_name, copy.deepcopy(attributes), recording_modifiers, diagnostics=spell_diagnostics)
+        stored = (spell.calculate_level(), spell_diagnostics.take())
+        cache.put(entry_hash, recording_modifiers.paths, all_modifiers.table, stored)
+    return stored
+
+def inherit_base_attributes(base_spell, spell):
+    spell_attributes = dict(spell)
+    # remove 'base' so we can tell if there are no more base spells left
+    del spell_attributes['base']
+    for key in base_spell:
+        if key not in spell_attributes and key != 'ignore':
+            spell_attributes[key] = base_spell[key]
+    return spell_attributes
+
+def resolve_spells(spells):
+    # spells can inherit attributes from specific 'base' spells
+    resolved_spells = InheritanceGraph(spells, 'base').resolve(inherit_base_attributes)
+    # every spell also inherits from the default spell to avoid unnecessary duplication
+    default_spell = resolved_spells['default spell']
+    for spell_name in resolved_spells:
+        if spell_name == 'default spell':
+            continue
+        spell_attributes = dict(resolved_spells[spell_name])
+        for key in default_spell:
+            if key not in spell_attributes:
+                spell_attributes[key] = default_spell[key]
+        resolved_spells[spell_name] = spell_attributes
+    return resolved_spells
+
 def enforce_plural_attributes(attributes):
     # make sure only the plural versions of the attribute names are stored
     for attribute_name in attributes:
@@ -82,17 +251,58 @@ def ensure_list(string_or_list):
     else:
         return string_or_list
 
+def register_attribute_handlers(cls):
+    """Build the attribute_handlers registry of a Spell class
+
+    Handlers are called with (attribute_name, attribute, all_modifiers),
+    and return the modifier for the attribute, or None if they added their
+    own modifiers. Attributes without a handler of their own use the
+    generic lookup or are ignored.
+    """
+    handlers = collect_handlers(cls, 'attribute_handlers')
+    for attribute_name in SINGLE_MODIFIERS:
+        handlers.setdefault(attribute_name, cls.calculate_generic_modifier.__func__)
+    for attribute_name in NONGENERIC_MODIFIERS:
+        handlers.setdefault(attribute_name, cls.calculate_nongeneric_modifier.__func__)
+    cls.attribute_handlers = handlers
+    return cls
+
+@register_attribute_handlers
 class Spell:
-    def __init__(self, name, attributes, all_modifiers, verbose = False):
+    def __init__(self, name, attributes, all_modifiers, verbose = False, diagnostics = None):
         self.name = name
         self.attributes = enforce_plural_attributes(attributes)
         self.verbose = verbose
+        self.all_modifiers = all_modifiers
         self.modifiers = dict()
+        # verbose spells also record the modifier paths and subspells behind
+        # each modifier, so that trace() can explain them
+        self.level = None
+        self.modifier_paths = dict()
+        self.modifier_subspells = dict()
+        self._recording_modifiers = None
+        self._pending_subspells = list()
+        # subspells share the diagnostics of the spell that created them
+        if diagnostics is None:
+            diagnostics = DiagnosticCollector()
+        self.diagnostics = diagnostics
 
     @property
     def ignore_warnings(self):
         return self.attributes.get('ignore warnings')
 
+    def diagnostic(self, code, severity, arguments):
+        return Diagnostic(code, severity, self.name, DIAGNOSTIC_TEMPLATES[code], arguments)
+
+    def die(self, code, *arguments):
+        # the attributes are only formatted if the error is printed
+        raise DiagnosticError(self.diagnostic(code, ERROR, arguments), self.attributes)
+
+    def warn(self, code, *arguments):
+        # 'ignore warnings' is either true or a list of codes to suppress
+        if not is_suppressed(code, self.ignore_warnings):
+            self.diagnostics.add(self.diagnostic(code, WARNING, arguments))
+
     @property
     def affects_multiple(self):
         for attribute_name in AREA_NAMES:
@@ -108,18 +318,17 @@ class Spell:
             if self.has_attribute(primary_attribute) and self.get_attribute(primary_attribute) is not None:
                 primary_attribute_count += 1
         if primary_attribute_count == 0:
-            raise Exception("Spell {0} has no primary attributes ({1})".format(self.name, pprinter.pformat(self.attributes)))
+            self.die('missing-primary-attribute')
         elif primary_attribute_count >= 2:
-            raise Exception("Spell {0} has too many primary attributes ({1})".format(self.name, pprinter.pformat(self.attributes)))
+            self.die('multiple-primary-attributes')
 
     def get_attribute(self, attribute):
         try:
             return self.attributes[attribute]
         except KeyError:
-            raise Exception("Spell {0} does not have attribute {1}".format(self.name, attribute))
+            self.die('missing-attribute', attribute)
         except TypeError as e:
-            raise Exception("Spell {0} had weird error getting attribute {1}: {2}".format(
-                self.name, attribute, e))
+            self.die('invalid-attribute', attribute, e)
 
     def has_attribute(self, attribute_name):
         return attribute_name in self.attributes
@@ -136,13 +345,23 @@ class Spell:
         if replace_existing or not self.has_attribute(attribute_name):
             self.attributes[attribute_name] = attribute
         elif require_nonexisting and self.has_attribute(attribute_name):
-            raise Exception("Spell {0} already has attribute {1}, but require_nonexisting is true ({2})".format(self.name, attribute_name, pprinter.pformat(self.attributes)))
+            self.die('existing-attribute', attribute_name)
         # if the attribute already exists, and both replace_exiting and
         # require_nonexisting are False, silently ignore the addition
 
     def add_modifier(self, modifier_name, value):
         if value is None:
-            raise Exception("Spell {0} can't add modifier {1} with value of None".format(self.name, modifier_name))
+            self.die('none-modifier', modifier_name)
+        if self.verbose:
+            # everything read since the last modifier was added belongs to this one
+            self.modifier_paths.setdefault(modifier_name, set()).update(
+                self._recording_modifiers.paths
+            )
+            self._recording_modifiers.paths = set()
+            self.modifier_subspells.setdefault(modifier_name, []).extend(
+                self._pending_subspells
+            )
+            self._pending_subspells = list()
         if modifier_name in self.modifiers:
             try:
                 self.modifiers[modifier_name].append(value)
@@ -158,12 +377,22 @@ class Spell:
         try:
             return self.modifiers[modifier_name]
         except KeyError:
-            raise Exception("Spell {0} does not have modifier {1}".format(self.name, modifier_name))
+            self.die('missing-modifier', modifier_name)
 
     def calculate_level(self, raw = False, ignore_targeting_attributes = False):
         if self.has_attribute('ignore') and self.get_attribute('ignore'):
             return ''
         self.assert_valid_attributes()
+        all_modifiers = self.all_modifiers
+        if self.verbose:
+            # subspells record their own modifier paths, so a subspell
+            # doesn't record into the modifiers of the spell that created it
+            all_modifiers = self._recording_modifiers = RecordingModifiers(
+                getattr(all_modifiers, 'index', all_modifiers)
+            )
+            self.modifier_paths = dict()
+            self.modifier_subspells = dict()
+            self._pending_subspells = list()
         self.calculate_modifiers(all_modifiers, ignore_targeting_attributes)
 
         level = 0
@@ -175,12 +404,12 @@ class Spell:
             except TypeError:
                 for submodifier in self.get_modifier(modifier_name):
                     level += submodifier
-        if level <= 0 and not self.ignore_warnings:
-            print "#Warning: Spell {0} has nonpositive raw level {1}, which is usually bad".format(self.name, level)
-        if raw:
-            return level
-        else:
-            return level - 4
+        if level <= 0:
+            self.warn('nonpositive-level', level)
+        if not raw:
+            level -= 4
+        self.level = level
+        return level
 
     def calculate_modifiers(self, all_modifiers, ignore_targeting_attributes = False):
         self.modifiers = dict()
@@ -193,69 +422,54 @@ class Spell:
             # skip attributes that don't actually exist
             if attribute is None:
                 continue
-            # most modifiers are a single dict
-            # but some have nested dicts, while others don't use dicts at all
-            if attribute_name == 'subeffects':
-                for subeffect in attribute:
-                    self.add_modifier('subeffect', self.calculate_subeffect_modifier(subeffect, all_modifiers))
-            elif attribute_name == 'attack subeffects':
-                self.add_attack_subeffects_modifiers(attribute_name, attribute, all_modifiers)
-            elif attribute_name == 'triggered':
-                for modifier in self.calculate_triggered_modifier(all_modifiers):
-                    self.add_modifier('triggered', modifier)
-            else:
-                # for these attributes, we are just deciding what the total
-                # modifier is, not using fancy logic to assign special modifier
-                # names, so the structure is more similar
-                spell_level = 0
-                if attribute_name in AREA_NAMES:
-                    spell_level = self.calculate_area_modifier(attribute_name, attribute, all_modifiers)
-                elif attribute_name == 'damage':
-                    spell_level = self.calculate_damage_modifier(attribute, all_modifiers)
-                elif attribute_name == 'targets':
-                    spell_level = self.calculate_targets_modifier(attribute_name, attribute, all_modifiers)
-                elif attribute_name == 'buffs':
-                    spell_level = self.calculate_buffs_modifier(attribute, all_modifiers)
-                elif attribute_name == 'conditions':
-                    spell_level = self.calculate_conditions_modifier(attribute, all_modifiers)
-                elif attribute_name == 'limit affected':
-                    spell_level = self.calculate_limit_affected_modifier(attribute, all_modifiers)
-                elif attribute_name == 'range':
-                    spell_level = self.calculate_range_modifier(attribute, all_modifiers)
-                elif attribute_name == 'antibuffs':
-                    spell_level = self.calculate_antibuffs_modifier(attribute, all_modifiers)
-                elif attribute_name == 'instant effect':
-                    spell_level = self.calculate_instant_effect_modifier(attribute, all_modifiers)
-                elif attribute_name == 'teleport':
-                    spell_level = self.calculate_teleport_modifier(attribute, all_modifiers)
-                elif attribute_name == 'breakable':
-                    spell_level = self.calculate_breakable_modifier(attribute, all_modifiers)
-                elif attribute_name == 'misc':
-                    spell_level = attribute
-                elif attribute_name == 'at will class feature':
-                    spell_level = all_modifiers['at will class feature']
-                elif attribute_name in SINGLE_MODIFIERS:
-                    spell_level = self.calculate_generic_modifier(attribute_name, attribute, all_modifiers)
-                #elif attribute_name in PLURAL_MODIFIERS:
-                    #for subattribute_name in self.get_attribute(attribute_name):
-                        #spell_level += super_get(all_modifiers, {attribute_name: subattribute_name})
-                elif attribute_name in NONGENERIC_MODIFIERS:
-                    pass
-                else:
-                    raise Exception("Spell {0} has unrecognized attribute {1}".format(self.name, attribute_name))
+            try:
+                handler = self.attribute_handlers[attribute_name]
+            except KeyError:
+                self.die('unrecognized-attribute', attribute_name)
+            # handlers with fancy logic to assign special modifier names
+            # add their own modifiers and return None
+            spell_level = handler(self, attribute_name, attribute, all_modifiers)
+            if spell_level is not None:
                 self.add_modifier(attribute_name, spell_level)
 
+    @handles('subeffects')
+    def add_subeffects_modifiers(self, attribute_name, attribute, all_modifiers):
+        for subeffect in attribute:
+            self.add_modifier('subeffect', self.calculate_subeffect_modifier(subeffect, all_modifiers))
+
+    @handles('triggered')
+    def add_triggered_modifiers(self, attribute_name, attribute, all_modifiers):
+        for modifier in self.calculate_triggered_modifier(all_modifiers):
+            self.add_modifier('triggered', modifier)
+
+    @handles('misc')
+    def calculate_misc_modifier(self, attribute_name, attribute, all_modifiers):
+        return attribute
+
+    @handles('at will class feature')
+    def calculate_at_will_class_feature_modifier(self, attribute_name, attribute, all_modifiers):
+        return all_modifiers.lookup('at will class feature')
+
+    def calculate_nongeneric_modifier(self, attribute_name, attribute, all_modifiers):
+        # these are factored in as part of other modifiers
+        return 0
+
     def calculate_subeffect_modifier(self, subeffect, all_modifiers):
-        subspell = Spell('{0}.subspell'.format(self.name), subeffect, all_modifiers)
+        subspell = Spell('{0}.subspell'.format(self.name), subeffect, all_modifiers, self.verbose, self.diagnostics)
         # propagate attributes of the base spell into the subeffects
         for attribute_name in self.attributes:
             if attribute_name in SUBSPELL_INHERITED_ATTRIBUTES:
                 subspell.add_attribute(attribute_name, self.get_attribute(attribute_name), replace_existing = False)
-        return max(0,subspell.calculate_level(raw = True, ignore_targeting_attributes = True))
+        modifier = max(0,subspell.calculate_level(raw = True, ignore_targeting_attributes = True))
+        if self.verbose:
+            self._pending_subspells.append((subspell, modifier))
+        return modifier
 
-    def calculate_damage_modifier(self, attribute, all_modifiers):
+    @handles('damage')
+    def calculate_damage_modifier(self, attribute_name, attribute, all_modifiers):
         return self.calculate_generic_modifier('damage', attribute, all_modifiers)
 
+    @handles('attack subeffects')
     def add_attack_subeffects_modifiers(self, attribute_name, attribute, all_modifiers):
         if 'success' in attribute:
             success_modifier = self.calculate_success_modifier(attribute['success'], all_modifiers)
@@ -268,7 +482,7 @@ class Spell:
                 attribute['noncritical effect'], all_modifiers
             )
             if success_modifier != 0 and noncritical_effect_modifier > success_modifier + 3:
-                raise Exception("Spell {0} has noncritical effect more powerful than success ({1})".format(self.name, self.attributes))
+                self.die('noncritical-effect-stronger-than-success')
             self.add_modifier('noncritical effect', noncritical_effect_modifier)
         else:
             noncritical_effect_modifier = 0
@@ -290,52 +504,48 @@ class Spell:
                 attribute['effect'], all_modifiers
             )
             if success_modifier != 0 and effect_modifier > success_modifier + 3:
-                raise Exception("Spell {0} has effect more powerful than success ({1})".format(self.name, self.attributes))
+                self.die('effect-stronger-than-success')
             self.add_modifier('attack effect', effect_modifier)
 
     def calculate_success_modifier(self, success_effects, all_modifiers):
         modifier = sum([
             self.calculate_subeffect_modifier(success_effects, all_modifiers),
-            all_modifiers['attack']['success only']
+            all_modifiers.lookup('attack', 'success only')
         ])
-        if modifier <= 0 and not self.ignore_warnings:
-            print "#Warning: Spell {0} has success subeffect with level {1}, which may be too weak".format(
-                self.name, modifier)
+        if modifier <= 0:
+            self.warn('weak-success', modifier)
         return max(1, modifier)
 
     def calculate_critical_success_modifier(self, critical_success_effects, success_modifier, all_modifiers):
         modifier = sum([
             self.calculate_subeffect_modifier(critical_success_effects, all_modifiers),
-            all_modifiers['attack']['critical success only'],
+            all_modifiers.lookup('attack', 'critical success only'),
             -success_modifier
         ])
-        if modifier < -1 and not self.ignore_warnings:
-            print "#Warning: Spell {0} has crit success subeffect with level {1}, which may be too weak".format(
-                self.name, modifier)
-        elif modifier > 0 and not self.ignore_warnings:
-            print "#Warning: Spell {0} has crit success subeffect with level {1}, which may be too strong".format(
-                self.name, modifier)
+        if modifier < -1:
+            self.warn('weak-critical-success', modifier)
+        elif modifier > 0:
+            self.warn('strong-critical-success', modifier)
         return modifier
 
     def calculate_failure_modifier(self, failure_effects, success_modifier, all_modifiers):
         modifier = sum([
             self.calculate_subeffect_modifier(failure_effects, all_modifiers),
-            all_modifiers['attack']['failure only'],
+            all_modifiers.lookup('attack', 'failure only'),
             -success_modifier
         ])
-        if modifier < -1 and not self.ignore_warnings:
-            print "#Warning: Spell {0} has failure subeffect with level {1}, which may be too weak".format(
-                    self.name, modifier)
-        elif modifier > 0 and not self.ignore_warnings:
-            print "#Warning: Spell {0} has failure subeffect with level {1}, which may be too strong".format(
-                self.name, modifier)
+        if modifier < -1:
+            self.warn('weak-failure', modifier)
+        elif modifier > 0:
+            self.warn('strong-failure', modifier)
         return modifier
 
+    @handles(*AREA_NAMES)
     def calculate_area_modifier(self, attribute_name, attribute, all_modifiers):
         area_size, area_shape = attribute.split()
-        modifier = all_modifiers['area'][area_shape][area_size]
+        modifier = all_modifiers.lookup('area', area_shape, area_size)
         if not self.has_attribute('targets'):
-            raise Exception("Spell {0} with area must have targets ({1})".format(self.name, self.attributes))
+            self.die('area-without-targets')
         targets = self.get_attribute('targets')
         # if a spell affects five targets
         if targets == 'five':
@@ -350,16 +560,17 @@ class Spell:
                 modifier += 1
         # if the spell is shapeable
         if self.has_attribute('shapeable') and area_shape in ('line', 'wall'):
-            modifier += all_modifiers['shapeable'][self.get_attribute('shapeable')]
+            modifier += all_modifiers.lookup('shapeable', self.get_attribute('shapeable'))
         # knowledge spells should get cheaper areas
         if self.has_attribute('knowledge'):
             modifier = max(2, modifier - 2)
         return modifier
 
-    def calculate_buffs_modifier(self, attribute, all_modifiers):
-        modifier = all_modifiers['buffs']['base']
+    @handles('buffs')
+    def calculate_buffs_modifier(self, attribute_name, attribute, all_modifiers):
+        modifier = all_modifiers.lookup('buffs', 'base')
         if not self.has_attribute('duration'):
-            raise Exception("Spell {0} with buff must have duration ({1})".format(self.name, self.attributes))
+            self.die('buff-without-duration')
         for buff in attribute:
             try:
                 buff_name = buff.keys()[0]
@@ -390,10 +601,11 @@ class Spell:
         modifier += self.calculate_duration_modifier(self.get_attribute('duration'), all_modifiers, duration_type = duration_type)
         return modifier
 
-    def calculate_conditions_modifier(self, attribute, all_modifiers):
+    @handles('conditions')
+    def calculate_conditions_modifier(self, attribute_name, attribute, all_modifiers):
         if not self.has_attribute('duration'):
-            raise Exception("Spell {0} with condition must have duration ({1})".format(self.name, self.attributes))
-        modifier = all_modifiers['conditions']['base']
+            self.die('condition-without-duration')
+        modifier = all_modifiers.lookup('conditions', 'base')
         for condition in attribute:
             try:
                 condition_name = condition.keys()[0]
@@ -428,14 +640,16 @@ class Spell:
             and 'temporary hp' in self.get_attribute('buffs')
         ):
             modifier = max(0, modifier - 1)
-        if attribute == 'personal long' and not self.attributes.get('range', None) == 'close' and not self.ignore_warnings:
-            print "#Warning: spell {0} with 'personal long' duration should be close range".format(self.name)
+        if attribute == 'personal long' and not self.attributes.get('range', None) == 'close':
+            self.warn('personal-long-not-close')
         return modifier
 
-    def calculate_instant_effect_modifier(self, attribute, all_modifiers):
+    @handles('instant effect')
+    def calculate_instant_effect_modifier(self, attribute_name, attribute, all_modifiers):
         return self.calculate_generic_modifier('instant effect', attribute, all_modifiers)
 
-    def calculate_limit_affected_modifier(self, attribute, all_modifiers):
+    @handles('limit affected')
+    def calculate_limit_affected_modifier(self, attribute_name, attribute, all_modifiers):
         if (
                 self.has_attribute('buffs')
                 or (
@@ -448,34 +662,39 @@ class Spell:
             attribute = {'normal': attribute}
         return self.calculate_generic_modifier('limit affected', attribute, all_modifiers)
 
-    def calculate_range_modifier(self, attribute, all_modifiers):
+    @handles('range')
+    def calculate_range_modifier(self, attribute_name, attribute, all_modifiers):
         if self.has_attribute('buffs') or self.has_attribute('teleport'):
             return self.calculate_generic_modifier('range', {'buff': attribute}, all_modifiers)
         else:
             return self.calculate_generic_modifier('range', {'normal': attribute}, all_modifiers)
 
-    def calculate_antibuffs_modifier(self, attribute, all_modifiers):
+    @handles('antibuffs')
+    def calculate_antibuffs_modifier(self, attribute_name, attribute, all_modifiers):
         try:
-            modifier = self.calculate_conditions_modifier(attribute, all_modifiers)
+            modifier = self.calculate_conditions_modifier('conditions', attribute, all_modifiers)
         except:
-            modifier = self.calculate_buffs_modifier(attribute, all_modifiers)
+            modifier = self.calculate_buffs_modifier('buffs', attribute, all_modifiers)
         return -modifier / 2.0
 
-    def calculate_teleport_modifier(self, attribute, all_modifiers):
-        modifier = self.calculate_range_modifier(attribute['range'], all_modifiers)
+    @handles('teleport')
+    def calculate_teleport_modifier(self, attribute_name, attribute, all_modifiers):
+        modifier = self.calculate_range_modifier('range', attribute['range'], all_modifiers)
         if attribute.get('unrestricted'):
             modifier += self.calculate_generic_modifier('teleport', 'unrestricted', all_modifiers)
         else:
             modifier += self.calculate_generic_modifier('teleport', 'normal', all_modifiers)
         return modifier
 
-    def calculate_breakable_modifier(self, attribute, all_modifiers):
+    @handles('breakable')
+    def calculate_breakable_modifier(self, attribute_name, attribute, all_modifiers):
         attribute = ensure_list(attribute)
         modifier = 0
         for subattribute in attribute:
             modifier += self.calculate_generic_modifier('breakable', subattribute, all_modifiers)
         return modifier
 
+    @handles('targets')
     def calculate_targets_modifier(self, attribute_name, attribute, all_modifiers):
         modifier = self.calculate_generic_modifier(attribute_name, attribute, all_modifiers)
         # if we affect a specific number of targets, this could mean two things
@@ -495,16 +714,12 @@ class Spell:
             for area_name in AREA_NAMES:
                 if self.has_attribute(area_name):
                     return modifier
-            raise Exception(
-                "Spell {0} with non-specific targets {1} must have area ({2})".format(
-                    self.name, attribute, self.attributes,
-                )
-            )
+            self.die('targets-without-area', attribute)
         return modifier
 
     def calculate_triggered_modifier(self, all_modifiers):
         if not (self.has_attribute('trigger condition') and self.has_attribute('triggered') and self.get_attribute('triggered')):
-            raise Exception("Spell {0} with trigger must have both 'triggered: true' and 'trigger condition' ({1})".format(self.name, self.attributes))
+            self.die('trigger-without-condition')
         modifiers = list()
         modifiers.append(self.calculate_generic_modifier('trigger condition', self.get_attribute('trigger condition'), all_modifiers))
         if self.has_attribute('trigger duration'):
@@ -518,34 +733,46 @@ class Spell:
                 trigger_condition = trigger['trigger condition']
                 trigger_effect = trigger['subeffect']
             except KeyError:
-                raise Exception("Spell {0} has invalid trigger {1}".format(self.name, pprinter.pformat(trigger)))
-            spell_level += all_modifiers['trigger condition'][trigger_condition]
+                self.die('invalid-trigger', pprinter.pformat(trigger))
+            spell_level += all_modifiers.lookup('trigger condition', trigger_condition)
             spell_level += self.calculate_subeffect_modifier(trigger_effect, all_modifiers)
         return spell_level
 
     def calculate_generic_modifier(self, attribute_name, attribute, all_modifiers):
-        return super_get(all_modifiers, {attribute_name: attribute})
+        path = modifier_path(attribute_name, attribute)
+        try:
+            return all_modifiers.lookup(*path)
+        except KeyError:
+            self.die('unrecognized-modifier', path)
 
     @classmethod
-    def create_by_name(cls, spell_name, spells, all_modifiers, verbose = None):
-        spell_attributes = dict()
-        # assign the attributes from the spell with the given name
-        for key in spells[spell_name]:
-            spell_attributes[key] = spells[spell_name][key]
-        # spells can inherit attributes from specific 'base' spells
-        while 'base' in spell_attributes:
-            # remove 'base' so we can tell if there are no more base spells left
-            base_spell = spells[spell_attributes.pop('base')]
-            for key in base_spell:
-                if key not in spell_attributes and key != 'ignore':
-                    spell_attributes[key] = base_spell[key]
-        # every spell also inherits from the default spell to avoid unnecessary duplication
-        default_spell = spells['default spell']
-        for key in default_spell:
-            if key not in spell_attributes:
-                spell_attributes[key] = default_spell[key]
-
-        return cls(spell_name, spell_attributes, all_modifiers, verbose)
+    def create_by_name(cls, spell_name, spells, all_modifiers, verbose = None, diagnostics = None):
+        # spells must already be resolved with resolve_spells
+        return cls(spell_name, dict(spells[spell_name]), all_modifiers, verbose, diagnostics)
+
+    def trace(self):
+        """Level a verbose spell, and record how its level was calculated
+
+        Yields:
+            LevelTrace
+        """
+        if self.level is None:
+            self.calculate_level()
+        contributions = list()
+        # sorted by name, like the properties in the traces of the new engine;
+        # the order of self.modifiers depends on how the data was loaded
+        for modifier_name, modifier in sorted(self.modifiers.items()):
+            contributions.append(Contribution(
+                modifier_name,
+                self.attributes.get(modifier_name),
+                modifier,
+                frozenset(self.modifier_paths.get(modifier_name, ())),
+                [
+                    Subtrace(None, submodifier, subspell.trace())
+                    for subspell, submodifier in self.modifier_subspells.get(modifier_name, ())
+                ],
+            ))
+        return LevelTrace(self.name, self.level, contributions)
 
     def __str__(self):
         text =  "{0}: {1}".format(self.name, self.calculate_level())
@@ -553,40 +780,134 @@ class Spell:
             text += "\n({0})".format(pprinter.pformat(self.attributes))
         return text
 
-def super_get(nested_dict, thing):
-    try:
-        return nested_dict[thing]
-    except TypeError:
-        if len(thing.keys()) > 1:
-            raise Exception("Can't super_get with dict that has more than one key: {0}".format(thing))
-        key = thing.keys()[0]
-        value = thing[key]
-        try:
-            return super_get(nested_dict[key], value)
-        except KeyError:
-            raise Exception("Can't find key {0} in {1}".format(key, nested_dict))
-    except KeyError:
-        raise Exception("Can't find key {0} in {1}".format(thing, nested_dict))
+def format_explanation(trace, attributes, pretty_modifiers=True):
+    """Format a LevelTrace of a spell as a text explanation
+
+    Args:
+        trace (LevelTrace)
+        attributes (dict): the attributes of the spell
+        pretty_modifiers (bool): pretty-print the modifiers, as --spell
+            does, instead of writing them on one line like --verbose
+    """
+    if pretty_modifiers:
+        modifiers = pformat(dict(
+            (contribution.name, contribution.modifier) for contribution in trace.contributions
+        ))
+    else:
+        # written like a dict, but in the order of the trace
+        modifiers = '{' + ', '.join(
+            '{0!r}: {1!r}'.format(contribution.name, contribution.modifier)
+            for contribution in trace.contributions
+        ) + '}'
+    return "{0}: {1}\n({2})\n{3}\n".format(
+        trace.name,
+        trace.level,
+        pprinter.pformat(attributes),
+        modifiers,
+    )
+
+def explain_spell(spell, explain_format, pretty_modifiers=True):
+    trace = spell.trace()
+    if explain_format == 'json':
+        return format_json(trace)
+    elif explain_format == 'top':
+        return format_top_contributors(trace)
+    return format_explanation(trace, spell.attributes, pretty_modifiers)
+
+# the hot paths reported by --profile
+PROFILER.instrument(Spell, [
+    method_name for method_name in dir(Spell)
+    if method_name.startswith('calculate_')
+    or (method_name.startswith('add_') and method_name.endswith('_modifiers'))
+] + ['__init__'])
+PROFILER.instrument_registry(Spell.attribute_handlers, 'Spell')
+PROFILER.instrument(ModifierIndex, ['contains', 'lookup'])
 
 if __name__ == '__main__':
     args = initialize_argument_parser()
+    if args['profile']:
+        PROFILER.enable()
+    diagnostics = DiagnosticCollector(args['suppress'])
+    if args['diff'] or args['diff_from']:
+        level_diff = diff_levels(
+            data_file_name(args),
+            'modifiers.yaml',
+            load_diff_spells,
+            make_diff_evaluator,
+            module_source_hash(*LEVELING_MODULES),
+            args['diff_from'] or 'HEAD',
+            None,
+            None if args['diff_from'] and not args['diff'] else args['diff'],
+        )
+        level_diff.report(sys.stdout)
+        sys.exit(1 if args['check'] and not level_diff.is_empty() else 0)
     data = import_data(args)
     spells = data['spells']
     all_modifiers = data['modifiers']
-    if args['spell_name']:
+    if args['level'] or args['where']:
+        # answer the query from the index, without building any spells
+        filename = data_file_name(args)
+        corpus_index = load_corpus_index(filename, 'modifiers.yaml',
+            lambda: build_corpus_index(filename, spells, all_modifiers, diagnostics),
+            module_source_hash(*CORPUS_INDEX_MODULES))
+        for spell_name, error in sorted(corpus_index.errors.items()):
+            sys.stderr.write("error: {0}: {1}\n".format(spell_name, error))
+        filters = list(args['where'] or [])
+        if args['level']:
+            filters = level_filters(args['level']) + filters
+        if args['type']:
+            filters.append(args['type'])
+        for spell_name, level in corpus_index.select(filters, args['sort']):
+            print "{0}: {1}".format(spell_name, level)
+    elif args['spell_name']:
         for spell_name in args['spell_name']:
-            spell = Spell.create_by_name(spell_name, spells, all_modifiers, verbose = True)
-            print spell
-            pprint(spell.modifiers)
-            print
+            with PROFILER.entry(spell_name):
+                spell = Spell.create_by_name(spell_name, spells, all_modifiers, verbose = True, diagnostics = diagnostics)
+                text = explain_spell(spell, args['explain'])
+                # json explanations are written one per line, so warnings go to stderr
+                diagnostics.report(sys.stderr if args['explain'] == 'json' else sys.stdout, '#')
+                diagnostics.take()
+                print text
     else:
-        for spell_name in sorted(spells.keys()):
-            if spell_name == 'default spell':
-                continue
-            spell = Spell.create_by_name(spell_name, spells, all_modifiers, args['verbose'])
-            if args['type'] and not spell.has_nested_attribute(args['type']):
-                continue
-            print spell
-            if args['verbose']:
-                print spell.modifiers
-                print
+        if args['type']:
+            # find the spells without building them
+            property_index = load_property_index(data_file_name(args), resolve_spells,
+                module_source_hash(*PROPERTY_INDEX_MODULES), PLURAL_MAPPINGS)
+            spell_names = property_index.find(*parse_query(args['type']))
+        else:
+            spell_names = sorted(spells.keys())
+        cache = None
+        if not (args['verbose'] or args['profile'] or args['no_cache']):
+            cache = ResultCache.for_data_file(data_file_name(args), module_source_hash(*LEVELING_MODULES))
+            # every spell is hashed before any is leveled, since subspells
+            # modify the nested attributes that resolved spells share
+            entry_hashes = dict(
+                (spell_name, cache.entry_hash(spell_name, spells[spell_name]))
+                for spell_name in spell_names
+            )
+        try:
+            for spell_name in spell_names:
+                if spell_name == 'default spell':
+                    continue
+                with PROFILER.entry(spell_name):
+                    if cache is not None:
+                        level, spell_diagnostics = calculate_cached_level(
+                            spell_name, spells[spell_name], all_modifiers, cache, entry_hashes[spell_name]
+                        )
+                        diagnostics.extend(spell_diagnostics)
+                        text = "{0}: {1}".format(spell_name, level)
+                    else:
+                        spell = Spell.create_by_name(spell_name, spells, all_modifiers, args['verbose'], diagnostics)
+                        if args['verbose']:
+                            text = explain_spell(spell, args['explain'], pretty_modifiers=False)
+                        else:
+                            text = str(spell)
+                    # each spell's warnings are written as comments before its level
+                    diagnostics.report(sys.stderr if args['explain'] == 'json' and args['verbose'] else sys.stdout, '#')
+                    diagnostics.take()
+                    print text
+        finally:
+            if cache is not None:
+                cache.close()
+    if args['profile']:
+        PROFILER.report(sys.stderr)
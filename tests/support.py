@@ -0,0 +1,32 @@
+"""Paths and shared data for the tests of both spell engines
+
+The engines are scripts rather than packages, so the tests import them the
+way the scripts import each other: with the repository and the new engine
+directory on the path. Run the tests from the repository with
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+
+REPOSITORY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+NEW_ENGINE_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, 'new')
+for directory in [NEW_ENGINE_DIRECTORY, REPOSITORY_DIRECTORY]:
+    if directory not in sys.path:
+        sys.path.insert(1, directory)
+
+import spell_engine
+
+SPELLS_FILE_NAME = os.path.join(NEW_ENGINE_DIRECTORY, 'spells.yaml')
+MODIFIERS_FILE_NAME = os.path.join(NEW_ENGINE_DIRECTORY, 'modifiers.yaml')
+
+
+def load_spells():
+    """Load the resolved spells of the new engine"""
+    return spell_engine.import_yaml_file(SPELLS_FILE_NAME)
+
+
+def load_modifiers():
+    """Load a ModifierTable with its own subability cache"""
+    return spell_engine.ModifierTable(MODIFIERS_FILE_NAME)
@@ -0,0 +1,71 @@
+import copy
+import unittest
+
+import support
+from spell_engine import Engine, level_ability, TracingAbility
+
+
+class EngineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.spells = support.load_spells()
+        cls.abilities = sorted(cls.spells.items())
+
+    def test_parallel_records_match_serial_records(self):
+        engine = Engine(support.load_modifiers())
+        serial_records = list(engine.evaluate_many(self.abilities, jobs=1))
+        parallel_records = list(engine.evaluate_many(self.abilities, jobs=2))
+        self.assertEqual(len(serial_records), len(self.abilities))
+        self.assertEqual(serial_records, parallel_records)
+
+    def test_properties_are_not_modified(self):
+        spells = copy.deepcopy(self.spells)
+        engine = Engine(support.load_modifiers())
+        for record in engine.evaluate_many(sorted(spells.items())):
+            pass
+        for ability_name, properties in sorted(spells.items()):
+            TracingAbility(ability_name, properties, support.load_modifiers()).trace()
+        self.assertEqual(spells, self.spells)
+
+    def test_records_have_levels_or_errors(self):
+        for record in Engine(support.load_modifiers()).evaluate_many(self.abilities):
+            if record.errors:
+                self.assertIsNone(record.level)
+            else:
+                self.assertIsNotNone(record.level)
+                self.assertTrue(record.modifier_paths)
+
+    def test_traced_levels_match_records(self):
+        modifiers = support.load_modifiers()
+        for record in Engine(modifiers).evaluate_many(self.abilities):
+            if record.errors:
+                continue
+            trace = TracingAbility(record.name, self.spells[record.name], modifiers).trace()
+            self.assertEqual(trace.level, record.level)
+
+
+class LevelAbilityTest(unittest.TestCase):
+
+    def test_every_error_is_collected(self):
+        record = level_ability('broken', {
+            'damage': 'normal',
+            'bogus': 1,
+            'targets': 'five',
+            'area': 'medium radius blob',
+        })
+        self.assertIsNone(record.level)
+        self.assertEqual(
+            [error.code for error in record.errors],
+            ['unknown-property', 'missing-modifier'],
+        )
+        self.assertIn('area type: blob', record.errors[1].message())
+
+    def test_valid_ability_has_no_errors(self):
+        record = level_ability('fireball', support.load_spells()['fireball'])
+        self.assertEqual(record.errors, [])
+        self.assertEqual(record.level, sum(record.breakdown.values()) - 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
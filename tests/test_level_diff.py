@@ -0,0 +1,97 @@
+import unittest
+
+import support
+from level_diff import EntryResult, evaluate_entries
+from spell_engine import make_diff_evaluator
+
+
+class CountingEvaluator(object):
+    """Evaluates entries with a fixed level, and counts the evaluations"""
+
+    def __init__(self, modifier_paths=frozenset([('range', 'close')])):
+        self.modifier_paths = modifier_paths
+        self.evaluated_names = list()
+
+    def __call__(self, name, properties):
+        self.evaluated_names.append(name)
+        return EntryResult(None, None, len(properties), {}, self.modifier_paths, None)
+
+
+class EvaluateEntriesTest(unittest.TestCase):
+
+    entries = {
+        'fireball': {'range': 'close', 'damage': 'normal'},
+        'haste': {'range': 'close', 'buffs': ['haste']},
+    }
+
+    def previous_results(self, modifier_paths=frozenset([('range', 'close')])):
+        results, reused_count = evaluate_entries(
+            self.entries, CountingEvaluator(modifier_paths), 'code'
+        )
+        self.assertEqual(reused_count, 0)
+        return results
+
+    def test_unchanged_entries_are_reused(self):
+        evaluate = CountingEvaluator()
+        results, reused_count = evaluate_entries(
+            self.entries, evaluate, 'code', self.previous_results()
+        )
+        self.assertEqual(reused_count, 2)
+        self.assertEqual(evaluate.evaluated_names, [])
+        self.assertEqual(results['fireball'].level, 2)
+
+    def test_changed_entries_are_evaluated_again(self):
+        entries = dict(self.entries)
+        entries['haste'] = {'range': 'far', 'buffs': ['haste']}
+        evaluate = CountingEvaluator()
+        results, reused_count = evaluate_entries(
+            entries, evaluate, 'code', self.previous_results()
+        )
+        self.assertEqual(reused_count, 1)
+        self.assertEqual(evaluate.evaluated_names, ['haste'])
+
+    def test_changed_code_evaluates_every_entry_again(self):
+        evaluate = CountingEvaluator()
+        results, reused_count = evaluate_entries(
+            self.entries, evaluate, 'other code', self.previous_results()
+        )
+        self.assertEqual(reused_count, 0)
+        self.assertEqual(sorted(evaluate.evaluated_names), ['fireball', 'haste'])
+        self.assertEqual(results['fireball'].code_hash, 'other code')
+
+    def test_only_entries_that_read_changed_modifiers_are_evaluated_again(self):
+        previous = self.previous_results()
+        previous['haste'] = previous['haste']._replace(modifier_paths=frozenset([('buffs', 'haste')]))
+        evaluate = CountingEvaluator()
+        results, reused_count = evaluate_entries(
+            self.entries, evaluate, 'code', previous, set([('buffs', 'haste')])
+        )
+        self.assertEqual(reused_count, 1)
+        self.assertEqual(evaluate.evaluated_names, ['haste'])
+
+    def test_entries_without_modifier_paths_are_evaluated_after_any_change(self):
+        evaluate = CountingEvaluator()
+        results, reused_count = evaluate_entries(
+            self.entries, evaluate, 'code', self.previous_results(modifier_paths=None),
+            set([('unrelated', 'path')])
+        )
+        self.assertEqual(reused_count, 0)
+
+
+class DiffEvaluatorTest(unittest.TestCase):
+
+    def test_results_match_the_engine(self):
+        modifiers = support.load_modifiers()
+        evaluate = make_diff_evaluator(modifiers.index)
+        spells = support.load_spells()
+        for ability_name in ['acid fog', 'fireball', 'haste']:
+            result = evaluate(ability_name, spells[ability_name])
+            self.assertIsNone(result.error)
+            self.assertEqual(result.level, support.spell_engine.level_ability(
+                ability_name, spells[ability_name], modifiers
+            ).level)
+            self.assertTrue(result.modifier_paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import copy
+import itertools
+import random
+import unittest
+
+import support
+from diagnostics import DiagnosticError
+from modifier_index import ModifierIndex
+from rebalance import compile_plans, PlanEvaluator
+from spell_engine import Ability, Engine, import_yaml_file, ModifierTable
+
+
+def changed_modifiers(modifiers, seed):
+    """Copy nested modifiers with every integer changed by a small amount"""
+    generator = random.Random(seed)
+
+    def change(value):
+        if isinstance(value, dict):
+            return dict((key, change(subvalue)) for key, subvalue in value.items())
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value + generator.choice([-1, 0, 1, 2])
+        return value
+    return change(copy.deepcopy(modifiers))
+
+
+def ability_level(ability_name, properties, modifiers):
+    """Level an ability directly, without validating it like plans"""
+    properties = dict(properties)
+    properties['skip validation'] = True
+    try:
+        return Ability(ability_name, properties, modifiers).spell_level()
+    except DiagnosticError:
+        return None
+
+
+class PlanEvaluatorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.spells = support.load_spells()
+        cls.modifiers = support.load_modifiers()
+        cls.evaluator = PlanEvaluator(compile_plans(cls.spells, cls.modifiers))
+
+    def test_plans_match_the_engine_with_the_base_table(self):
+        levels = self.evaluator.evaluate([self.modifiers.index])
+        records = dict(
+            (record.name, record)
+            for record in Engine(self.modifiers).evaluate_many(sorted(self.spells.items()))
+        )
+        compared_count = 0
+        for row, ability_name in enumerate(self.evaluator.names):
+            if records[ability_name].errors:
+                continue
+            self.assertAlmostEqual(levels[row, 0], records[ability_name].level, msg=ability_name)
+            compared_count += 1
+        self.assertGreater(compared_count, 200)
+
+    def test_plans_match_the_engine_with_changed_tables(self):
+        raw_modifiers = import_yaml_file(support.MODIFIERS_FILE_NAME)
+        tables = [ModifierIndex(changed_modifiers(raw_modifiers, seed)) for seed in range(3)]
+        levels = self.evaluator.evaluate(tables)
+        for column, table in enumerate(tables):
+            modifiers = ModifierTable(modifiers=table)
+            compared_count = 0
+            for row, ability_name in enumerate(self.evaluator.names):
+                level = ability_level(ability_name, self.spells[ability_name], modifiers)
+                if level is None:
+                    continue
+                self.assertAlmostEqual(levels[row, column], level, msg=ability_name)
+                compared_count += 1
+            self.assertGreater(compared_count, 200)
+
+    def test_halved_areas_match_the_engine(self):
+        # knowledge abilities halve their area before targets halve it again
+        table = self.modifiers.index.table
+        areas = sorted(set(
+            '{0} {1}'.format(path[2], path[1])
+            for path in table if path[0] == 'area' and len(path) == 3
+        ))
+        area_types = sorted(set(path[1] for path in table if path[0] == 'area type'))
+        data = dict()
+        for index, (area, area_type, knowledge) in enumerate(
+                itertools.product(areas, area_types, [False, True])):
+            properties = {
+                'area': '{0} {1}'.format(area, area_type),
+                'targets': 'automatically find one',
+            }
+            if knowledge:
+                properties.update({'knowledge': 'thoughts', 'duration': 'round'})
+            else:
+                properties['damage'] = 'normal'
+            data['area {0}'.format(index)] = properties
+        evaluator = PlanEvaluator(compile_plans(data, self.modifiers))
+        levels = evaluator.evaluate([self.modifiers.index])
+        for row, ability_name in enumerate(evaluator.names):
+            self.assertAlmostEqual(
+                levels[row, 0],
+                ability_level(ability_name, data[ability_name], self.modifiers),
+                msg=data[ability_name],
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
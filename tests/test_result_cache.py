@@ -0,0 +1,94 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import support
+import result_cache
+from result_cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'results.sqlite')
+        self.table = {('range', 'close'): 1, ('range', 'far'): 3, ('damage', 'normal'): 2}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, code_hash='code', table=None):
+        cache = ResultCache(self.file_name, code_hash)
+        entry_hash = cache.entry_hash('fireball', {'range': 'close'})
+        cache.put(entry_hash, [('range', 'close')], table or self.table, 'stored level')
+        cache.close()
+
+    def fetch(self, code_hash='code', table=None):
+        cache = ResultCache(self.file_name, code_hash)
+        result = cache.get(cache.entry_hash('fireball', {'range': 'close'}), table or self.table)
+        cache.close()
+        return result
+
+    def test_result_is_reused(self):
+        self.store()
+        self.assertEqual(self.fetch(), 'stored level')
+
+    def test_changing_a_read_modifier_invalidates_the_result(self):
+        self.store()
+        table = dict(self.table)
+        table[('range', 'close')] = 2
+        self.assertIsNone(self.fetch(table=table))
+
+    def test_changing_an_unread_modifier_keeps_the_result(self):
+        self.store()
+        table = dict(self.table)
+        table[('range', 'far')] = 4
+        self.assertEqual(self.fetch(table=table), 'stored level')
+
+    def test_changing_the_code_invalidates_the_result(self):
+        self.store()
+        self.assertIsNone(self.fetch(code_hash='other code'))
+
+    def test_properties_are_part_of_the_entry_hash(self):
+        cache = ResultCache(self.file_name, 'code')
+        self.assertNotEqual(
+            cache.entry_hash('fireball', {'range': 'close'}),
+            cache.entry_hash('fireball', {'range': 'far'}),
+        )
+        cache.close()
+
+    def test_locked_store_is_skipped_and_kept(self):
+        self.store()
+        lock = sqlite3.connect(self.file_name)
+        lock.execute('BEGIN EXCLUSIVE')
+        timeout = result_cache.LOCK_TIMEOUT
+        result_cache.LOCK_TIMEOUT = 0.1
+        try:
+            self.assertIsNone(self.fetch())
+        finally:
+            result_cache.LOCK_TIMEOUT = timeout
+            lock.rollback()
+            lock.close()
+        self.assertEqual(self.fetch(), 'stored level')
+
+    def test_corrupt_store_is_replaced(self):
+        with open(self.file_name, 'w') as store_file:
+            store_file.write('not a database')
+        self.assertIsNone(self.fetch())
+        self.store()
+        self.assertEqual(self.fetch(), 'stored level')
+
+    def test_leveling_modules_are_hashed(self):
+        hash_before = result_cache.module_source_hash(*support.spell_engine.LEVELING_MODULES)
+        self.assertEqual(
+            hash_before, result_cache.module_source_hash(*support.spell_engine.LEVELING_MODULES)
+        )
+        self.assertNotEqual(
+            hash_before, result_cache.module_source_hash(*support.spell_engine.RESOLVING_MODULES)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
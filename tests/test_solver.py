@@ -0,0 +1,69 @@
+import itertools
+import unittest
+
+import support
+from solver import AbilitySolver
+
+
+def brute_force_solutions(solver, target, within=0):
+    """Level every combination of the candidates to find the solutions"""
+    property_names = sorted(solver.candidates)
+    solutions = set()
+    for values in itertools.product(*[
+            solver.candidates[property_name] for property_name in property_names]):
+        changes = dict(zip(property_names, values))
+        level = solver.level_with(changes)
+        if level is not None and abs(level - target) <= within + 1e-9:
+            solutions.add(tuple(sorted(changes.items())))
+    return solutions
+
+
+class AbilitySolverTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.spells = support.load_spells()
+
+    def assertMatchesBruteForce(self, ability_name, property_names, target, within=0):
+        solver = AbilitySolver(
+            ability_name, self.spells[ability_name], property_names, support.load_modifiers()
+        )
+        solutions = set(
+            tuple(sorted(solution.changes.items()))
+            for solution in solver.solutions(target, within)
+        )
+        self.assertTrue(solutions)
+        self.assertEqual(solutions, brute_force_solutions(solver, target, within))
+
+    def test_solutions_match_brute_force(self):
+        self.assertMatchesBruteForce(
+            'cloak of chaos', ['range', 'duration', 'dispellable', 'targets'], 6
+        )
+
+    def test_solutions_with_area_match_brute_force(self):
+        self.assertMatchesBruteForce(
+            'acid fog', ['area', 'targets', 'duration', 'spell resistance'], 5
+        )
+
+    def test_solutions_within_a_distance_match_brute_force(self):
+        self.assertMatchesBruteForce(
+            'cloak of chaos', ['range', 'duration', 'dispellable', 'targets'], 4, within=1
+        )
+
+    def test_solution_levels_are_the_levels_of_the_changed_ability(self):
+        solver = AbilitySolver(
+            'cloak of chaos', self.spells['cloak of chaos'], ['range', 'duration'],
+            support.load_modifiers()
+        )
+        for solution in solver.solutions(6, within=2):
+            self.assertAlmostEqual(solution.level, solver.level_with(solution.changes))
+
+    def test_properties_are_not_modified(self):
+        properties = dict(self.spells['acid fog'])
+        solver = AbilitySolver('acid fog', properties, ['area', 'targets'], support.load_modifiers())
+        list(solver.solutions(5, within=1))
+        self.assertEqual(properties, self.spells['acid fog'])
+
+
+if __name__ == '__main__':
+    unittest.main()